@@ -0,0 +1,165 @@
+#
+# Copyright (C) 2023  FreeIPA Contributors see COPYING for license
+#
+
+import json
+import os
+import queue
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+IPA_TUURA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "ipa-tuura")
+
+
+def setup_django(database=None):
+    """
+    Make the ipa-tuura applications importable and configure Django
+
+    :param database: optional path of a SQLite database to create and
+                     use instead of the configured one
+    """
+    sys.path.insert(0, os.path.normpath(IPA_TUURA))
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "root.settings")
+    import django
+    from django.conf import settings
+
+    if database is not None:
+        settings.DATABASES["default"] = {
+            "ENGINE": "django.db.backends.sqlite3",
+            "NAME": database,
+        }
+    django.setup()
+    if database is not None:
+        from django.core.management import call_command
+
+        call_command("migrate", verbosity=0)
+
+
+def summary(samples):
+    """
+    Return the count, mean, median, 95th and 99th percentiles and maximum
+    of a list of durations in seconds, as milliseconds.
+    """
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+
+    def percentile(p):
+        return round(ordered[min(len(ordered) - 1, len(ordered) * p // 100)] * 1000, 3)
+
+    return {
+        "count": len(ordered),
+        "mean_ms": round(statistics.fmean(ordered) * 1000, 3),
+        "p50_ms": percentile(50),
+        "p95_ms": percentile(95),
+        "p99_ms": percentile(99),
+        "max_ms": round(ordered[-1] * 1000, 3),
+    }
+
+
+def commit():
+    """
+    Return the commit of the tree being measured, if known
+    """
+    try:
+        proc = subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+        )
+    except OSError:
+        return None
+    return proc.stdout.strip() or None
+
+
+def report(name, results, output=None):
+    """
+    Write the results of a benchmark as JSON, to output or stdout
+    """
+    document = {
+        "benchmark": name,
+        "commit": commit(),
+        "timestamp": int(time.time()),
+        "results": results,
+    }
+    text = json.dumps(document, indent=2) + "\n"
+    if output:
+        with open(output, "w") as f:
+            f.write(text)
+    else:
+        sys.stdout.write(text)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class LatencyProxy:
+    """
+    TCP proxy in front of a local server, delaying the data by latency
+    seconds each way to simulate a WAN link: a request/response round
+    trip takes twice the latency more.
+    """
+
+    def __init__(self, port, latency):
+        self.target = ("127.0.0.1", port)
+        self.latency = latency
+        self._listener = socket.create_server(("127.0.0.1", 0))
+        self.port = self._listener.getsockname()[1]
+
+    def start(self):
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        while True:
+            try:
+                client, _ = self._listener.accept()
+            except OSError:
+                return
+            server = socket.create_connection(self.target)
+            for sock in (client, server):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self._pipe(client, server)
+            self._pipe(server, client)
+
+    def _pipe(self, src, dst):
+        # the data is sent when due, not after the previous chunk,
+        # so that the proxy adds latency without limiting the throughput
+        chunks = queue.SimpleQueue()
+
+        def read():
+            while True:
+                try:
+                    data = src.recv(65536)
+                except OSError:
+                    data = b""
+                chunks.put((time.monotonic() + self.latency, data))
+                if not data:
+                    return
+
+        def write():
+            while True:
+                due, data = chunks.get()
+                delay = due - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                try:
+                    if not data:
+                        dst.shutdown(socket.SHUT_WR)
+                        return
+                    dst.sendall(data)
+                except OSError:
+                    return
+
+        threading.Thread(target=read, daemon=True).start()
+        threading.Thread(target=write, daemon=True).start()
+
+    def stop(self):
+        self._listener.close()
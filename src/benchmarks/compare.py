@@ -0,0 +1,87 @@
+#
+# Copyright (C) 2023  FreeIPA Contributors see COPYING for license
+#
+
+"""
+Compare two results of a benchmark, for instance of two commits.
+
+Latencies, worker time and calls per request are better lower, rates
+better higher. Exits with status 1 when a metric regressed by more than
+the threshold.
+
+    python src/benchmarks/compare.py baseline.json results.json --threshold 10
+"""
+
+import argparse
+import json
+import sys
+
+# Metrics better higher, the other numeric ones are better lower
+HIGHER_IS_BETTER = ("per_second",)
+# Metrics not compared
+IGNORED = ("count", "errors", "requests", "concurrency", "directory", "setup")
+
+
+def _flatten(results, prefix=""):
+    for key, value in results.items():
+        if key in IGNORED:
+            continue
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            yield from _flatten(value, name + ".")
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            yield name, key, value
+
+
+def compare(baseline, current, threshold):
+    """
+    :returns: a list of (metric, baseline, current, change in percent,
+              regressed) tuples for the metrics present in both results
+    """
+    old = {name: value for name, _, value in _flatten(baseline["results"])}
+    rows = []
+    for name, key, value in _flatten(current["results"]):
+        if name not in old:
+            continue
+        before = old[name]
+        if before == 0:
+            change = 0.0 if value == 0 else float("inf")
+        else:
+            change = (value - before) / before * 100
+        worse = -change if key in HIGHER_IS_BETTER else change
+        rows.append((name, before, value, change, worse > threshold))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("baseline")
+    parser.add_argument("current")
+    parser.add_argument(
+        "--threshold", type=float, default=10, help="regression threshold in percent"
+    )
+    args = parser.parse_args()
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+    if baseline["benchmark"] != current["benchmark"]:
+        sys.stderr.write("the results are from different benchmarks\n")
+        return 2
+
+    print(
+        f"{baseline['benchmark']}: {baseline.get('commit')} -> {current.get('commit')}"
+    )
+    regressed = False
+    for name, before, value, change, worse in compare(
+        baseline, current, args.threshold
+    ):
+        mark = "  REGRESSION" if worse else ""
+        print(f"{name:60} {before:>12g} {value:>12g} {change:+8.1f}%{mark}")
+        regressed |= worse
+    return 1 if regressed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,236 @@
+#
+# Copyright (C) 2023  FreeIPA Contributors see COPYING for license
+#
+
+"""
+Compare the latency and worker time of the PAM and Kerberos credential
+validations.
+
+The Kerberos validations run against a throwaway MIT KDC started on
+localhost (krb5kdc, kdb5_util and kadmin.local are required), or against
+an existing realm with --realm, the tickets being verified with the host
+keytab (--keytab). The PAM validations go through the PAM
+stack of the host, they are only run when --pam-user is given; for a fair
+comparison the host should authenticate that user against the same KDC.
+
+    python src/benchmarks/creds_validation.py --count 500 --concurrency 8
+"""
+
+import argparse
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import FIRST_COMPLETED, wait
+
+from common import free_port, report, setup_django, summary
+
+REALM = "BENCH.TEST"
+PRINCIPAL = "bench"
+PASSWORD = "Secret123"
+
+KRB5_CONF = """[libdefaults]
+    default_realm = {realm}
+    dns_lookup_kdc = false
+    dns_lookup_realm = false
+    rdns = false
+
+[realms]
+    {realm} = {{
+        kdc = 127.0.0.1:{port}
+    }}
+"""
+
+KDC_CONF = """[kdcdefaults]
+    kdc_ports = {port}
+    kdc_tcp_ports = {port}
+
+[realms]
+    {realm} = {{
+        database_name = {path}/principal
+        key_stash_file = {path}/stash
+        acl_file = {path}/kadm5.acl
+    }}
+
+[logging]
+    kdc = FILE:{path}/kdc.log
+"""
+
+
+class LocalKDC:
+    """
+    MIT KDC serving a throwaway realm with one test principal, and a
+    keytab of the host principal
+    """
+
+    def __init__(self, realm=REALM):
+        self.realm = realm
+        self.path = tempfile.mkdtemp(prefix="ipatuura-kdc-")
+        self.keytab = os.path.join(self.path, "krb5.keytab")
+        self.port = free_port()
+        self.process = None
+
+    def _kadmin(self, query):
+        subprocess.run(
+            ["kadmin.local", "-r", self.realm, "-q", query],
+            check=True,
+            capture_output=True,
+        )
+
+    def start(self):
+        with open(os.path.join(self.path, "krb5.conf"), "w") as f:
+            f.write(KRB5_CONF.format(realm=self.realm, port=self.port))
+        with open(os.path.join(self.path, "kdc.conf"), "w") as f:
+            f.write(KDC_CONF.format(realm=self.realm, port=self.port, path=self.path))
+        open(os.path.join(self.path, "kadm5.acl"), "w").close()
+        os.environ["KRB5_CONFIG"] = os.path.join(self.path, "krb5.conf")
+        os.environ["KRB5_KDC_PROFILE"] = os.path.join(self.path, "kdc.conf")
+
+        subprocess.run(
+            ["kdb5_util", "create", "-s", "-r", self.realm, "-P", "master"],
+            check=True,
+            capture_output=True,
+        )
+        self._kadmin(f"addprinc +requires_preauth -pw {PASSWORD} {PRINCIPAL}")
+        host = f"host/{socket.gethostname()}"
+        self._kadmin(f"addprinc -randkey {host}")
+        self._kadmin(f"ktadd -k {self.keytab} {host}")
+        self.process = subprocess.Popen(["krb5kdc", "-n", "-r", self.realm])
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline:
+            try:
+                socket.create_connection(("127.0.0.1", self.port), 0.2).close()
+                return
+            except OSError:
+                time.sleep(0.1)
+        raise RuntimeError("krb5kdc did not start")
+
+    def stop(self):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.wait()
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+def _timed(func):
+    """
+    Wrap a validation to also return the CPU time of the worker thread
+    """
+
+    def run(*args):
+        start = time.thread_time()
+        res = func(*args)
+        return res, time.thread_time() - start
+
+    return run
+
+
+def measure(pool, func, username, password, count, concurrency):
+    """
+    Run count validations through the pool, at most concurrency at once
+
+    :returns: the latency, worker time and throughput of the validations
+    """
+    timed = _timed(func)
+    latencies = []
+    worker = []
+    codes = {}
+    running = {}
+    submitted = 0
+    start = time.monotonic()
+    while submitted < count or running:
+        while submitted < count and len(running) < concurrency:
+            running[pool.submit(timed, username, password)] = time.monotonic()
+            submitted += 1
+        done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+        for future in done:
+            latencies.append(time.monotonic() - running.pop(future))
+            (res, reason, code), cpu = future.result()
+            worker.append(cpu)
+            codes[str(code)] = codes.get(str(code), 0) + 1
+    elapsed = time.monotonic() - start
+    return {
+        "latency": summary(latencies),
+        "worker_cpu": summary(worker),
+        "codes": codes,
+        "per_second": round(count / elapsed, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--count", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument(
+        "--realm", help="existing realm to validate against, no local KDC"
+    )
+    parser.add_argument(
+        "--keytab", default="/etc/krb5.keytab", help="host keytab of --realm"
+    )
+    parser.add_argument("--principal", default=PRINCIPAL)
+    parser.add_argument("--password", default=PASSWORD)
+    parser.add_argument("--pam-user", help="user validated through PAM")
+    parser.add_argument("--pam-password", default=PASSWORD)
+    parser.add_argument("--output", help="JSON results file, stdout by default")
+    args = parser.parse_args()
+
+    kdc = None
+    realm = args.realm
+    keytab = args.keytab
+    if realm is None:
+        kdc = LocalKDC()
+        kdc.start()
+        realm = kdc.realm
+        keytab = kdc.keytab
+
+    setup_django()
+    from creds.pool import ValidationPool
+    from creds.validators import kerberos_authenticate, pam_authenticate
+
+    pool = ValidationPool()
+    principal = f"{args.principal}@{realm}"
+    service = f"host/{socket.gethostname()}@{realm}"
+
+    def kerberos(principal, password):
+        return kerberos_authenticate(principal, password, service, keytab)
+
+    results = {"count": args.count, "concurrency": args.concurrency}
+    try:
+        results["kerberos"] = measure(
+            pool,
+            kerberos,
+            principal,
+            args.password,
+            args.count,
+            args.concurrency,
+        )
+        results["kerberos_bad_password"] = measure(
+            pool,
+            kerberos,
+            principal,
+            args.password + "x",
+            args.count,
+            args.concurrency,
+        )
+        if args.pam_user:
+            results["pam"] = measure(
+                pool,
+                pam_authenticate,
+                args.pam_user,
+                args.pam_password,
+                args.count,
+                args.concurrency,
+            )
+    finally:
+        if kdc is not None:
+            kdc.stop()
+
+    report("creds_validation", results, args.output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
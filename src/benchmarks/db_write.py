@@ -0,0 +1,177 @@
+#
+# Copyright (C) 2023  FreeIPA Contributors see COPYING for license
+#
+
+"""
+Measure the concurrent database writes of several worker processes, as
+served by several WSGI workers, for each database configuration.
+
+Each worker creates users, reads them back and modifies them, each write
+in a transaction reading the user first like SCIMUser.save. The legacy
+profile is the former SQLite configuration (rollback journal, full
+synchronous, deferred transactions, 5s timeout), the sqlite profile the
+default one (WAL). The postgresql profile is measured with --postgresql,
+configured by the IPATUURA_DB_* variables; it needs a database of its
+own, whose tables are migrated and kept.
+
+    python src/benchmarks/db_write.py --workers 8 --writes 200 --output results.json
+"""
+
+import argparse
+import logging
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+from common import report, setup_django, summary
+
+PROFILES = {
+    "legacy": {
+        "IPATUURA_DATABASE": "sqlite",
+        "IPATUURA_SQLITE_JOURNAL_MODE": "DELETE",
+        "IPATUURA_SQLITE_SYNCHRONOUS": "FULL",
+        "IPATUURA_SQLITE_BUSY_TIMEOUT": "5",
+        "IPATUURA_SQLITE_TRANSACTION_MODE": "DEFERRED",
+    },
+    "sqlite": {"IPATUURA_DATABASE": "sqlite"},
+    "postgresql": {"IPATUURA_DATABASE": "postgresql"},
+}
+
+
+def _setup(env):
+    os.environ.update(env)
+    os.environ["DJANGO_DEBUG"] = "False"
+    setup_django()
+    logging.disable(logging.INFO)
+
+
+def _migrate(env):
+    _setup(env)
+    from django.core.management import call_command
+
+    call_command("migrate", verbosity=0)
+
+
+def _worker(env, prefix, writes, start, results):
+    _setup(env)
+    from django.db import OperationalError, transaction
+    from ipatuura.models import User
+
+    def create(name):
+        with transaction.atomic():
+            User.objects.filter(scim_username=name).exists()
+            User(
+                scim_username=name,
+                first_name="Bench",
+                last_name=name,
+                email=f"{name}@bench.test",
+            ).save()
+
+    def read(name):
+        list(User.objects.filter(scim_username__startswith=prefix)[:50])
+
+    def modify(name):
+        with transaction.atomic():
+            user = User.objects.filter(scim_username=name).first()
+            user.first_name = "Modified"
+            user.save()
+
+    operations = (("create", create), ("read", read), ("modify", modify))
+    latencies = {op: [] for op, _ in operations}
+    errors = {"locked": 0, "other": 0}
+    start.wait()
+    for i in range(writes):
+        name = f"{prefix}{i}"
+        for op, func in operations:
+            begin = time.perf_counter()
+            try:
+                func(name)
+            except OperationalError as e:
+                errors["locked" if "locked" in str(e) else "other"] += 1
+            except Exception:
+                errors["other"] += 1
+            latencies[op].append(time.perf_counter() - begin)
+    results.put((latencies, errors))
+
+
+def run(env, workers, writes, run_id):
+    """
+    Run the workers of a profile at once
+
+    :returns: the throughput, latency summaries and errors of the profile
+    """
+    ctx = multiprocessing.get_context("spawn")
+    migrate = ctx.Process(target=_migrate, args=(env,))
+    migrate.start()
+    migrate.join()
+    if migrate.exitcode != 0:
+        raise RuntimeError("migrate failed")
+
+    start = ctx.Event()
+    results = ctx.Queue()
+    processes = [
+        ctx.Process(
+            target=_worker,
+            args=(env, f"bench{run_id}_{i}_", writes, start, results),
+        )
+        for i in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    # leave the workers time to import Django
+    time.sleep(5)
+    begin = time.perf_counter()
+    start.set()
+    collected = [results.get() for _ in processes]
+    elapsed = time.perf_counter() - begin
+    for process in processes:
+        process.join()
+
+    latencies = {}
+    errors = {"locked": 0, "other": 0}
+    for worker_latencies, worker_errors in collected:
+        for op, samples in worker_latencies.items():
+            latencies.setdefault(op, []).extend(samples)
+        for kind, count in worker_errors.items():
+            errors[kind] += count
+    operations = sum(len(samples) for samples in latencies.values())
+    return {
+        "errors": errors,
+        "per_second": round(operations / elapsed, 1),
+        "latency": {op: summary(samples) for op, samples in latencies.items()},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--writes", type=int, default=200, help="users per worker")
+    parser.add_argument(
+        "--postgresql", action="store_true", help="also measure PostgreSQL"
+    )
+    parser.add_argument("--output", help="JSON results file, stdout by default")
+    args = parser.parse_args()
+
+    results = {
+        "setup": {"workers": args.workers, "writes": args.writes},
+        "profiles": {},
+    }
+    run_id = int(time.time())
+    with tempfile.TemporaryDirectory() as path:
+        for name, env in PROFILES.items():
+            env = dict(env)
+            if name == "postgresql":
+                if not args.postgresql:
+                    continue
+            else:
+                env["IPATUURA_DB_NAME"] = os.path.join(path, f"{name}.sqlite3")
+            results["profiles"][name] = run(env, args.workers, args.writes, run_id)
+
+    report("db_write", results, args.output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
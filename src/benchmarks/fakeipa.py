@@ -0,0 +1,203 @@
+#
+# Copyright (C) 2023  FreeIPA Contributors see COPYING for license
+#
+
+"""
+Stand-in for the IPA JSON-RPC endpoint, serving the user and group
+commands of the IPA writable interface from memory.
+
+The commands and errors follow the IPA API: a request is a JSON object
+{"method": "user_add/1", "params": [args, options], "id": id}, a failed
+command returns the IPA error code, for instance 4001 for NotFound.
+"""
+
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+NOT_FOUND = 4001
+DUPLICATE_ENTRY = 4002
+EMPTY_MODLIST = 4202
+
+COMMANDS = (
+    "user_add",
+    "user_mod",
+    "user_del",
+    "group_add",
+    "group_del",
+    "group_add_member",
+    "group_remove_member",
+)
+
+
+class CommandError(Exception):
+    def __init__(self, code, name, message):
+        super().__init__(message)
+        self.code = code
+        self.name = name
+
+
+def _not_found(kind, name):
+    return CommandError(NOT_FOUND, "NotFound", f"{name}: {kind} not found")
+
+
+class Directory:
+    """
+    Users and groups of the fake IPA server
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.users = {}
+        self.groups = {}
+
+    def _name(self, args, options, key):
+        if args:
+            return args[0]
+        return options.pop(key)
+
+    def user_add(self, args, options):
+        uid = self._name(args, options, "uid")
+        if uid in self.users:
+            raise CommandError(
+                DUPLICATE_ENTRY,
+                "DuplicateEntry",
+                f'user with name "{uid}" already exists',
+            )
+        self.users[uid] = {k: v for k, v in options.items() if v is not None}
+        return {"result": {"uid": [uid]}, "value": uid, "summary": f'Added "{uid}"'}
+
+    def user_mod(self, args, options):
+        uid = self._name(args, options, "uid")
+        if uid not in self.users:
+            raise _not_found("user", uid)
+        user = self.users[uid]
+        changed = False
+        for attr, value in options.items():
+            if value is None:
+                changed |= user.pop(attr, None) is not None
+            elif user.get(attr) != value:
+                user[attr] = value
+                changed = True
+        if not changed:
+            raise CommandError(EMPTY_MODLIST, "EmptyModlist", "no modifications")
+        return {"result": {"uid": [uid]}, "value": uid, "summary": f'Modified "{uid}"'}
+
+    def user_del(self, args, options):
+        uid = self._name(args, options, "uid")
+        if self.users.pop(uid, None) is None:
+            raise _not_found("user", uid)
+        for members in self.groups.values():
+            members.discard(uid)
+        return {"result": {"failed": []}, "value": [uid]}
+
+    def group_add(self, args, options):
+        cn = self._name(args, options, "cn")
+        if cn in self.groups:
+            raise CommandError(
+                DUPLICATE_ENTRY,
+                "DuplicateEntry",
+                f'group with name "{cn}" already exists',
+            )
+        self.groups[cn] = set()
+        return {"result": {"cn": [cn]}, "value": cn}
+
+    def group_del(self, args, options):
+        cn = self._name(args, options, "cn")
+        if self.groups.pop(cn, None) is None:
+            raise _not_found("group", cn)
+        return {"result": {"failed": []}, "value": [cn]}
+
+    def _members(self, args, options, add):
+        cn = self._name(args, options, "cn")
+        if cn not in self.groups:
+            raise _not_found("group", cn)
+        members = self.groups[cn]
+        users = options.get("user") or []
+        if isinstance(users, str):
+            users = [users]
+        failed = []
+        for uid in users:
+            if (uid in members) == add:
+                reason = "already a member" if add else "not a member"
+                failed.append([uid, f"This entry is {reason}"])
+            elif add:
+                members.add(uid)
+            else:
+                members.discard(uid)
+        return {
+            "result": {"cn": [cn]},
+            "completed": len(users) - len(failed),
+            "failed": {"member": {"user": failed, "group": []}},
+        }
+
+    def group_add_member(self, args, options):
+        return self._members(args, options, True)
+
+    def group_remove_member(self, args, options):
+        return self._members(args, options, False)
+
+    def count_users(self, prefix, **attrs):
+        """
+        Return the number of users whose name starts with prefix and
+        having the given attribute values
+        """
+        with self.lock:
+            return sum(
+                1
+                for uid, user in self.users.items()
+                if uid.startswith(prefix)
+                and all(user.get(k) == v for k, v in attrs.items())
+            )
+
+    def call(self, method, args, options):
+        command = method.split("/", 1)[0]
+        if command not in COMMANDS:
+            raise CommandError(3005, "CommandError", f"unknown command '{command}'")
+        with self.lock:
+            return getattr(self, command)(list(args), dict(options))
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        args, options = request["params"]
+        response = {"id": request.get("id"), "error": None, "result": None}
+        try:
+            response["result"] = self.server.directory.call(
+                request["method"], args, options
+            )
+        except CommandError as e:
+            response["error"] = {"code": e.code, "name": e.name, "message": str(e)}
+        body = json.dumps(response).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeIPA:
+    """
+    Fake IPA server running in a thread of this process
+    """
+
+    def __init__(self):
+        self.directory = Directory()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+        self._server.daemon_threads = True
+        self._server.directory = self.directory
+        self.port = self._server.server_address[1]
+
+    def start(self):
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
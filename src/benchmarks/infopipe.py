@@ -0,0 +1,335 @@
+#
+# Copyright (C) 2023  FreeIPA Contributors see COPYING for license
+#
+
+"""
+Stand-in for the SSSD infopipe responder, serving generated users and
+groups on a private bus.
+
+The group sizes follow a power law: the group of rank r has about
+max_group_size / r ** skew members, so that a few groups are large and
+most are small. The data only depends on the seed.
+
+    python src/benchmarks/infopipe.py --address unix:path=/tmp/bus --users 1000
+"""
+
+import argparse
+import fnmatch
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+DBUS_SSSD_NAME = "org.freedesktop.sssd.infopipe"
+DBUS_SSSD_PATH = "/org/freedesktop/sssd/infopipe"
+DBUS_SSSD_IF = "org.freedesktop.sssd.infopipe"
+DBUS_PROPERTY_IF = "org.freedesktop.DBus.Properties"
+DBUS_SSSD_USERS_PATH = "/org/freedesktop/sssd/infopipe/Users"
+DBUS_SSSD_USERS_IF = "org.freedesktop.sssd.infopipe.Users"
+DBUS_SSSD_USER_IF = "org.freedesktop.sssd.infopipe.Users.User"
+DBUS_SSSD_GROUPS_PATH = "/org/freedesktop/sssd/infopipe/Groups"
+DBUS_SSSD_GROUPS_IF = "org.freedesktop.sssd.infopipe.Groups"
+DBUS_SSSD_GROUP_IF = "org.freedesktop.sssd.infopipe.Groups.Group"
+NOT_FOUND = "org.freedesktop.sssd.Error.NotFound"
+
+# Interface counting the calls served, not counted itself
+BENCH_IF = "org.ipatuura.Bench"
+
+FIRST_UID = 100000
+FIRST_GID = 200000
+
+BUS_CONFIG = """<!DOCTYPE busconfig PUBLIC
+ "-//freedesktop//DTD D-Bus Bus Configuration 1.0//EN"
+ "http://www.freedesktop.org/standards/dbus/1.0/busconfig.dtd">
+<busconfig>
+  <type>session</type>
+  <listen>unix:path={path}/bus</listen>
+  <policy context="default">
+    <allow send_destination="*" eavesdrop="true"/>
+    <allow eavesdrop="true"/>
+    <allow own="*"/>
+  </policy>
+</busconfig>
+"""
+
+
+class Directory:
+    """
+    Generated users, groups and memberships
+    """
+
+    def __init__(self, users=1000, groups=50, max_group_size=500, skew=1.0, seed=0):
+        rng = random.Random(seed)
+        self.user_names = [f"user{i}" for i in range(users)]
+        self.group_names = [f"group{i}" for i in range(groups)]
+        self.members = []
+        self.user_groups = [[] for _ in range(users)]
+        for rank in range(groups):
+            size = max(1, min(users, int(max_group_size / (rank + 1) ** skew)))
+            members = rng.sample(range(users), size)
+            self.members.append(members)
+            for user in members:
+                self.user_groups[user].append(rank)
+
+    def user(self, name):
+        if not name.startswith("user"):
+            return None
+        try:
+            index = int(name[4:])
+        except ValueError:
+            return None
+        return index if index < len(self.user_names) else None
+
+    def group(self, name):
+        if not name.startswith("group"):
+            return None
+        try:
+            index = int(name[5:])
+        except ValueError:
+            return None
+        return index if index < len(self.group_names) else None
+
+
+def serve(address, directory):
+    """
+    Serve the directory on the bus at address until terminated
+    """
+    import dbus
+    import dbus.bus
+    import dbus.service
+    from dbus.mainloop.glib import DBusGMainLoop
+    from gi.repository import GLib
+
+    DBusGMainLoop(set_as_default=True)
+    bus = dbus.bus.BusConnection(address)
+    calls = [0]
+
+    class NotFound(dbus.exceptions.DBusException):
+        _dbus_error_name = NOT_FOUND
+
+    def user_path(index):
+        return dbus.ObjectPath(f"{DBUS_SSSD_USERS_PATH}/{FIRST_UID + index}")
+
+    def group_path(index):
+        return dbus.ObjectPath(f"{DBUS_SSSD_GROUPS_PATH}/{FIRST_GID + index}")
+
+    def index_of(rel_path, first, count):
+        try:
+            index = int(rel_path.rsplit("/", 1)[1]) - first
+        except ValueError:
+            raise NotFound(rel_path)
+        if not 0 <= index < count:
+            raise NotFound(rel_path)
+        return index
+
+    def match(names, name_filter, limit, path):
+        indexes = [
+            i for i, name in enumerate(names) if fnmatch.fnmatchcase(name, name_filter)
+        ]
+        if not indexes:
+            raise NotFound(name_filter)
+        return dbus.Array([path(i) for i in indexes[: limit or None]], signature="o")
+
+    class Infopipe(dbus.service.Object):
+        @dbus.service.method(DBUS_SSSD_IF, in_signature="s", out_signature="as")
+        def GetUserGroups(self, name):
+            calls[0] += 1
+            index = directory.user(str(name))
+            if index is None:
+                raise NotFound(name)
+            return [directory.group_names[g] for g in directory.user_groups[index]]
+
+        @dbus.service.method(BENCH_IF, in_signature="", out_signature="t")
+        def Calls(self):
+            return calls[0]
+
+    class Users(dbus.service.FallbackObject):
+        @dbus.service.method(DBUS_SSSD_USERS_IF, in_signature="s", out_signature="o")
+        def FindByName(self, name):
+            calls[0] += 1
+            index = directory.user(str(name))
+            if index is None:
+                raise NotFound(name)
+            return user_path(index)
+
+        @dbus.service.method(DBUS_SSSD_USERS_IF, in_signature="u", out_signature="o")
+        def FindByID(self, id):
+            calls[0] += 1
+            index = int(id) - FIRST_UID
+            if not 0 <= index < len(directory.user_names):
+                raise NotFound(id)
+            return user_path(index)
+
+        @dbus.service.method(DBUS_SSSD_USERS_IF, in_signature="su", out_signature="ao")
+        def ListByName(self, name_filter, limit):
+            calls[0] += 1
+            return match(directory.user_names, name_filter, limit, user_path)
+
+        @dbus.service.method(
+            DBUS_PROPERTY_IF,
+            in_signature="ss",
+            out_signature="v",
+            rel_path_keyword="rel_path",
+        )
+        def Get(self, interface, prop, rel_path):
+            calls[0] += 1
+            index = index_of(rel_path, FIRST_UID, len(directory.user_names))
+            name = directory.user_names[index]
+            if prop == "name":
+                return dbus.String(name)
+            if prop == "uidNumber":
+                return dbus.UInt32(FIRST_UID + index)
+            if prop == "extraAttributes":
+                return dbus.Dictionary(
+                    {
+                        "mail": [f"{name}@bench.test"],
+                        "givenname": [name],
+                        "sn": ["Bench"],
+                    },
+                    signature="sas",
+                )
+            raise NotFound(prop)
+
+    class Groups(dbus.service.FallbackObject):
+        @dbus.service.method(DBUS_SSSD_GROUPS_IF, in_signature="s", out_signature="o")
+        def FindByName(self, name):
+            calls[0] += 1
+            index = directory.group(str(name))
+            if index is None:
+                raise NotFound(name)
+            return group_path(index)
+
+        @dbus.service.method(DBUS_SSSD_GROUPS_IF, in_signature="u", out_signature="o")
+        def FindByID(self, id):
+            calls[0] += 1
+            index = int(id) - FIRST_GID
+            if not 0 <= index < len(directory.group_names):
+                raise NotFound(id)
+            return group_path(index)
+
+        @dbus.service.method(DBUS_SSSD_GROUPS_IF, in_signature="su", out_signature="ao")
+        def ListByName(self, name_filter, limit):
+            calls[0] += 1
+            return match(directory.group_names, name_filter, limit, group_path)
+
+        @dbus.service.method(
+            DBUS_SSSD_GROUP_IF, in_signature="u", rel_path_keyword="rel_path"
+        )
+        def UpdateMemberList(self, id, rel_path):
+            calls[0] += 1
+
+        @dbus.service.method(
+            DBUS_PROPERTY_IF,
+            in_signature="ss",
+            out_signature="v",
+            rel_path_keyword="rel_path",
+        )
+        def Get(self, interface, prop, rel_path):
+            calls[0] += 1
+            index = index_of(rel_path, FIRST_GID, len(directory.group_names))
+            if prop == "name":
+                return dbus.String(directory.group_names[index])
+            if prop == "gidNumber":
+                return dbus.UInt32(FIRST_GID + index)
+            if prop == "users":
+                return dbus.Array(
+                    [user_path(u) for u in directory.members[index]], signature="o"
+                )
+            raise NotFound(prop)
+
+    name = dbus.service.BusName(DBUS_SSSD_NAME, bus)
+    objects = [
+        Infopipe(bus, DBUS_SSSD_PATH),
+        Users(bus, DBUS_SSSD_USERS_PATH),
+        Groups(bus, DBUS_SSSD_GROUPS_PATH),
+    ]
+    GLib.MainLoop().run()
+    return name, objects
+
+
+class PrivateBus:
+    """
+    Private bus running the stand-in infopipe. While started, the system
+    bus of this process and its children is the private bus.
+    """
+
+    def __init__(self, **options):
+        self.options = options
+        self.path = tempfile.mkdtemp(prefix="ipatuura-bus-")
+        self.address = f"unix:path={self.path}/bus"
+        self.processes = []
+
+    def start(self):
+        config = os.path.join(self.path, "bus.conf")
+        with open(config, "w") as f:
+            f.write(BUS_CONFIG.format(path=self.path))
+        self.processes.append(
+            subprocess.Popen(["dbus-daemon", "--nofork", f"--config-file={config}"])
+        )
+        args = [sys.executable, os.path.abspath(__file__), "--address", self.address]
+        for key, value in self.options.items():
+            args += ["--" + key.replace("_", "-"), str(value)]
+        self.processes.append(subprocess.Popen(args))
+        os.environ["DBUS_SYSTEM_BUS_ADDRESS"] = self.address
+        self._wait()
+
+    def _wait(self, timeout=60):
+        import dbus
+        import dbus.bus
+
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            try:
+                bus = dbus.bus.BusConnection(self.address)
+                if bus.name_has_owner(DBUS_SSSD_NAME):
+                    self._bus = bus
+                    return
+            except dbus.exceptions.DBusException:
+                pass
+            time.sleep(0.1)
+        raise RuntimeError("the stand-in infopipe did not start")
+
+    def calls(self):
+        """
+        Return the number of infopipe calls served so far
+        """
+        obj = self._bus.get_object(DBUS_SSSD_NAME, DBUS_SSSD_PATH, introspect=False)
+        return int(obj.Calls(dbus_interface=BENCH_IF))
+
+    def stop(self):
+        for process in reversed(self.processes):
+            process.terminate()
+            process.wait()
+        os.environ.pop("DBUS_SYSTEM_BUS_ADDRESS", None)
+
+
+def add_arguments(parser):
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--groups", type=int, default=50)
+    parser.add_argument("--max-group-size", type=int, default=500)
+    parser.add_argument("--skew", type=float, default=1.0)
+    parser.add_argument("--seed", type=int, default=0)
+
+
+def directory_options(args):
+    return {
+        "users": args.users,
+        "groups": args.groups,
+        "max_group_size": args.max_group_size,
+        "skew": args.skew,
+        "seed": args.seed,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--address", required=True)
+    add_arguments(parser)
+    args = parser.parse_args()
+    serve(args.address, Directory(**directory_options(args)))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,454 @@
+#
+# Copyright (C) 2023  FreeIPA Contributors see COPYING for license
+#
+
+"""
+Measure the write paths: SCIMUser and SCIMGroup save and delete through
+the IPA, LDAP and AD writable interfaces.
+
+The ldap and ad providers write to a throwaway slapd (see slapd.py), the
+ipa provider to a fake IPA JSON-RPC server running in this process (see
+fakeipa.py), through the IPAAPI writable interface with its transport
+replaced: neither an enrolled host nor Kerberos is needed. With --rtt,
+the directory is reached through a proxy adding that round trip time.
+
+The sequential and concurrent modes create, modify and delete users,
+the bulk mode creates groups with many members, adds and removes as
+many members and deletes the groups. Each phase reports its throughput,
+latency percentiles and the number of writes that did not reach the
+directory. Requires python-ldap, ipalib and slapd for the ldap and ad
+providers.
+
+    python src/benchmarks/ipa_write.py --users 500 --concurrency 8 \\
+        --rtt 20 --output results.json
+"""
+
+import argparse
+import http.client
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import urlsplit
+
+from common import LatencyProxy, report, setup_django, summary
+from fakeipa import FakeIPA
+from slapd import ROOT_DN, ROOT_PW, LocalSlapd
+
+PROVIDERS = ("ipa", "ldap", "ad")
+MODES = ("sequential", "concurrent", "bulk")
+
+
+def _fake_ipa_api():
+    """
+    Return an IPAAPI sending its commands as plain JSON-RPC requests to
+    the fake IPA server, one keep-alive connection per thread
+    """
+    from ipalib import errors
+    from ipatuura.ipa_writer import IPAAPI
+    from ipatuura.mapping import attribute_map
+
+    errors_by_code = {e.errno: e for e in errors.public_errors}
+
+    class FakeIPAAPI(IPAAPI):
+        def __init__(self, domain):
+            self._domain = domain
+            self._attribute_map = attribute_map(domain.user_extra_attrs, ipa_api=True)
+            self._address = urlsplit(domain.integration_domain_url)
+            self._local = threading.local()
+
+        def _ipa_connect(self):
+            pass
+
+        def _command(self, name, *args, **kwargs):
+            conn = getattr(self._local, "conn", None)
+            if conn is None:
+                conn = http.client.HTTPConnection(
+                    self._address.hostname, self._address.port
+                )
+                self._local.conn = conn
+            # as bytes, sent along with the headers
+            body = json.dumps(
+                {"method": f"{name}/1", "params": [list(args), kwargs], "id": 0}
+            ).encode("utf-8")
+            conn.request(
+                "POST",
+                "/ipa/session/json",
+                body,
+                {"Content-Type": "application/json"},
+            )
+            response = json.loads(conn.getresponse().read())
+            error = response["error"]
+            if error:
+                raise errors_by_code.get(error["code"], errors.PublicError)(
+                    message=error["message"]
+                )
+            return response["result"]
+
+    return FakeIPAAPI
+
+
+class _NamingAttributeMap:
+    """
+    Attribute map adding the uid naming attribute to the user entries
+    """
+
+    def __init__(self, attribute_map):
+        self._attribute_map = attribute_map
+
+    def __getattr__(self, name):
+        return getattr(self._attribute_map, name)
+
+    def entry(self, user):
+        return dict(self._attribute_map.entry(user), uid=user.username)
+
+
+def _openldap():
+    """
+    Return an LDAP writable interface for slapd, which requires the uid
+    naming attribute in the user entries
+    """
+    from ipatuura.ldap_writer import LDAP
+
+    class OpenLDAP(LDAP):
+        def _fetch_domain(self, domain):
+            super()._fetch_domain(domain)
+            self._attribute_map = _NamingAttributeMap(self._attribute_map)
+
+    return OpenLDAP
+
+
+class IPATarget:
+    """
+    Fake IPA server behind an optional latency proxy
+    """
+
+    provider = "ipa"
+
+    def __init__(self, rtt):
+        self.server = FakeIPA()
+        self.proxy = LatencyProxy(self.server.port, rtt / 2) if rtt else None
+
+    def start(self):
+        from ipatuura import ipa_writer
+
+        self.server.start()
+        if self.proxy:
+            self.proxy.start()
+        ipa_writer.IPAAPI = _fake_ipa_api()
+
+    @property
+    def url(self):
+        port = self.proxy.port if self.proxy else self.server.port
+        return f"http://127.0.0.1:{port}"
+
+    def domain(self):
+        return {"client_id": "admin", "client_secret": "Secret123"}
+
+    def users(self, prefix, givenname=None):
+        if givenname is None:
+            return self.server.directory.count_users(prefix)
+        return self.server.directory.count_users(prefix, givenname=givenname)
+
+    def members(self, prefix):
+        directory = self.server.directory
+        with directory.lock:
+            groups = [m for cn, m in directory.groups.items() if cn.startswith(prefix)]
+            return len(groups), sum(len(m) for m in groups)
+
+    def stop(self):
+        if self.proxy:
+            self.proxy.stop()
+        self.server.stop()
+
+
+class LDAPTarget:
+    """
+    slapd behind an optional latency proxy, shared by the ldap and ad
+    providers
+    """
+
+    # provider: (users base, groups base)
+    BASES = {"ldap": ("ou=people", "ou=groups"), "ad": ("cn=Users", "cn=Users")}
+
+    def __init__(self, slapd, provider, rtt):
+        self.slapd = slapd
+        self.provider = provider
+        self.proxy = LatencyProxy(slapd.port, rtt / 2) if rtt else None
+
+    def start(self):
+        from ipatuura import ldap_writer
+
+        if self.proxy:
+            self.proxy.start()
+        if self.provider == "ldap":
+            ldap_writer.LDAP = _openldap()
+
+    @property
+    def url(self):
+        port = self.proxy.port if self.proxy else self.slapd.port
+        return f"ldap://127.0.0.1:{port}"
+
+    def domain(self):
+        # the ad writable interface binds as client_id@name, not a DN
+        client_id = ROOT_DN if self.provider == "ldap" else "admin"
+        return {"client_id": client_id, "client_secret": ROOT_PW}
+
+    def users(self, prefix, givenname=None):
+        filterstr = f"(cn={prefix}*)"
+        if givenname is not None:
+            filterstr = f"(&{filterstr}(givenName={givenname}))"
+        return self.slapd.count(self.BASES[self.provider][0], filterstr)
+
+    def members(self, prefix):
+        import ldap
+
+        conn = self.slapd.connect()
+        try:
+            entries = conn.search_s(
+                f"{self.BASES[self.provider][1]},dc=bench,dc=test",
+                ldap.SCOPE_ONELEVEL,
+                f"(&(cn={prefix}*)(member=*))",
+                ["member"],
+            )
+        finally:
+            conn.unbind_s()
+        return len(entries), sum(len(attrs["member"]) for _, attrs in entries)
+
+    def stop(self):
+        if self.proxy:
+            self.proxy.stop()
+
+
+def use(target):
+    """
+    Make the integration domain of a target the only active one
+    """
+    from domains.models import Domain
+    from ipatuura.registry import Registry
+
+    Domain.objects.update(is_active=False)
+    Domain.objects.create(
+        name="bench.test",
+        integration_domain_url=target.url,
+        id_provider=target.provider,
+        ldap_tls_cacert="",
+        **target.domain(),
+    )
+    Registry().reset()
+
+
+def run(func, items, concurrency):
+    """
+    Call func on each item from concurrency threads
+
+    :returns: the throughput, latency summary and number of errors
+    """
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    pending = iter(items)
+
+    def worker():
+        local = []
+        failed = 0
+        while True:
+            with lock:
+                item = next(pending, None)
+            if item is None:
+                break
+            start = time.perf_counter()
+            try:
+                func(item)
+            except Exception:
+                failed += 1
+            local.append(time.perf_counter() - start)
+        with lock:
+            latencies.extend(local)
+            errors[0] += failed
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    return {
+        "errors": errors[0],
+        "per_second": round(len(items) / elapsed, 1),
+        "latency": summary(latencies),
+    }
+
+
+def user_phases(target, prefix, count, concurrency):
+    """
+    Create, modify and delete count users.
+
+    Some failed writes are only logged by the LDAP writable interfaces,
+    unapplied is the number of writes missing from the directory.
+    """
+    from django_scim.utils import get_user_adapter
+    from ipatuura.models import User
+
+    adapter = get_user_adapter()
+    names = [f"{prefix}{i}" for i in range(count)]
+    users = {}
+
+    def create(name):
+        user = User(
+            scim_username=name,
+            first_name="Bench",
+            last_name=name,
+            email=f"{name}@bench.test",
+        )
+        scim_user = adapter(user)
+        scim_user.save()
+        users[name] = scim_user
+
+    def modify(name):
+        scim_user = users[name]
+        scim_user.obj.first_name = "Modified"
+        scim_user.save()
+
+    def delete(name):
+        users[name].delete()
+
+    results = {}
+    results["create"] = run(create, names, concurrency)
+    results["create"]["unapplied"] = count - target.users(prefix)
+    results["modify"] = run(modify, names, concurrency)
+    results["modify"]["unapplied"] = count - target.users(prefix, "Modified")
+    results["delete"] = run(delete, names, concurrency)
+    results["delete"]["unapplied"] = target.users(prefix)
+    return results
+
+
+def group_phases(target, prefix, groups, size, concurrency):
+    """
+    Create groups with size members, add size more members, remove them
+    and delete the groups
+    """
+    from django_scim.utils import get_group_adapter
+    from ipatuura.models import Group, User
+
+    adapter = get_group_adapter()
+    names = [f"{prefix}{i}" for i in range(groups)]
+    first = [User(scim_username=f"{prefix}user{i}") for i in range(size)]
+    second = [User(scim_username=f"{prefix}user{size + i}") for i in range(size)]
+    scim_groups = {}
+
+    def create(name):
+        scim_group = adapter(Group())
+        scim_group.from_dict({"displayName": name})
+        scim_group.obj.user_set.set(first)
+        scim_group.save()
+        scim_groups[name] = scim_group
+
+    def add_members(name):
+        scim_group = scim_groups[name]
+        scim_group.obj.user_set.set(first + second)
+        scim_group.save()
+
+    def remove_members(name):
+        scim_group = scim_groups[name]
+        scim_group.obj.user_set.set(first)
+        scim_group.save()
+
+    def delete(name):
+        scim_groups[name].delete()
+
+    results = {}
+    results["group_add"] = run(create, names, concurrency)
+    results["group_add"]["unapplied"] = groups * size - target.members(prefix)[1]
+    results["add_members"] = run(add_members, names, concurrency)
+    results["add_members"]["unapplied"] = 2 * groups * size - target.members(prefix)[1]
+    results["remove_members"] = run(remove_members, names, concurrency)
+    results["remove_members"]["unapplied"] = target.members(prefix)[1] - groups * size
+    results["group_delete"] = run(delete, names, concurrency)
+    results["group_delete"]["unapplied"] = target.members(prefix)[0]
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--provider", action="append", choices=PROVIDERS)
+    parser.add_argument("--mode", action="append", choices=MODES)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--groups", type=int, default=4)
+    parser.add_argument(
+        "--bulk-size", type=int, default=2000, help="members added per bulk write"
+    )
+    parser.add_argument(
+        "--rtt", type=float, default=0, help="round trip time added, in ms"
+    )
+    parser.add_argument("--slapd", help="slapd binary")
+    parser.add_argument("--schema-dir", help="OpenLDAP schema directory")
+    parser.add_argument("--output", help="JSON results file, stdout by default")
+    args = parser.parse_args()
+    providers = args.provider or PROVIDERS
+    modes = args.mode or MODES
+    rtt = args.rtt / 1000
+
+    results = {
+        "setup": {
+            "users": args.users,
+            "concurrency": args.concurrency,
+            "groups": args.groups,
+            "bulk_size": args.bulk_size,
+            "rtt_ms": args.rtt,
+        },
+        "providers": {},
+    }
+    slapd = None
+    with tempfile.TemporaryDirectory() as path:
+        setup_django(os.path.join(path, "bench.sqlite3"))
+        # the writable interfaces log every write
+        logging.disable(logging.INFO)
+        if "ldap" in providers or "ad" in providers:
+            slapd = LocalSlapd(args.slapd, args.schema_dir)
+            slapd.start()
+        try:
+            for provider in providers:
+                if provider == "ipa":
+                    target = IPATarget(rtt)
+                else:
+                    target = LDAPTarget(slapd, provider, rtt)
+                target.start()
+                try:
+                    use(target)
+                    phases = {}
+                    for mode in modes:
+                        prefix = f"{provider}_{mode}_"
+                        if mode == "bulk":
+                            phases[mode] = group_phases(
+                                target,
+                                prefix,
+                                args.groups,
+                                args.bulk_size,
+                                min(args.groups, args.concurrency),
+                            )
+                        else:
+                            concurrency = (
+                                1 if mode == "sequential" else args.concurrency
+                            )
+                            phases[mode] = user_phases(
+                                target, prefix, args.users, concurrency
+                            )
+                    results["providers"][provider] = phases
+                finally:
+                    target.stop()
+        finally:
+            if slapd is not None:
+                slapd.stop()
+
+    report("ipa_write", results, args.output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,212 @@
+#
+# Copyright (C) 2023  FreeIPA Contributors see COPYING for license
+#
+
+"""
+Measure the serialization of the SCIM documents of directory users and
+groups.
+
+The users and groups are served by an in-memory stand-in of the SSSD
+infopipe, so that only the serialization is measured. Each document is
+serialized by the adapter path (a User per member and group, the
+django_scim adapters and the json module, still used by the filtered
+searches), by the fast path of the SCIM views with the json module and
+with orjson when it is installed, and streamed as for the large groups.
+The documents of all the paths are checked to be identical. Reports the
+latency, throughput and peak memory of each path, per group size.
+
+    python src/benchmarks/serialization.py --sizes 10,1000,10000 --output results.json
+"""
+
+import argparse
+import json
+import logging
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from common import report, setup_django, summary
+
+
+class Directory:
+    """
+    Stand-in for the SSSD interface, returning generated users and groups
+    """
+
+    def __init__(self, sizes, user_groups):
+        from ipatuura.sssd import SSSDGroup, SSSDUser
+
+        self.SSSDUser = SSSDUser
+        self.users = max(sizes + [user_groups])
+        self.groups = {}
+        for index, size in enumerate(sizes + [0] * user_groups):
+            group = SSSDGroup(200000 + index, f"group{index}")
+            group.set_members([f"user{i}" for i in range(size)])
+            self.groups[group.name] = group
+        self.user_groups = [f"group{len(sizes) + i}" for i in range(user_groups)]
+
+    def _user(self, index, retrieve_groups):
+        return self.SSSDUser(
+            100000 + index,
+            f"user{index}",
+            givenname="Bench",
+            sn=f"User{index}",
+            mail=f"user{index}@bench.test",
+            groups=self.user_groups if retrieve_groups else [],
+            active=True,
+        )
+
+    def find_user_by_name(self, name, retrieve_groups=False):
+        return self._user(int(name[4:]), retrieve_groups)
+
+    def find_user_by_id(self, id, retrieve_groups=False):
+        return self._user(int(id) - 100000, retrieve_groups)
+
+    def find_group_by_name(self, name, retrieve_members=False):
+        return self.groups[name]
+
+    def find_group_by_id(self, id, retrieve_members=False):
+        return self.groups[f"group{int(id) - 200000}"]
+
+
+def _measure(func, duration):
+    """
+    Call func repeatedly for about duration seconds, then once more to
+    record the peak memory it allocates
+    """
+    samples = []
+    deadline = time.perf_counter() + duration
+    while not samples or time.perf_counter() < deadline:
+        start = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - start)
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {
+        "latency": summary(samples),
+        "per_second": round(len(samples) / sum(samples), 1),
+        "peak_kb": round(peak / 1024, 1),
+    }
+
+
+def _paths(directory, request, group=None, user=None):
+    """
+    Return the functions serializing a group or a user by each path
+    """
+    from django_scim.utils import get_group_adapter, get_user_adapter
+    from ipatuura import serializers
+    from ipatuura.models import SSSDGroupToGroupModel, SSSDUserToUserModel
+
+    if group is not None:
+
+        def adapter():
+            model = SSSDGroupToGroupModel(directory, group)
+            d = get_group_adapter()(model, request=request).to_dict()
+            return json.dumps(d).encode("utf-8")
+
+        def document():
+            locations = serializers.Locations(request)
+            members = serializers.directory_members(directory, group.members)
+            return serializers.group_to_dict(group.id, group.name, members, locations)
+
+        def streamed():
+            locations = serializers.Locations(request)
+            members = serializers.directory_members(directory, group.members)
+            return b"".join(
+                serializers.iter_group_json(group.id, group.name, members, locations)
+            )
+
+    else:
+
+        def adapter():
+            model = SSSDUserToUserModel(directory, user)
+            d = get_user_adapter()(model, request=request).to_dict()
+            return json.dumps(d).encode("utf-8")
+
+        def document():
+            locations = serializers.Locations(request)
+            groups = serializers.directory_groups(directory, user.groups)
+            return serializers.user_to_dict(user, groups, locations)
+
+        streamed = None
+
+    orjson = serializers.orjson
+
+    def fast_json():
+        serializers.orjson = None
+        try:
+            return serializers.dumps(document())
+        finally:
+            serializers.orjson = orjson
+
+    paths = {"adapter": adapter, "fast_json": fast_json}
+    if orjson is not None:
+        paths["fast_orjson"] = lambda: serializers.dumps(document())
+    if streamed is not None:
+        paths["streamed"] = streamed
+    return paths
+
+
+def run(paths, duration):
+    expected = None
+    results = {}
+    for name, func in paths.items():
+        content = func()
+        if expected is None:
+            expected = json.loads(content)
+        elif json.loads(content) != expected:
+            raise RuntimeError(f"{name} serializes a different document")
+        results[name] = _measure(func, duration)
+        results[name]["bytes"] = len(content)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--sizes", default="10,1000,10000", help="comma-separated group sizes"
+    )
+    parser.add_argument(
+        "--user-groups", type=int, default=50, help="groups of the user measured"
+    )
+    parser.add_argument(
+        "--duration", type=float, default=2, help="seconds measured per path"
+    )
+    parser.add_argument("--output", help="JSON results file, stdout by default")
+    args = parser.parse_args()
+    sizes = [int(size) for size in args.sizes.split(",")]
+
+    setup_django(database=tempfile.mktemp(suffix=".sqlite3"))
+    logging.disable(logging.INFO)
+    from django.test import RequestFactory
+    from ipatuura import serializers
+
+    directory = Directory(sizes, args.user_groups)
+    request = RequestFactory().get("/scim/v2/Groups")
+
+    results = {
+        "setup": {
+            "sizes": sizes,
+            "user_groups": args.user_groups,
+            "orjson": serializers.orjson is not None,
+        },
+        "user": run(
+            _paths(directory, request, user=directory.find_user_by_id(100000, True)),
+            args.duration,
+        ),
+        "groups": {},
+    }
+    for index, size in enumerate(sizes):
+        group = directory.find_group_by_name(f"group{index}")
+        results["groups"][str(size)] = run(
+            _paths(directory, request, group=group), args.duration
+        )
+    report("serialization", results, args.output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,190 @@
+#
+# Copyright (C) 2023  FreeIPA Contributors see COPYING for license
+#
+
+"""
+Throwaway OpenLDAP server holding the entries of the LDAP and AD
+writable interfaces.
+
+The suffix has an ou=people and ou=groups tree for the ldap provider,
+and a cn=Users container for the ad provider. A minimal schema defines
+the AD user, group and container object classes. The AD writable
+interface binds with a user principal name, which is not a DN: its
+writes are anonymous, hence allowed.
+"""
+
+import glob
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
+import time
+
+from common import free_port
+
+SUFFIX = "dc=bench,dc=test"
+ROOT_DN = f"cn=admin,{SUFFIX}"
+ROOT_PW = "Secret123"
+
+SCHEMA_DIRS = ("/etc/openldap/schema", "/etc/ldap/schema")
+MODULE_DIRS = (
+    "/usr/lib64/openldap",
+    "/usr/lib/openldap",
+    "/usr/lib/ldap",
+    "/usr/lib/x86_64-linux-gnu/ldap",
+)
+
+AD_SCHEMA = """objectclass ( 1.2.840.113556.1.5.9 NAME 'user'
+    SUP organizationalPerson STRUCTURAL
+    MAY ( uid $ mail $ givenName ) )
+objectclass ( 1.2.840.113556.1.5.8 NAME 'group'
+    SUP top STRUCTURAL
+    MUST cn MAY member )
+objectclass ( 1.2.840.113556.1.3.23 NAME 'container'
+    SUP top STRUCTURAL
+    MUST cn )
+"""
+
+SLAPD_CONF = """include {schema}/core.schema
+include {schema}/cosine.schema
+include {schema}/inetorgperson.schema
+include {path}/ad.schema
+pidfile {path}/slapd.pid
+{modules}
+allow update_anon
+access to * by * write
+
+database mdb
+maxsize 1073741824
+suffix "{suffix}"
+rootdn "{root_dn}"
+rootpw {root_pw}
+directory {path}/data
+index objectClass eq
+index cn,uid eq
+"""
+
+
+def _find(dirs, pattern):
+    for path in dirs:
+        if glob.glob(os.path.join(path, pattern)):
+            return path
+    return None
+
+
+class LocalSlapd:
+    """
+    slapd listening on localhost, with its configuration and database
+    in a temporary directory
+    """
+
+    def __init__(self, slapd=None, schema_dir=None):
+        self.slapd = slapd or shutil.which("slapd") or "/usr/sbin/slapd"
+        self.schema_dir = schema_dir or _find(SCHEMA_DIRS, "core.schema")
+        self.path = tempfile.mkdtemp(prefix="ipatuura-slapd-")
+        self.port = free_port()
+        self.uri = f"ldap://127.0.0.1:{self.port}"
+        self.process = None
+
+    def _config(self):
+        # the backends are either built in or loadable modules
+        module_dir = _find(MODULE_DIRS, "back_mdb*")
+        modules = ""
+        if module_dir:
+            modules = f"modulepath {module_dir}\nmoduleload back_mdb"
+        return SLAPD_CONF.format(
+            schema=self.schema_dir,
+            path=self.path,
+            modules=modules,
+            suffix=SUFFIX,
+            root_dn=ROOT_DN,
+            root_pw=ROOT_PW,
+        )
+
+    def start(self):
+        if self.schema_dir is None:
+            raise RuntimeError("OpenLDAP schema directory not found")
+        os.mkdir(os.path.join(self.path, "data"))
+        with open(os.path.join(self.path, "ad.schema"), "w") as f:
+            f.write(AD_SCHEMA)
+        config = os.path.join(self.path, "slapd.conf")
+        with open(config, "w") as f:
+            f.write(self._config())
+        with open(os.path.join(self.path, "slapd.log"), "w") as log:
+            self.process = subprocess.Popen(
+                [self.slapd, "-d", "0", "-f", config, "-h", self.uri + "/"],
+                stdout=log,
+                stderr=subprocess.STDOUT,
+            )
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"slapd failed, see {self.path}/slapd.log")
+            try:
+                socket.create_connection(("127.0.0.1", self.port), 0.2).close()
+                break
+            except OSError:
+                time.sleep(0.1)
+        else:
+            raise RuntimeError("slapd did not start")
+        self._populate()
+
+    def connect(self):
+        import ldap
+
+        conn = ldap.initialize(self.uri)
+        conn.protocol_version = 3
+        conn.simple_bind_s(ROOT_DN, ROOT_PW)
+        return conn
+
+    def _populate(self):
+        import ldap.modlist as modlist
+
+        entries = [
+            (
+                SUFFIX,
+                {
+                    "objectClass": [b"dcObject", b"organization"],
+                    "dc": [b"bench"],
+                    "o": [b"bench"],
+                },
+            ),
+            (
+                f"ou=people,{SUFFIX}",
+                {"objectClass": [b"organizationalUnit"], "ou": [b"people"]},
+            ),
+            (
+                f"ou=groups,{SUFFIX}",
+                {"objectClass": [b"organizationalUnit"], "ou": [b"groups"]},
+            ),
+            (f"cn=Users,{SUFFIX}", {"objectClass": [b"container"], "cn": [b"Users"]}),
+        ]
+        conn = self.connect()
+        try:
+            for dn, attrs in entries:
+                conn.add_s(dn, modlist.addModlist(attrs))
+        finally:
+            conn.unbind_s()
+
+    def count(self, base, filterstr):
+        """
+        Return the number of entries right below base matching filterstr
+        """
+        import ldap
+
+        conn = self.connect()
+        try:
+            return len(
+                conn.search_s(
+                    f"{base},{SUFFIX}", ldap.SCOPE_ONELEVEL, filterstr, ["1.1"]
+                )
+            )
+        finally:
+            conn.unbind_s()
+
+    def stop(self):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.wait()
+        shutil.rmtree(self.path, ignore_errors=True)
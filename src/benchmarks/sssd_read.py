@@ -0,0 +1,200 @@
+#
+# Copyright (C) 2023  FreeIPA Contributors see COPYING for license
+#
+
+"""
+Measure the read paths against a stand-in SSSD infopipe: the _SSSD API
+and the SCIM endpoints.
+
+A private bus serving generated users and groups (see infopipe.py) is
+started and used as the system bus. Each scenario reports its throughput,
+latency percentiles and number of DBus calls per request. Requires
+dbus-daemon, dbus-python and PyGObject.
+
+    python src/benchmarks/sssd_read.py --users 100000 --groups 5000 \\
+        --max-group-size 2000 --requests 2000 --output results.json
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+from common import report, setup_django, summary
+from infopipe import FIRST_GID, FIRST_UID, PrivateBus, add_arguments, directory_options
+
+
+class Context:
+    """
+    State shared by the scenarios of a run
+    """
+
+    def __init__(self, args):
+        self.users = args.users
+        self.groups = args.groups
+        self._local = threading.local()
+
+    @property
+    def sssd(self):
+        from ipatuura.sssd import SSSD
+
+        return SSSD()
+
+    @property
+    def client(self):
+        client = getattr(self._local, "client", None)
+        if client is None:
+            from django.contrib.auth import get_user_model
+            from django.test import Client
+
+            client = Client()
+            client.force_login(get_user_model().objects.get(username="bench"))
+            self._local.client = client
+        return client
+
+
+def _scim_get(ctx, path, params=None):
+    response = ctx.client.get(path, params)
+    if response.status_code != 200:
+        raise RuntimeError(f"GET {path}: {response.status_code}")
+
+
+def sssd_user_by_name(ctx, rng):
+    ctx.sssd.find_user_by_name(f"user{rng.randrange(ctx.users)}", retrieve_groups=True)
+
+
+def sssd_user_by_id(ctx, rng):
+    ctx.sssd.find_user_by_id(FIRST_UID + rng.randrange(ctx.users), retrieve_groups=True)
+
+
+def sssd_user_groups(ctx, rng):
+    ctx.sssd.find_user_groups(f"user{rng.randrange(ctx.users)}")
+
+
+def sssd_group_members(ctx, rng):
+    ctx.sssd.find_group_by_name(
+        f"group{rng.randrange(ctx.groups)}", retrieve_members=True
+    )
+
+
+def scim_user_get(ctx, rng):
+    _scim_get(ctx, f"/scim/v2/Users/{FIRST_UID + rng.randrange(ctx.users)}")
+
+
+def scim_user_filter(ctx, rng):
+    name = f"user{rng.randrange(ctx.users)}"
+    _scim_get(ctx, "/scim/v2/Users", {"filter": f'userName eq "{name}"'})
+
+
+def scim_group_get(ctx, rng):
+    _scim_get(ctx, f"/scim/v2/Groups/{FIRST_GID + rng.randrange(ctx.groups)}")
+
+
+SCENARIOS = {
+    "sssd_user_by_name": sssd_user_by_name,
+    "sssd_user_by_id": sssd_user_by_id,
+    "sssd_user_groups": sssd_user_groups,
+    "sssd_group_members": sssd_group_members,
+    "scim_user_get": scim_user_get,
+    "scim_user_filter": scim_user_filter,
+    "scim_group_get": scim_group_get,
+}
+
+
+def run(ctx, scenario, requests, concurrency, seed):
+    """
+    Run requests calls of a scenario split over concurrency threads
+
+    :returns: the latencies in seconds, the number of errors and the
+              duration of the run
+    """
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+
+    def worker(index, count):
+        rng = random.Random(seed * 1000 + index)
+        local = []
+        failed = 0
+        for _ in range(count):
+            start = time.perf_counter()
+            try:
+                scenario(ctx, rng)
+            except Exception:
+                failed += 1
+            local.append(time.perf_counter() - start)
+        with lock:
+            latencies.extend(local)
+            errors[0] += failed
+
+    counts = [requests // concurrency] * concurrency
+    for i in range(requests % concurrency):
+        counts[i] += 1
+    threads = [
+        threading.Thread(target=worker, args=(i, count))
+        for i, count in enumerate(counts)
+    ]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, errors[0], time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    add_arguments(parser)
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--warmup", type=int, default=50)
+    parser.add_argument(
+        "--scenario",
+        action="append",
+        choices=sorted(SCENARIOS),
+        help="scenario to run, all by default",
+    )
+    parser.add_argument("--output", help="JSON results file, stdout by default")
+    args = parser.parse_args()
+
+    bus = PrivateBus(**directory_options(args))
+    bus.start()
+    try:
+        with tempfile.TemporaryDirectory() as path:
+            setup_django(os.path.join(path, "bench.sqlite3"))
+            from django.contrib.auth import get_user_model
+
+            get_user_model().objects.create_superuser("bench", password="bench")
+            ctx = Context(args)
+            results = {
+                "directory": directory_options(args),
+                "requests": args.requests,
+                "concurrency": args.concurrency,
+                "scenarios": {},
+            }
+            for name in args.scenario or SCENARIOS:
+                scenario = SCENARIOS[name]
+                run(ctx, scenario, args.warmup, args.concurrency, args.seed + 1)
+                calls = bus.calls()
+                latencies, errors, elapsed = run(
+                    ctx, scenario, args.requests, args.concurrency, args.seed
+                )
+                calls = bus.calls() - calls
+                results["scenarios"][name] = {
+                    "errors": errors,
+                    "per_second": round(args.requests / elapsed, 1),
+                    "latency": summary(latencies),
+                    "dbus_calls_per_request": round(calls / args.requests, 2),
+                }
+    finally:
+        bus.stop()
+
+    report("sssd_read", results, args.output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,135 @@
+#
+# Copyright (C) 2023  FreeIPA Contributors see COPYING for license
+#
+
+"""
+Measure the startup time and memory of a worker for each id provider.
+
+Each profile starts a fresh interpreter which sets up Django, loads the
+URLconf (and so the views) like a WSGI worker, then loads what the first
+request of the profile needs: the writable interface of a provider, or
+the provisioning code run by the domain jobs. The base profile loads
+nothing more, as a worker serving reads only. The startup time and
+maximum RSS are the medians of --repeat runs; one more run with
+-X importtime reports the slowest packages to import.
+
+    python src/benchmarks/startup.py --repeat 5 --output results.json
+"""
+
+import argparse
+import json
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import time
+
+PROFILES = ("base", "ipa", "ldap", "ad", "provisioning")
+
+
+def _child(profile):
+    """
+    Load a profile in this interpreter and print its measures as JSON
+    """
+    start = time.perf_counter()
+    from common import setup_django
+
+    setup_django()
+    from django.urls import get_resolver
+    from django.utils.module_loading import import_string
+
+    get_resolver().url_patterns
+    if profile == "provisioning":
+        import_string("domains.utils.add_domain_steps")
+    elif profile != "base":
+        from ipatuura.ipa import WRITERS
+
+        import_string(WRITERS[profile])
+    elapsed = time.perf_counter() - start
+    json.dump(
+        {
+            "seconds": elapsed,
+            # kilobytes on Linux
+            "rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            "modules": len(sys.modules),
+        },
+        sys.stdout,
+    )
+
+
+def _spawn(profile, importtime=False):
+    args = [sys.executable]
+    if importtime:
+        args += ["-X", "importtime"]
+    args += [os.path.abspath(__file__), "--child", profile]
+    proc = subprocess.run(args, capture_output=True, text=True)
+    if proc.returncode != 0:
+        raise RuntimeError(f"{profile}: {proc.stderr.strip().splitlines()[-1]}")
+    return json.loads(proc.stdout), proc.stderr
+
+
+def _packages(importtime, top):
+    """
+    Sum the self import time of the modules by top-level package
+
+    :param importtime: the -X importtime output
+    :returns: the top slowest packages, in milliseconds
+    """
+    packages = {}
+    for line in importtime.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        fields = line[len("import time:") :].split("|")
+        try:
+            self_us = int(fields[0])
+        except ValueError:
+            # header line
+            continue
+        package = fields[2].strip().split(".")[0]
+        packages[package] = packages.get(package, 0) + self_us
+    slowest = sorted(packages.items(), key=lambda item: item[1], reverse=True)
+    return {name: round(us / 1000, 1) for name, us in slowest[:top]}
+
+
+def run(profile, repeat, top):
+    runs = [_spawn(profile)[0] for _ in range(repeat)]
+    measures, importtime = _spawn(profile, importtime=True)
+    return {
+        "startup_ms": round(statistics.median(r["seconds"] for r in runs) * 1000, 1),
+        "rss_kb": statistics.median(r["rss_kb"] for r in runs),
+        "modules": measures["modules"],
+        "import_ms": _packages(importtime, top),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--top", type=int, default=10, help="slowest packages reported")
+    parser.add_argument(
+        "--profile", action="append", choices=PROFILES, help="default: all"
+    )
+    parser.add_argument("--child", choices=PROFILES, help=argparse.SUPPRESS)
+    parser.add_argument("--output", help="JSON results file, stdout by default")
+    args = parser.parse_args()
+
+    if args.child:
+        _child(args.child)
+        return 0
+
+    from common import report
+
+    results = {"setup": {"repeat": args.repeat}, "profiles": {}}
+    for profile in args.profile or PROFILES:
+        try:
+            results["profiles"][profile] = run(profile, args.repeat, args.top)
+        except RuntimeError as e:
+            # e.g. the FreeIPA client is not installed
+            sys.stderr.write(f"skipped {e}\n")
+    report("startup", results, args.output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,74 @@
+#
+# Copyright (C) 2023  FreeIPA Contributors see COPYING for license
+#
+
+"""
+Production profile of ipa-tuura served by gunicorn:
+
+    gunicorn -c src/conf/gunicorn.conf.py
+
+The application is loaded once by the master process and its workers
+are forked from it. Each worker opens its connections to the database,
+the SSSD infopipe and the integration domains before it accepts its
+first request. The profile is tuned from the environment, e.g.
+IPATUURA_WORKERS or IPATUURA_BIND.
+"""
+
+import glob
+import multiprocessing
+import os
+
+chdir = os.environ.get(
+    "IPATUURA_HOME",
+    os.path.normpath(
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "ipa-tuura")
+    ),
+)
+wsgi_app = "root.wsgi:application"
+
+bind = os.environ.get("IPATUURA_BIND", "127.0.0.1:8000").split(",")
+workers = int(os.environ.get("IPATUURA_WORKERS", multiprocessing.cpu_count() + 1))
+# more than one thread per worker selects the gthread worker class, each
+# thread then binds to the LDAP servers on its first write. The
+# long-polls of the change feed wait only in the gthread workers, see
+# IPATUURA_CHANGES_MAX_WAITERS
+threads = int(os.environ.get("IPATUURA_THREADS", 1))
+timeout = int(os.environ.get("IPATUURA_WORKER_TIMEOUT", 60))
+graceful_timeout = 30
+keepalive = 5
+# recycle the workers, bounds the growth of their caches
+max_requests = int(os.environ.get("IPATUURA_MAX_REQUESTS", 10000))
+max_requests_jitter = max_requests // 10
+
+preload_app = True
+
+accesslog = os.environ.get("IPATUURA_ACCESS_LOG", "-")
+loglevel = os.environ.get("IPATUURA_LOG_LEVEL", "info")
+proc_name = "ipa-tuura"
+
+
+def on_starting(server):
+    # the metrics of the workers of a previous run are obsolete
+    path = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+    if path:
+        for name in glob.glob(os.path.join(path, "*.db")):
+            os.unlink(name)
+
+
+def pre_fork(server, worker):
+    from ipatuura.prefork import before_fork
+
+    before_fork()
+
+
+def post_worker_init(worker):
+    # the singletons inherited from the master were dropped when forking
+    from ipatuura.prefork import warm_up
+
+    warm_up()
+
+
+def child_exit(server, worker):
+    from ipatuura.metrics import mark_process_dead
+
+    mark_process_dead(worker.pid)
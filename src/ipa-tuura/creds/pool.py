@@ -0,0 +1,197 @@
+#
+# Copyright (C) 2023  FreeIPA Contributors see COPYING for license
+#
+
+import bisect
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+from django.conf import settings
+from ipatuura.metrics import (
+    POOL_BUSY,
+    POOL_REJECTED,
+    POOL_SIZE,
+    POOL_WAIT_SECONDS,
+    POOL_WAITING,
+    VALIDATION_SECONDS,
+)
+
+logger = logging.getLogger(__name__)
+
+POOL_DEFAULTS = {
+    "WORKERS": 8,
+    "MAX_QUEUE": 64,
+    "TIMEOUT": 10,
+    "MAX_BATCH": 1000,
+}
+
+# Upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Result codes of the validations that did not reach PAM
+CODE_TIMEOUT = "timeout"
+CODE_OVERLOADED = "overloaded"
+
+
+class PoolOverloadedException(Exception):
+    """
+    Exception returned when too many validations are already queued.
+    """
+
+    pass
+
+
+class PoolTimeoutException(Exception):
+    """
+    Exception returned when a validation did not complete in time.
+    """
+
+    pass
+
+
+def _option(name):
+    return getattr(settings, "IPATUURA_PAM", {}).get(name, POOL_DEFAULTS[name])
+
+
+class _ValidationPool:
+    """
+    Bounded pool of threads running the credential validations, so that
+    slow PAM conversations or KDC exchanges do not hold the web workers.
+    """
+
+    _instance = None
+
+    def __init__(self):
+        self.workers = _option("WORKERS")
+        self.max_queue = _option("MAX_QUEUE")
+        self.timeout = _option("TIMEOUT")
+        self.max_batch = _option("MAX_BATCH")
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.workers, thread_name_prefix="creds"
+        )
+        # validations running or waiting for a worker
+        self._slots = threading.BoundedSemaphore(self.workers + self.max_queue)
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._wait = {
+            "buckets": [0] * (len(LATENCY_BUCKETS) + 1),
+            "count": 0,
+            "sum": 0.0,
+        }
+        POOL_SIZE.labels("pam").set(self.workers)
+
+    def _observe(self, code, elapsed):
+        with self._lock:
+            histogram = self._histograms.setdefault(
+                str(code),
+                {"buckets": [0] * (len(LATENCY_BUCKETS) + 1), "count": 0, "sum": 0.0},
+            )
+            histogram["buckets"][bisect.bisect_left(LATENCY_BUCKETS, elapsed)] += 1
+            histogram["count"] += 1
+            histogram["sum"] += elapsed
+        VALIDATION_SECONDS.labels(str(code)).observe(elapsed)
+
+    def _run(self, func, args, queued):
+        waited = time.monotonic() - queued
+        with self._lock:
+            self._wait["buckets"][bisect.bisect_left(LATENCY_BUCKETS, waited)] += 1
+            self._wait["count"] += 1
+            self._wait["sum"] += waited
+        POOL_WAIT_SECONDS.labels("pam").observe(waited)
+        POOL_WAITING.labels("pam").dec()
+        POOL_BUSY.labels("pam").inc()
+        try:
+            return func(*args)
+        finally:
+            POOL_BUSY.labels("pam").dec()
+            self._slots.release()
+
+    def try_submit(self, func, *args):
+        """
+        Queue a validation if the queue is not full.
+
+        :returns: a Future of the (validated, reason, code) tuple, or None
+        """
+        if not self._slots.acquire(blocking=False):
+            return None
+        POOL_WAITING.labels("pam").inc()
+        try:
+            return self._executor.submit(self._run, func, args, time.monotonic())
+        except Exception:
+            POOL_WAITING.labels("pam").dec()
+            self._slots.release()
+            raise
+
+    def submit(self, func, *args):
+        """
+        Queue a validation.
+
+        :returns: a Future of the (validated, reason, code) tuple
+        :raises PoolOverloadedException: if the queue is full
+        """
+        future = self.try_submit(func, *args)
+        if future is None:
+            self._observe(CODE_OVERLOADED, 0)
+            POOL_REJECTED.labels("pam", "overloaded").inc()
+            raise PoolOverloadedException("Too many credential validations queued")
+        return future
+
+    def result(self, future, start):
+        """
+        Wait for a queued validation, at most TIMEOUT seconds after start.
+
+        :returns: the (validated, reason, code) tuple
+        :raises PoolTimeoutException: if the validation did not complete
+        """
+        try:
+            res = future.result(max(0, start + self.timeout - time.monotonic()))
+        except FutureTimeoutError:
+            self._observe(CODE_TIMEOUT, time.monotonic() - start)
+            POOL_REJECTED.labels("pam", "timeout").inc()
+            raise PoolTimeoutException("Credential validation timed out")
+        self._observe(res[2], time.monotonic() - start)
+        return res
+
+    def validate(self, func, *args):
+        """
+        Run a validation in the pool and wait for its result.
+        """
+        start = time.monotonic()
+        return self.result(self.submit(func, *args), start)
+
+    def stats(self):
+        """
+        Return the latency histograms per result code: the counts per
+        bucket of LATENCY_BUCKETS (plus one for the larger latencies),
+        the number of validations and their total duration.
+        """
+        with self._lock:
+            return {
+                code: {
+                    "buckets": list(h["buckets"]),
+                    "count": h["count"],
+                    "sum": h["sum"],
+                }
+                for code, h in self._histograms.items()
+            }
+
+    def wait_stats(self):
+        """
+        Return the histogram of the time the validations waited for a
+        worker thread, with the same buckets as stats().
+        """
+        with self._lock:
+            return {
+                "buckets": list(self._wait["buckets"]),
+                "count": self._wait["count"],
+                "sum": self._wait["sum"],
+            }
+
+
+def ValidationPool():
+    if _ValidationPool._instance is None:
+        _ValidationPool._instance = _ValidationPool()
+    return _ValidationPool._instance
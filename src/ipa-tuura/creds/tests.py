@@ -0,0 +1,237 @@
+#
+# Copyright (C) 2023  FreeIPA Contributors see COPYING for license
+#
+
+import json
+import socket
+import sys
+import tempfile
+import threading
+from unittest import mock
+
+from creds import validators, views
+from creds.pool import CODE_OVERLOADED, CODE_TIMEOUT, _ValidationPool
+from django.conf import settings
+from django.middleware.csrf import CsrfViewMiddleware, get_token
+from django.test import RequestFactory, TestCase
+from domains.models import Domain
+from ipatuura.registry import Registry
+
+
+class GSSError(Exception):
+    min_code = 0
+
+
+class AuthenticatorTest(TestCase):
+    def setUp(self):
+        Registry().reset()
+        self.addCleanup(Registry().reset)
+        self.domain = Domain.objects.create(
+            name="example.test",
+            realm="IPA.EXAMPLE.TEST",
+            integration_domain_url="https://ipa.example.test",
+            client_id="admin",
+            client_secret="Secret123",
+            id_provider="ipa",
+            password_validation=Domain.PasswordValidation.KERBEROS,
+        )
+        keytab = tempfile.NamedTemporaryFile()
+        self.addCleanup(keytab.close)
+        self.keytab = keytab.name
+
+    def validate(self, username):
+        with self.settings(IPATUURA_KERBEROS_KEYTAB=self.keytab):
+            validate = validators.authenticator(username)
+        with mock.patch.object(validators, "kerberos_authenticate") as kerberos:
+            validate(username, "Secret123")
+        return kerberos
+
+    def test_pam_by_default(self):
+        self.domain.password_validation = Domain.PasswordValidation.PAM
+        self.domain.save()
+        self.assertIs(validators.authenticator("alice"), validators.pam_authenticate)
+
+    def test_configured_realm(self):
+        kerberos = self.validate("alice")
+        kerberos.assert_called_once_with(
+            "alice@IPA.EXAMPLE.TEST",
+            "Secret123",
+            f"host/{socket.gethostname()}@IPA.EXAMPLE.TEST",
+            self.keytab,
+        )
+
+    def test_qualified_with_domain_or_realm(self):
+        for username in ("alice@example.test", "alice@IPA.EXAMPLE.TEST"):
+            kerberos = self.validate(username)
+            self.assertEqual(kerberos.call_args.args[0], "alice@IPA.EXAMPLE.TEST")
+
+    def test_unknown_qualifier_to_pam(self):
+        self.assertIs(
+            validators.authenticator("alice@trusted.test"),
+            validators.pam_authenticate,
+        )
+
+    def test_refused_without_keytab(self):
+        with self.settings(IPATUURA_KERBEROS_KEYTAB="/nonexistent/krb5.keytab"):
+            with self.assertLogs("creds.validators", "ERROR"):
+                validate = validators.authenticator("alice")
+        self.assertEqual(
+            validate("alice", "Secret123"),
+            (
+                False,
+                validators.PAM_REASONS[validators.PAM_AUTHINFO_UNAVAIL],
+                validators.PAM_AUTHINFO_UNAVAIL,
+            ),
+        )
+
+
+class KerberosAuthenticateTest(TestCase):
+    def setUp(self):
+        self.gssapi = mock.MagicMock()
+        self.gssapi.raw.misc.GSSError = GSSError
+        patcher = mock.patch.dict(sys.modules, {"gssapi": self.gssapi})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def authenticate(self):
+        return validators.kerberos_authenticate(
+            "alice@EXAMPLE.TEST",
+            "Secret123",
+            "host/tuura.example.test@EXAMPLE.TEST",
+            "/etc/krb5.keytab",
+        )
+
+    def test_ticket_verified(self):
+        res, reason, code = self.authenticate()
+        self.assertTrue(res)
+        # the service ticket is accepted with the host keytab
+        self.gssapi.Credentials.assert_called_with(
+            name=self.gssapi.Name.return_value,
+            usage="accept",
+            store={"keytab": "/etc/krb5.keytab"},
+        )
+        # the initiator token is stepped into the acceptor context
+        step = self.gssapi.SecurityContext.return_value.step
+        self.assertEqual(
+            step.call_args_list, [mock.call(), mock.call(step.return_value)]
+        )
+
+    def test_spoofed_kdc(self):
+        # the key of the host principal does not decrypt the ticket
+        self.gssapi.SecurityContext.return_value.step.side_effect = [
+            b"token",
+            GSSError("Decrypt integrity check failed"),
+        ]
+        with self.assertLogs("creds.validators", "ERROR"):
+            res, reason, code = self.authenticate()
+        self.assertFalse(res)
+        self.assertEqual(code, validators.PAM_AUTH_ERR)
+
+    def test_bad_password(self):
+        error = GSSError("Preauthentication failed")
+        error.min_code = validators.KRB5KDC_ERR_PREAUTH_FAILED
+        self.gssapi.raw.acquire_cred_with_password.side_effect = error
+
+        res, reason, code = self.authenticate()
+        self.assertFalse(res)
+        self.assertEqual(code, validators.PAM_AUTH_ERR)
+        self.gssapi.SecurityContext.assert_not_called()
+
+
+class ValidateBatchTest(TestCase):
+    def pool(self, **options):
+        with self.settings(IPATUURA_PAM=options):
+            pool = _ValidationPool()
+        self.addCleanup(pool._executor.shutdown)
+        return pool
+
+    def validate(self, pool, credentials, validate):
+        with mock.patch.object(views, "authenticator", return_value=validate):
+            results = [
+                json.loads(line) for line in views.validate_batch(pool, credentials)
+            ]
+        return sorted(results, key=lambda result: result["index"])
+
+    def blocked(self):
+        """
+        Return a validation blocked until the test ends
+        """
+        release = threading.Event()
+        self.addCleanup(release.set)
+
+        def validate(username, password):
+            release.wait(5)
+            return (True, "Success", 0)
+
+        return validate
+
+    def test_results(self):
+        def validate(username, password):
+            if password == "Secret123":
+                return (True, "Success", 0)
+            return (False, "Authentication failure", 7)
+
+        # more pairs than the pool holds, they wait for each other
+        pool = self.pool(WORKERS=1, MAX_QUEUE=0)
+        credentials = [
+            {"username": "alice", "password": "Secret123"},
+            {"username": "bob", "password": "wrong"},
+            {"username": "carol"},
+            {"username": "dave", "password": "Secret123"},
+        ]
+        results = self.validate(pool, credentials, validate)
+
+        self.assertEqual(
+            [r["username"] for r in results], ["alice", "bob", "carol", "dave"]
+        )
+        self.assertEqual(
+            [r["result"] and r["result"]["validated"] for r in results],
+            [True, False, None, True],
+        )
+        self.assertEqual(
+            results[2]["error"], {"message": "username and password required"}
+        )
+
+    def test_overloaded(self):
+        pool = self.pool(WORKERS=1, MAX_QUEUE=0)
+        pool.submit(self.blocked(), "bob", "Secret123")
+
+        credentials = [{"username": "alice", "password": "Secret123"}]
+        (result,) = self.validate(pool, credentials, validators.pam_authenticate)
+        self.assertEqual(result["error"]["code"], CODE_OVERLOADED)
+
+    def test_timeout(self):
+        pool = self.pool(WORKERS=2, MAX_QUEUE=0, TIMEOUT=0.05)
+
+        credentials = [{"username": "alice", "password": "Secret123"}]
+        (result,) = self.validate(pool, credentials, self.blocked())
+        self.assertEqual(result["error"]["code"], CODE_TIMEOUT)
+        self.assertIsNone(result["result"])
+
+
+class BatchValidationViewTest(TestCase):
+    def csrf_check(self, **headers):
+        """
+        Return the response of the CSRF check of a request from a browser
+        holding a session with a CSRF cookie
+        """
+        session = RequestFactory().get("/creds/simple_pwd")
+        token = get_token(session)
+        request = RequestFactory().post(
+            "/creds/validate",
+            data="{}",
+            content_type="application/json",
+            **{k: v.format(token=token) for k, v in headers.items()},
+        )
+        request.COOKIES[settings.CSRF_COOKIE_NAME] = session.META["CSRF_COOKIE"]
+        middleware = CsrfViewMiddleware(lambda request: None)
+        return middleware.process_view(
+            request, views.BatchValidationView.as_view(), (), {}
+        )
+
+    def test_csrf_token_required(self):
+        # e.g. a form of another site posted with the session cookie
+        self.assertEqual(self.csrf_check().status_code, 403)
+
+    def test_csrf_token(self):
+        self.assertIsNone(self.csrf_check(HTTP_X_CSRFTOKEN="{token}"))
@@ -7,4 +7,5 @@ from django.urls import path
 
 urlpatterns = [
     path("simple_pwd", views.SimplePwdView.as_view(), name="simple_pwd"),
+    path("validate", views.BatchValidationView.as_view(), name="validate"),
 ]
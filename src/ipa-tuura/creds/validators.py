@@ -0,0 +1,171 @@
+#
+# Copyright (C) 2023  FreeIPA Contributors see COPYING for license
+#
+
+import logging
+import os
+import socket
+
+import pam
+from django.conf import settings
+from domains.models import Domain
+from ipatuura.registry import Registry
+
+logger = logging.getLogger(__name__)
+
+# PAM result codes, the Kerberos validations report the same codes
+PAM_SUCCESS = 0
+PAM_AUTH_ERR = 7
+PAM_AUTHINFO_UNAVAIL = 9
+PAM_USER_UNKNOWN = 10
+PAM_NEW_AUTHTOK_REQD = 12
+PAM_ACCT_EXPIRED = 13
+
+# krb5 error codes (minor status) of the failed AS exchanges
+KRB5KDC_ERR_C_PRINCIPAL_UNKNOWN = -1765328378
+KRB5KDC_ERR_CLIENT_REVOKED = -1765328366
+KRB5KDC_ERR_KEY_EXP = -1765328361
+KRB5KDC_ERR_PREAUTH_FAILED = -1765328360
+KRB5KRB_AP_ERR_BAD_INTEGRITY = -1765328353
+KRB5_KDC_UNREACH = -1765328228
+KRB5_REALM_CANT_RESOLVE = -1765328164
+
+KRB5_PAM_CODES = {
+    KRB5KDC_ERR_C_PRINCIPAL_UNKNOWN: PAM_USER_UNKNOWN,
+    KRB5KDC_ERR_CLIENT_REVOKED: PAM_ACCT_EXPIRED,
+    KRB5KDC_ERR_KEY_EXP: PAM_NEW_AUTHTOK_REQD,
+    KRB5KDC_ERR_PREAUTH_FAILED: PAM_AUTH_ERR,
+    KRB5KRB_AP_ERR_BAD_INTEGRITY: PAM_AUTH_ERR,
+    KRB5_KDC_UNREACH: PAM_AUTHINFO_UNAVAIL,
+    KRB5_REALM_CANT_RESOLVE: PAM_AUTHINFO_UNAVAIL,
+}
+
+PAM_REASONS = {
+    PAM_SUCCESS: "Success",
+    PAM_AUTH_ERR: "Authentication failure",
+    PAM_AUTHINFO_UNAVAIL: "Authentication service cannot retrieve authentication info",
+    PAM_USER_UNKNOWN: "User not known to the underlying authentication module",
+    PAM_NEW_AUTHTOK_REQD: "Authentication token is no longer valid; new one required",
+    PAM_ACCT_EXPIRED: "User account has expired",
+}
+
+# Providers with a KDC the credentials can be validated against
+KERBEROS_PROVIDERS = (Domain.DomainProviderType.IPA, Domain.DomainProviderType.AD)
+
+# Keytab of the host principal the tickets are verified with
+DEFAULT_KEYTAB = "/etc/krb5.keytab"
+
+
+def pam_authenticate(username, password):
+    """
+    Validate credentials through the PAM stack
+
+    :returns: a (validated, reason, code) tuple
+    """
+    p = pam.PamAuthenticator()
+    res = p.authenticate(username, password)
+    return res, p.reason, p.code
+
+
+def kerberos_principal(username, realm):
+    """
+    Return the principal of a user name, qualified or not, in a realm
+    """
+    return "%s@%s" % (username.rsplit("@", 1)[0], realm)
+
+
+def kerberos_authenticate(principal, password, service, keytab):
+    """
+    Validate credentials with a Kerberos AS exchange
+
+    The initial credentials are acquired into a memory ccache that is
+    discarded with the credentials object, nothing is written to disk.
+    The ticket granting ticket is then verified as krb5_verify_init_creds()
+    does: a ticket for the host principal is requested with it and
+    accepted with the key of the host keytab, which a spoofed KDC does
+    not know. Only the KDC checks apply: the PAM account stack (HBAC
+    rules, access control of SSSD) is not evaluated.
+
+    :param principal: user principal, user@REALM
+    :param service: host principal, host/hostname@REALM
+    :param keytab: path of the keytab holding the key of the host principal
+    :returns: a (validated, reason, code) tuple, with the PAM code
+              matching the Kerberos error
+    """
+    import gssapi
+
+    name = gssapi.Name(principal, gssapi.NameType.kerberos_principal)
+    try:
+        result = gssapi.raw.acquire_cred_with_password(
+            name, password.encode("utf-8"), usage="initiate"
+        )
+        # the AS exchange happened while acquiring the credentials
+        creds = gssapi.Credentials(result.creds)
+        creds.lifetime
+    except gssapi.raw.misc.GSSError as e:
+        code = KRB5_PAM_CODES.get(e.min_code, PAM_AUTH_ERR)
+        logger.debug(f"kerberos validation of {principal}: {e}")
+        return False, PAM_REASONS[code], code
+
+    target = gssapi.Name(service, gssapi.NameType.kerberos_principal)
+    try:
+        acceptor = gssapi.Credentials(
+            name=target, usage="accept", store={"keytab": keytab}
+        )
+        initiator_ctx = gssapi.SecurityContext(
+            name=target, creds=creds, usage="initiate"
+        )
+        acceptor_ctx = gssapi.SecurityContext(creds=acceptor, usage="accept")
+        acceptor_ctx.step(initiator_ctx.step())
+    except gssapi.raw.misc.GSSError as e:
+        logger.error(f"kerberos validation of {principal}: {service} not verified: {e}")
+        return False, PAM_REASONS[PAM_AUTH_ERR], PAM_AUTH_ERR
+    return True, PAM_REASONS[PAM_SUCCESS], PAM_SUCCESS
+
+
+def _unavailable(username, password):
+    return False, PAM_REASONS[PAM_AUTHINFO_UNAVAIL], PAM_AUTHINFO_UNAVAIL
+
+
+def authenticator(username):
+    """
+    Select the validation of a user's credentials, as configured on
+    the integration domain of the user.
+
+    A name qualified with a domain that is not integrated (a trusted
+    domain for instance) is validated through the PAM stack.
+
+    :param username: a user name, qualified or not
+    :returns: a function called with (username, password) and returning
+              a (validated, reason, code) tuple
+    """
+    try:
+        domain = Registry().route(username)
+    except Domain.DoesNotExist:
+        return pam_authenticate
+    if domain.password_validation != Domain.PasswordValidation.KERBEROS:
+        return pam_authenticate
+    if domain.id_provider not in KERBEROS_PROVIDERS:
+        logger.debug(f"kerberos validation not supported by {domain.name}, using PAM")
+        return pam_authenticate
+    if "@" in username:
+        # the names of other domains are routed to the default domain
+        suffix = username.rsplit("@", 1)[1].lower()
+        if suffix not in (domain.name.lower(), domain.realm.lower()):
+            return pam_authenticate
+
+    realm = domain.realm
+    keytab = getattr(settings, "IPATUURA_KERBEROS_KEYTAB", DEFAULT_KEYTAB)
+    if not os.access(keytab, os.R_OK):
+        # the tickets can not be verified, the KDC could be spoofed
+        logger.error(
+            f"kerberos validation refused for {domain.name}: no keytab {keytab}"
+        )
+        return _unavailable
+    service = "host/%s@%s" % (socket.gethostname(), realm)
+
+    def validate(username, password):
+        principal = kerberos_principal(username, realm)
+        return kerberos_authenticate(principal, password, service, keytab)
+
+    return validate
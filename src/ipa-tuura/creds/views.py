@@ -4,14 +4,25 @@
 
 import json
 import logging
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, wait
 
-import pam
 from creds import forms
+from creds.pool import (
+    CODE_OVERLOADED,
+    CODE_TIMEOUT,
+    PoolOverloadedException,
+    PoolTimeoutException,
+    ValidationPool,
+)
+from creds.validators import authenticator
 from django.contrib.auth.mixins import LoginRequiredMixin
-from django.http import HttpResponse
+from django.http import HttpResponse, StreamingHttpResponse
 from django.shortcuts import render
 from django.utils.html import escape
 from django.views import View
+from ipatuura.admission import retry_after
 
 logger = logging.getLogger(__name__)
 
@@ -28,18 +39,35 @@ class SimplePwdView(LoginRequiredMixin, View):
 
     def post(self, request):
         """
-        Validation of user credentials using PAM stack.
+        Validation of user credentials using PAM stack, or a Kerberos
+        AS exchange for the domains configured so.
+
+        The validation runs in the validation pool, the request
+        fails with 503 when the pool is overloaded and 504 on timeout.
         """
         form = forms.PwdValidationForm(request.POST)
+        status = 200
+        headers = None
         if form.is_valid():
             username = escape(form.cleaned_data["username"])
             password = escape(form.cleaned_data["password"])
             logger.debug("cred validation: validating user %s", username)
-            p = pam.PamAuthenticator()
-            res = p.authenticate(username, password)
-            answer = {"validated": res, "reason": p.reason, "code": p.code}
-            error = None
-            logger.debug("cred validation: result %s reason %s", res, p.reason)
+            answer = None
+            try:
+                res, reason, code = ValidationPool().validate(
+                    authenticator(username), username, password
+                )
+            except PoolOverloadedException as e:
+                error = {"message": str(e)}
+                status = 503
+                headers = {"Retry-After": str(retry_after())}
+            except PoolTimeoutException as e:
+                error = {"message": str(e)}
+                status = 504
+            else:
+                answer = {"validated": res, "reason": reason, "code": code}
+                error = None
+                logger.debug("cred validation: result %s reason %s", res, reason)
         else:
             answer = None
             error = {"message": form.errors}
@@ -49,4 +77,134 @@ class SimplePwdView(LoginRequiredMixin, View):
             "error": error,
             "result": answer,
         }
-        return HttpResponse(content=json.dumps(result), content_type="application/json")
+        return HttpResponse(
+            content=json.dumps(result),
+            content_type="application/json",
+            status=status,
+            headers=headers,
+        )
+
+
+def _json_error(message, status):
+    return HttpResponse(
+        content=json.dumps({"error": {"message": message}}),
+        content_type="application/json",
+        status=status,
+    )
+
+
+def _entry_result(index, username, answer=None, error=None):
+    result = {"index": index, "username": username, "error": error, "result": answer}
+    return json.dumps(result) + "\n"
+
+
+def validate_batch(pool, credentials):
+    """
+    Validate credential pairs concurrently through the validation pool.
+
+    The pairs are queued as long as the pool accepts them, the others
+    wait for a validation of the batch to complete. A pair is only
+    reported as overloaded when the pool has no room and the batch
+    has no validation running.
+
+    :param pool: the ValidationPool
+    :param credentials: list of {"username", "password"} dicts
+    :returns: a generator of the JSON lines of the results, in
+              completion order
+    """
+    pending = deque(enumerate(credentials))
+    running = {}
+
+    while pending or running:
+        while pending:
+            index, entry = pending[0]
+            username = entry.get("username")
+            password = entry.get("password")
+            if not isinstance(username, str) or not isinstance(password, str):
+                pending.popleft()
+                yield _entry_result(
+                    index, username, error={"message": "username and password required"}
+                )
+                continue
+            validate = authenticator(username)
+            future = pool.try_submit(validate, username, password)
+            if future is None and running:
+                # wait for a validation of the batch to complete
+                break
+            try:
+                if future is None:
+                    future = pool.submit(validate, username, password)
+            except PoolOverloadedException as e:
+                pending.popleft()
+                yield _entry_result(
+                    index, username, error={"message": str(e), "code": CODE_OVERLOADED}
+                )
+                continue
+            pending.popleft()
+            running[future] = (index, username, time.monotonic())
+
+        if not running:
+            continue
+        deadline = min(start for _, _, start in running.values()) + pool.timeout
+        wait(
+            list(running),
+            timeout=max(0, deadline - time.monotonic()),
+            return_when=FIRST_COMPLETED,
+        )
+        now = time.monotonic()
+        for future, (index, username, start) in list(running.items()):
+            if not future.done() and now < start + pool.timeout:
+                continue
+            del running[future]
+            try:
+                res, reason, code = pool.result(future, start)
+            except PoolTimeoutException as e:
+                yield _entry_result(
+                    index, username, error={"message": str(e), "code": CODE_TIMEOUT}
+                )
+            else:
+                yield _entry_result(
+                    index,
+                    username,
+                    answer={"validated": res, "reason": reason, "code": code},
+                )
+
+
+class BatchValidationView(View):
+    """
+    View for the validation of many username and password pairs at once.
+
+    The request body is a JSON object {"credentials": [{"username": ...,
+    "password": ...}, ...]}, the results are streamed back as one JSON
+    object per line as soon as each validation completes.
+
+    Like the simple_pwd form, the requests carry the CSRF token of the
+    session: a page of another site cannot use the session of a browser
+    to guess passwords.
+    """
+
+    http_method_names = ["post"]
+
+    def dispatch(self, request, *args, **kwargs):
+        if not request.user.is_authenticated:
+            return _json_error("Authentication required", 401)
+        return super().dispatch(request, *args, **kwargs)
+
+    def post(self, request):
+        try:
+            body = json.loads(request.body)
+            credentials = body["credentials"]
+        except (ValueError, TypeError, KeyError):
+            return _json_error("Expected a JSON object with a credentials list", 400)
+        if not isinstance(credentials, list) or not all(
+            isinstance(entry, dict) for entry in credentials
+        ):
+            return _json_error("credentials must be a list of objects", 400)
+
+        pool = ValidationPool()
+        if len(credentials) > pool.max_batch:
+            return _json_error(f"At most {pool.max_batch} credentials per request", 413)
+        logger.debug("cred validation: validating %d users", len(credentials))
+        return StreamingHttpResponse(
+            validate_batch(pool, credentials), content_type="application/x-ndjson"
+        )
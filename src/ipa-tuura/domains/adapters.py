@@ -4,7 +4,7 @@
 
 import logging
 
-from domains.models import Domain
+from domains.models import Domain, DomainJob
 from rest_framework.serializers import ModelSerializer
 
 logger = logging.getLogger(__name__)
@@ -16,13 +16,33 @@ class DomainSerializer(ModelSerializer):
         fields = (
             "id",
             "name",
+            "realm",
             "description",
+            "is_active",
             "integration_domain_url",
             "client_id",
             "client_secret",
             "id_provider",
+            "password_validation",
             "user_extra_attrs",
             "user_object_classes",
             "users_dn",
+            "groups_dn",
             "ldap_tls_cacert",
         )
+
+
+class DomainJobSerializer(ModelSerializer):
+    class Meta:
+        model = DomainJob
+        fields = (
+            "id",
+            "domain",
+            "operation",
+            "status",
+            "steps",
+            "error",
+            "created",
+            "updated",
+        )
+        read_only_fields = fields
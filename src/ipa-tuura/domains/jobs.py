@@ -0,0 +1,323 @@
+#
+# Copyright (C) 2023  FreeIPA Contributors see COPYING for license
+#
+
+import contextvars
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import Q
+from django.utils import timezone
+from domains.models import Domain, DomainJob
+from ipatuura.outbox import worker_id
+
+logger = logging.getLogger(__name__)
+
+STEP_DONE = "done"
+STEP_FAILED = "failed"
+
+# Domain fields not persisted in the payload of the jobs, the steps read
+# them from the domain of the job
+SECRET_FIELDS = ("client_secret",)
+
+
+# Log handler of the step running in the current context, the helper
+# threads of a step run in a copy of its context
+_step_log = contextvars.ContextVar("domain_job_step_log", default=None)
+
+
+class _StepLogHandler(logging.Handler):
+    """
+    Collect the log records emitted by a step, in the thread running it
+    or in the helper threads it runs in its context
+    """
+
+    def __init__(self):
+        super().__init__(logging.INFO)
+        self.lines = []
+        self.setFormatter(logging.Formatter("%(levelname)s %(name)s: %(message)s"))
+
+    def emit(self, record):
+        if _step_log.get() is self:
+            self.lines.append(self.format(record))
+
+
+class _Scheduler:
+    """
+    Run the jobs in the background of the worker process. Provisioning
+    changes host-wide configuration (IPA enrollment, sssd.conf), the jobs
+    are therefore run one at a time.
+
+    The pending jobs are swept every IPATUURA_DOMAIN_JOB_SWEEP seconds:
+    the jobs of a worker process that stopped before running them, or
+    held back by the job of another process.
+    """
+
+    _instance = None
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="domain-job"
+        )
+        self._thread = threading.Thread(
+            target=self._run, name="domain-job-sweep", daemon=True
+        )
+        self._thread.start()
+
+    def submit(self, job_id):
+        self._executor.submit(run, job_id)
+
+    def sweep(self):
+        """
+        Submit the oldest pending job, unless a job is running
+        """
+        close_old_connections()
+        try:
+            pending = _next_pending()
+        except Exception as e:
+            logger.error(f"domain jobs: unable to sweep the pending jobs: {e}")
+            pending = None
+        close_old_connections()
+        if pending is not None:
+            logger.info(f"domain job {pending}: picked up by the sweep")
+            self.submit(pending)
+
+    def _run(self):
+        while True:
+            self.sweep()
+            time.sleep(getattr(settings, "IPATUURA_DOMAIN_JOB_SWEEP", 60))
+
+
+def Scheduler():
+    # the threads do not survive a fork
+    if _Scheduler._instance is None or _Scheduler._instance.pid != os.getpid():
+        _Scheduler._instance = _Scheduler()
+    return _Scheduler._instance
+
+
+def submit(operation, payload, domain=None):
+    """
+    Create a provisioning job and schedule it in the background.
+
+    :param operation: one of DomainJob.Operation
+    :param payload: integration domain configuration, its secrets are
+                    not persisted
+    :param domain: Domain object added or deleted by the job
+    :returns: the DomainJob object
+    """
+    payload = {k: v for k, v in payload.items() if k not in SECRET_FIELDS}
+    job = DomainJob.objects.create(operation=operation, payload=payload, domain=domain)
+    transaction.on_commit(lambda: Scheduler().submit(job.id))
+    return job
+
+
+def _lease():
+    return getattr(settings, "IPATUURA_DOMAIN_JOB_LEASE", 60)
+
+
+def _lease_end():
+    return timezone.now() + timedelta(seconds=_lease())
+
+
+def retry(job):
+    """
+    Schedule a failed (or never started) job again, it resumes from
+    the step that failed. A running job whose lease expired, its worker
+    process stopped, is retried as well.
+
+    :returns: False if the job is running or succeeded
+    """
+    interrupted = Q(status=DomainJob.Status.RUNNING) & (
+        Q(lease_expires__lt=timezone.now()) | Q(lease_expires__isnull=True)
+    )
+    updated = (
+        DomainJob.objects.filter(id=job.id)
+        .filter(
+            Q(status__in=[DomainJob.Status.FAILED, DomainJob.Status.PENDING])
+            | interrupted
+        )
+        .update(status=DomainJob.Status.PENDING, error="", owner="", lease_expires=None)
+    )
+    if updated:
+        transaction.on_commit(lambda: Scheduler().submit(job.id))
+    return bool(updated)
+
+
+def _next_pending():
+    """
+    Return the id of the oldest pending job, None if there is none or a
+    job is running in any worker process
+    """
+    running = DomainJob.objects.filter(
+        status=DomainJob.Status.RUNNING, lease_expires__gt=timezone.now()
+    ).exists()
+    if running:
+        return None
+    return (
+        DomainJob.objects.filter(status=DomainJob.Status.PENDING)
+        .order_by("created")
+        .values_list("id", flat=True)
+        .first()
+    )
+
+
+def _claim(job_id, owner):
+    """
+    Mark a pending job as running, unless another job runs in any worker
+    process.
+
+    :returns: True if the job was claimed
+    """
+    with transaction.atomic():
+        # Locking the domains serializes the claims across the processes
+        list(Domain.objects.select_for_update().order_by("id"))
+        running = (
+            DomainJob.objects.filter(
+                status=DomainJob.Status.RUNNING, lease_expires__gt=timezone.now()
+            )
+            .exclude(id=job_id)
+            .exists()
+        )
+        if running:
+            logger.info(f"domain job {job_id}: waiting for the running job")
+            return False
+        return bool(
+            DomainJob.objects.filter(id=job_id, status=DomainJob.Status.PENDING).update(
+                status=DomainJob.Status.RUNNING, owner=owner, lease_expires=_lease_end()
+            )
+        )
+
+
+@contextmanager
+def _heartbeat(job_id, owner):
+    """
+    Renew the lease of a job while it runs
+    """
+    stop = threading.Event()
+
+    def renew():
+        while not stop.wait(_lease() / 3):
+            close_old_connections()
+            try:
+                DomainJob.objects.filter(id=job_id, owner=owner).update(
+                    lease_expires=_lease_end()
+                )
+            except Exception as e:
+                logger.error(f"domain job {job_id}: unable to renew the lease: {e}")
+        close_old_connections()
+
+    thread = threading.Thread(target=renew, name="domain-job-heartbeat", daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
+def _payload(job):
+    """
+    Return the payload the steps of a job are run with, along with the
+    secrets of its domain
+    """
+    payload = dict(job.payload)
+    if job.domain is not None:
+        for field in SECRET_FIELDS:
+            payload[field] = getattr(job.domain, field)
+    return payload
+
+
+def _steps(job):
+    # the provisioning code loads SSSDConfig and the FreeIPA client
+    # libraries, only when a job runs
+    from domains.utils import add_domain_steps, delete_domain_steps
+
+    if job.operation == DomainJob.Operation.ADD:
+        return add_domain_steps(job.payload)
+    return delete_domain_steps(job.payload)
+
+
+def _run_step(job, name, func, payload):
+    handler = _StepLogHandler()
+    root = logging.getLogger()
+    root.addHandler(handler)
+    token = _step_log.set(handler)
+    start = time.monotonic()
+    try:
+        func(payload)
+    except Exception as e:
+        status = STEP_FAILED
+        handler.lines.append(f"ERROR {e}")
+        raise
+    else:
+        status = STEP_DONE
+    finally:
+        _step_log.reset(token)
+        root.removeHandler(handler)
+        elapsed = time.monotonic() - start
+        logger.info(f"domain job {job.id}: step {name} {status} in {elapsed:.3f}s")
+        record = {
+            "name": name,
+            "status": status,
+            "seconds": round(elapsed, 3),
+            "log": handler.lines,
+        }
+        job.steps = [s for s in job.steps if s["name"] != name] + [record]
+        job.save(update_fields=["steps", "updated"])
+
+
+def _finish(job):
+    domain = job.domain
+    if domain is None:
+        return
+    if job.operation == DomainJob.Operation.ADD:
+        domain.is_active = True
+        domain.save()
+    else:
+        domain.delete()
+
+
+def run(job_id):
+    """
+    Run the steps of a job not completed yet
+    """
+    close_old_connections()
+    owner = worker_id()
+    if not _claim(job_id, owner):
+        close_old_connections()
+        return
+    job = DomainJob.objects.get(id=job_id)
+    done = {s["name"] for s in job.steps if s["status"] == STEP_DONE}
+
+    with _heartbeat(job.id, owner):
+        try:
+            payload = _payload(job)
+            for name, func in _steps(job):
+                if name in done:
+                    logger.info(f"domain job {job.id}: step {name} already done")
+                    continue
+                _run_step(job, name, func, payload)
+            _finish(job)
+        except Exception as e:
+            logger.error(f"domain job {job.id} failed: {e}")
+            job.status = DomainJob.Status.FAILED
+            job.error = str(e)
+        else:
+            job.status = DomainJob.Status.SUCCEEDED
+        job.owner = ""
+        job.lease_expires = None
+        job.save(update_fields=["status", "error", "owner", "lease_expires", "updated"])
+
+    # run the next job held back by this one, in any worker process
+    pending = _next_pending()
+    if pending is not None:
+        Scheduler().submit(pending)
+    close_old_connections()
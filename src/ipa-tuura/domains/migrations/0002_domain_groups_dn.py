@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-19 16:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('domains', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='domain',
+            name='groups_dn',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+    ]
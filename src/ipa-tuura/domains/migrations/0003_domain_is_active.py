@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-19 18:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('domains', '0002_domain_groups_dn'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='domain',
+            name='is_active',
+            field=models.BooleanField(default=True, verbose_name='is active?'),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-19 18:40
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('domains', '0003_domain_is_active'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DomainJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('operation', models.CharField(choices=[('add', 'Add integration domain'), ('delete', 'Delete integration domain')], max_length=6)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('running', 'Running'), ('succeeded', 'Succeeded'), ('failed', 'Failed')], default='pending', max_length=9)),
+                ('payload', models.JSONField()),
+                ('steps', models.JSONField(default=list)),
+                ('error', models.TextField(blank=True)),
+                ('owner', models.CharField(blank=True, max_length=64)),
+                ('lease_expires', models.DateTimeField(blank=True, null=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('domain', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='jobs', to='domains.domain')),
+            ],
+            options={
+                'ordering': ['id'],
+            },
+        ),
+    ]
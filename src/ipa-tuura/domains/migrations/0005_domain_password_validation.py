@@ -0,0 +1,31 @@
+# Generated by Django 5.2.18 on 2026-10-19 19:45
+
+from django.db import migrations, models
+
+
+def set_realm(apps, schema_editor):
+    Domain = apps.get_model('domains', 'Domain')
+    for domain in Domain.objects.filter(realm=''):
+        domain.realm = domain.name.upper()
+        domain.save(update_fields=['realm'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('domains', '0004_domainjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='domain',
+            name='password_validation',
+            field=models.CharField(choices=[('pam', 'PAM stack'), ('kerberos', 'Kerberos, ipa and ad providers only')], default='pam', max_length=8),
+        ),
+        migrations.AddField(
+            model_name='domain',
+            name='realm',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.RunPython(set_realm, migrations.RunPython.noop),
+    ]
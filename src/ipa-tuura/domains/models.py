@@ -6,6 +6,7 @@ import logging
 
 from django.db import models
 from django.utils.translation import gettext as _
+from ipatuura.mapping import DEFAULT_USER_EXTRA_ATTRS
 
 logger = logging.getLogger(__name__)
 
@@ -27,9 +28,9 @@ class Domain(models.Model):
         AD = "ad", _("LDAP Active Directory Provider")
         LDAP = "ldap", _("LDAP Provider")
 
-    # TODO: multi-domain, implement is_active boolean flag
-    # it designates whether the integration domain should be considered active
-    # is_active = models.BooleanField(verbose_name='is active?', default=True)
+    # Designates whether the integration domain should be considered active,
+    # SCIM requests are only routed to the active domains
+    is_active = models.BooleanField(verbose_name="is active?", default=True)
 
     # Domain Name
     name = models.CharField(max_length=80)
@@ -37,6 +38,9 @@ class Domain(models.Model):
     # Optional description
     description = models.TextField(blank=True)
 
+    # Kerberos realm of the domain, the domain name in upper case by default
+    realm = models.CharField(max_length=255, blank=True)
+
     # The connection URL to the identity server
     integration_domain_url = models.CharField(max_length=255)
 
@@ -53,6 +57,21 @@ class Domain(models.Model):
         default=DomainProviderType.IPA,
     )
 
+    class PasswordValidation(models.TextChoices):
+        """
+        Field Choices for the validation of the user credentials
+        """
+
+        PAM = "pam", _("PAM stack")
+        KERBEROS = "kerberos", _("Kerberos, ipa and ad providers only")
+
+    # How the credentials of the domain users are validated
+    password_validation = models.CharField(
+        max_length=8,
+        choices=PasswordValidation.choices,
+        default=PasswordValidation.PAM,
+    )
+
     # Optional comma-separated list of extra attributes to download
     # along with the user entry
     user_extra_attrs = models.CharField(max_length=255, blank=True)
@@ -63,6 +82,9 @@ class Domain(models.Model):
     # Optional full DN of LDAP tree where users are
     users_dn = models.CharField(max_length=255, blank=True)
 
+    # Optional full DN of LDAP tree where groups are
+    groups_dn = models.CharField(max_length=255, blank=True)
+
     # LDAP auth with TLS support, the file path for now
     # TODO: base64 decode CA cert from HTTP request
     ldap_tls_cacert = models.CharField(max_length=100)
@@ -75,7 +97,10 @@ class Domain(models.Model):
     def save(self, *args, **kwargs):
         # logic for default vaules part of simplification process
         if not self.user_extra_attrs:
-            self.user_extra_attrs = "mail:mail, sn:sn, givenname:givenname"
+            self.user_extra_attrs = DEFAULT_USER_EXTRA_ATTRS
+
+        if not self.realm:
+            self.realm = self.name.upper()
 
         if self.id_provider == "ldap":
             if not self.user_object_classes:
@@ -84,6 +109,8 @@ class Domain(models.Model):
                 )
             if not self.users_dn:
                 self.users_dn = "ou=people"
+            if not self.groups_dn:
+                self.groups_dn = "ou=groups"
 
         elif self.id_provider == "ad":
             if not self.user_object_classes:
@@ -92,5 +119,56 @@ class Domain(models.Model):
                 )
             if not self.users_dn:
                 self.users_dn = "CN=Users"
+            if not self.groups_dn:
+                self.groups_dn = "CN=Users"
 
         super().save(*args, **kwargs)
+
+
+class DomainJob(models.Model):
+    """
+    Provisioning job adding or deleting an integration domain.
+
+    The job runs in the background, the completed steps are recorded so
+    that a failed job resumes from the step that failed.
+    """
+
+    class Operation(models.TextChoices):
+        ADD = "add", _("Add integration domain")
+        DELETE = "delete", _("Delete integration domain")
+
+    class Status(models.TextChoices):
+        PENDING = "pending", _("Pending")
+        RUNNING = "running", _("Running")
+        SUCCEEDED = "succeeded", _("Succeeded")
+        FAILED = "failed", _("Failed")
+
+    domain = models.ForeignKey(
+        Domain, null=True, on_delete=models.SET_NULL, related_name="jobs"
+    )
+    operation = models.CharField(max_length=6, choices=Operation.choices)
+    status = models.CharField(
+        max_length=9, choices=Status.choices, default=Status.PENDING
+    )
+
+    # Integration domain configuration the steps are run with
+    payload = models.JSONField()
+
+    # List of {"name", "status", "seconds", "log"} for the steps run so far
+    steps = models.JSONField(default=list)
+
+    error = models.TextField(blank=True)
+
+    # Worker process running the job and end of its lease, renewed while
+    # the job runs: a running job whose lease expired can be retried
+    owner = models.CharField(max_length=64, blank=True)
+    lease_expires = models.DateTimeField(null=True, blank=True)
+
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ["id"]
+
+    def __str__(self):
+        return f"{self.operation} {self.payload.get('name')} ({self.status})"
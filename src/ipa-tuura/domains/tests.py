@@ -0,0 +1,316 @@
+#
+# Copyright (C) 2023  FreeIPA Contributors see COPYING for license
+#
+
+import contextvars
+import logging
+import os
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from unittest import mock
+
+from django.test import TestCase
+from django.utils import timezone
+from domains import jobs, utils
+from domains.models import Domain, DomainJob
+from ipatuura.sssd import SSSDNotFoundException
+
+
+class DomainJobTest(TestCase):
+    def setUp(self):
+        self.domain = Domain.objects.create(
+            name="example.test",
+            integration_domain_url="https://ipa.example.test",
+            client_id="admin",
+            client_secret="Secret123",
+            id_provider="ipa",
+            is_active=False,
+        )
+        self.payload = {
+            "name": "example.test",
+            "id_provider": "ipa",
+            "client_id": "admin",
+            "client_secret": "Secret123",
+        }
+
+    def job(self, **kwargs):
+        return DomainJob.objects.create(
+            operation=DomainJob.Operation.ADD,
+            payload={"name": "example.test", "id_provider": "ipa"},
+            domain=self.domain,
+            **kwargs,
+        )
+
+    def test_secret_not_persisted(self):
+        job = jobs.submit(DomainJob.Operation.ADD, self.payload, self.domain)
+        job.refresh_from_db()
+
+        self.assertNotIn("client_secret", job.payload)
+        self.assertEqual(jobs._payload(job)["client_secret"], "Secret123")
+
+    def test_run_with_the_domain_secret(self):
+        job = self.job()
+        step = mock.Mock()
+        with mock.patch.object(jobs, "_steps", return_value=[("step", step)]):
+            jobs.run(job.id)
+
+        self.assertEqual(step.call_args.args[0]["client_secret"], "Secret123")
+        job.refresh_from_db()
+        self.assertEqual(job.status, DomainJob.Status.SUCCEEDED)
+        self.assertEqual(job.owner, "")
+        self.domain.refresh_from_db()
+        self.assertTrue(self.domain.is_active)
+
+    def test_one_job_at_a_time(self):
+        self.job(
+            status=DomainJob.Status.RUNNING,
+            owner="other",
+            lease_expires=timezone.now() + timedelta(seconds=60),
+        )
+        job = self.job()
+
+        self.assertFalse(jobs._claim(job.id, "me"))
+        job.refresh_from_db()
+        self.assertEqual(job.status, DomainJob.Status.PENDING)
+
+    def test_expired_lease_does_not_block(self):
+        self.job(
+            status=DomainJob.Status.RUNNING,
+            owner="other",
+            lease_expires=timezone.now() - timedelta(seconds=1),
+        )
+        job = self.job()
+
+        self.assertTrue(jobs._claim(job.id, "me"))
+        job.refresh_from_db()
+        self.assertEqual(job.owner, "me")
+        self.assertGreater(job.lease_expires, timezone.now())
+
+    def test_retry_interrupted_job(self):
+        job = self.job(
+            status=DomainJob.Status.RUNNING,
+            owner="crashed",
+            lease_expires=timezone.now() - timedelta(seconds=1),
+        )
+
+        self.assertTrue(jobs.retry(job))
+        job.refresh_from_db()
+        self.assertEqual(job.status, DomainJob.Status.PENDING)
+        self.assertEqual(job.owner, "")
+
+    def test_no_retry_of_running_job(self):
+        job = self.job(
+            status=DomainJob.Status.RUNNING,
+            owner="other",
+            lease_expires=timezone.now() + timedelta(seconds=60),
+        )
+        self.assertFalse(jobs.retry(job))
+        self.assertFalse(jobs.retry(self.job(status=DomainJob.Status.SUCCEEDED)))
+
+    def test_step_logs(self):
+        logger = logging.getLogger("domains.utils")
+
+        def step(payload):
+            logger.info("in the step")
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                executor.submit(
+                    contextvars.copy_context().run, logger.info, "in a helper"
+                ).result()
+                # not run in the context of the step
+                executor.submit(logger.info, "in another job").result()
+
+        job = self.job()
+        with mock.patch.object(jobs, "_steps", return_value=[("step", step)]):
+            jobs.run(job.id)
+
+        job.refresh_from_db()
+        self.assertEqual(
+            job.steps[0]["log"],
+            ["INFO domains.utils: in the step", "INFO domains.utils: in a helper"],
+        )
+
+    def test_sweep(self):
+        with mock.patch.object(jobs._Scheduler, "_run"):
+            scheduler = jobs._Scheduler()
+        self.addCleanup(scheduler._executor.shutdown)
+        running = self.job(
+            status=DomainJob.Status.RUNNING,
+            owner="other",
+            lease_expires=timezone.now() + timedelta(seconds=60),
+        )
+        pending = self.job()
+        self.job()
+
+        with mock.patch.object(scheduler, "submit") as submit:
+            scheduler.sweep()
+            submit.assert_not_called()
+
+            # the worker process of the running job stopped
+            running.lease_expires = timezone.now() - timedelta(seconds=1)
+            running.save()
+            scheduler.sweep()
+            submit.assert_called_once_with(pending.id)
+
+
+@mock.patch.object(utils, "api")
+class IPABatchTest(TestCase):
+    COMMANDS = [
+        ("service_add", ["ipatuura/host.example.test@EXAMPLE.TEST"], {}),
+        ("role_add", [utils.IPATUURA_ROLE], {}),
+        ("role_add_member", [utils.IPATUURA_ROLE], {"service": "ipatuura"}),
+    ]
+
+    def results(self, api, *errors):
+        api.Command.__getitem__.return_value.return_value = {
+            "results": [
+                {"error": None} if name is None else {"error": name, "error_name": name}
+                for name in errors
+            ]
+        }
+
+    def test_single_round_trip(self, api):
+        self.results(api, None, None, None)
+        utils._ipa_batch(self.COMMANDS)
+
+        api.Command.__getitem__.assert_called_once_with("batch")
+        methods = api.Command.__getitem__.return_value.call_args.args
+        self.assertEqual(
+            [(m["method"], m["params"]) for m in methods],
+            [
+                ("service_add", [["ipatuura/host.example.test@EXAMPLE.TEST"], {}]),
+                ("role_add", [[utils.IPATUURA_ROLE], {}]),
+                ("role_add_member", [[utils.IPATUURA_ROLE], {"service": "ipatuura"}]),
+            ],
+        )
+
+    def test_ignored_errors(self, api):
+        # a second run finds the entries of the first one
+        self.results(api, "DuplicateEntry", "DuplicateEntry", None)
+        utils._ipa_batch(self.COMMANDS, ignore=("DuplicateEntry",))
+
+    def test_failure_in_the_middle(self, api):
+        self.results(api, None, "ACIError", None)
+        with self.assertRaisesRegex(Exception, "Error role_add:"):
+            utils._ipa_batch(self.COMMANDS, ignore=("DuplicateEntry",))
+
+
+@mock.patch.object(utils, "ipa_api_connect")
+@mock.patch.object(utils, "_ipa_batch")
+@mock.patch.object(utils, "_run")
+@mock.patch.object(utils.subprocess, "run")
+class DeployServiceTest(TestCase):
+    domain = {"name": "example.test", "realm": "EXAMPLE.TEST"}
+
+    def test_deploy(self, run, _run, batch, connect):
+        run.return_value.returncode = 0
+        utils.deploy_ipa_service(self.domain)
+
+        # the local account is created along with the IPA commands
+        self.assertEqual(
+            [c.args[0][0] for c in _run.call_args_list],
+            ["groupadd", "useradd", "chown"],
+        )
+        self.assertEqual(batch.call_args.kwargs, {"ignore": ("DuplicateEntry",)})
+        self.assertEqual(run.call_args.args[0][0], "ipa-getkeytab")
+
+    def test_deploy_batch_failure(self, run, _run, batch, connect):
+        batch.side_effect = Exception("Error role_add")
+        with self.assertRaises(Exception):
+            utils.deploy_ipa_service(self.domain)
+
+        # the account creation completed, no keytab was retrieved
+        self.assertEqual(
+            [c.args[0][0] for c in _run.call_args_list], ["groupadd", "useradd"]
+        )
+        run.assert_not_called()
+
+    def test_undeploy(self, run, _run, batch, connect):
+        utils.undeploy_ipa_service(self.domain)
+
+        self.assertEqual(_run.call_args.args[0][0], "ipa-rmkeytab")
+        self.assertEqual(
+            [name for name, _, _ in batch.call_args.args[0]],
+            ["role_remove_member", "role_del", "service_del"],
+        )
+        self.assertEqual(batch.call_args.kwargs, {"ignore": ("NotFound",)})
+
+
+@mock.patch.object(utils, "SSSD", side_effect=SSSDNotFoundException)
+@mock.patch.object(utils.subprocess, "run")
+class SSSDReloadTest(TestCase):
+    CONF = """[sssd]
+services = nss, pam
+
+[domain/example.test]
+id_provider = ipa
+"""
+
+    def setUp(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        self.conf = os.path.join(path, "sssd.conf")
+        self.applied = os.path.join(path, "ipatuura", "sssd.conf.applied")
+        for name, value in (
+            ("SSSD_CONF", self.conf),
+            ("SSSD_APPLIED_CONF", self.applied),
+        ):
+            patcher = mock.patch.object(utils, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.write(self.CONF)
+
+    def write(self, content):
+        with open(self.conf, "w") as fd:
+            fd.write(content)
+
+    def commands(self, run):
+        return [c.args[0][:2] for c in run.call_args_list]
+
+    def test_changed_sections(self, run, sssd):
+        # all of them until SSSD applied the configuration
+        self.assertEqual(utils.changed_sssd_sections(), {"sssd", "domain/example.test"})
+        os.makedirs(os.path.dirname(self.applied))
+        shutil.copyfile(self.conf, self.applied)
+        self.assertEqual(utils.changed_sssd_sections(), set())
+
+        self.write(
+            self.CONF.replace("nss, pam", "nss, pam, ifp")
+            + "\n[ifp]\nuser_attributes = +mail\n"
+        )
+        self.assertEqual(utils.changed_sssd_sections(), {"sssd", "ifp"})
+
+    def test_restarted_once_applied(self, run, sssd):
+        run.return_value.returncode = 0
+        utils.reload_sssd({})
+        self.assertEqual(
+            self.commands(run), [["sssctl", "config-check"], ["systemctl", "restart"]]
+        )
+
+        # nothing changed since
+        run.reset_mock()
+        utils.reload_sssd({})
+        run.assert_not_called()
+
+    def test_responder_change_restarts_sssd(self, run, sssd):
+        run.return_value.returncode = 0
+        utils.reload_sssd({})
+        run.reset_mock()
+
+        # the responders only read the confdb imported when SSSD starts
+        self.write(self.CONF + "\n[ifp]\nuser_attributes = +mail\n")
+        utils.reload_sssd({})
+        self.assertEqual(
+            run.call_args_list[-1].args[0], ["systemctl", "restart", "sssd"]
+        )
+
+    def test_invalid_conf(self, run, sssd):
+        run.return_value.returncode = 1
+        run.return_value.stdout = "Issues identified by validators: 1"
+        with self.assertRaises(Exception):
+            utils.reload_sssd({})
+
+        # SSSD keeps running with the previous configuration
+        self.assertEqual(self.commands(run), [["sssctl", "config-check"]])
+        self.assertFalse(os.path.exists(self.applied))
@@ -20,7 +20,7 @@ Including another URLconf
 import logging
 
 from django.urls import include, re_path
-from domains.views import DomainViewSet
+from domains.views import DomainJobViewSet, DomainViewSet
 from rest_framework.routers import DefaultRouter
 
 logger = logging.getLogger(__name__)
@@ -28,6 +28,7 @@ logger = logging.getLogger(__name__)
 
 router = DefaultRouter()
 router.register("domain", DomainViewSet)
+router.register("jobs", DomainJobViewSet)
 
 urlpatterns = [
     re_path("^", include(router.urls)),
@@ -2,17 +2,25 @@
 # Copyright (C) 2023  FreeIPA Contributors see COPYING for license
 #
 
+import contextvars
+import io
 import logging
 import os
 import re
+import shutil
 import socket
 import subprocess
 import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
-import ipalib.errors
 import SSSDConfig
 from ipalib import api
 from ipalib.facts import is_ipa_client_configured
+from ipatuura.changelog import enumeration_limit
+from ipatuura.mapping import DEFAULT_USER_EXTRA_ATTRS, attribute_map
+from ipatuura.sssd import SSSD, SSSDNotFoundException
 
 try:
     from ipalib.install.kinit import kinit_password
@@ -27,19 +35,26 @@ except ImportError:
 
 logger = logging.getLogger(__name__)
 
+SSSD_CONF = "/etc/sssd/sssd.conf"
+# Copy of sssd.conf as of the last time SSSD applied it
+SSSD_APPLIED_CONF = "/var/lib/ipa/ipatuura/sssd.conf.applied"
+
 
 def activate_ifp(domain):
     """
     Configure the ifp section of sssd.conf
 
-    Activate the ifp service and add the following user_attributes
-    to the [ifp] section:
-    +mail, +givenname, +sn, +lock
+    Activate the ifp service and add the attributes of the domain's
+    user_extra_attrs to the user_attributes of the [ifp] section,
+    for instance: +mail, +givenname, +sn, +lock
 
     If the attributes were part of the negative list (for instance
     user_attributes = -givenname), they are removed from the negative list
     and added in the positive list.
     The other attributes are kept.
+
+    The wildcard_limit is raised to the enumeration limit of the change
+    log, so that a truncated enumeration is detected.
     """
     try:
         sssdconfig = SSSDConfig.SSSDConfig()
@@ -48,6 +63,7 @@ def activate_ifp(domain):
         logger.info("Unable to read SSSD config")
         raise e
 
+    was_active = "ifp" in sssdconfig.list_active_services()
     try:
         sssdconfig.activate_service("ifp")
         ifp = sssdconfig.get_service("ifp")
@@ -56,26 +72,45 @@ def activate_ifp(domain):
         raise e
 
     # edit the [ifp] section
+    exported = attribute_map(domain.get("user_extra_attrs")).ifp_user_attributes
     try:
-        user_attrs = ifp.get_option("user_attributes")
+        previous = ifp.get_option("user_attributes")
     except SSSDConfig.NoOptionError:
-        user_attrs = set()
-    else:
-        # TODO: read content from domain['user_extra_attrs']
-        negative_set = {"-mail", "-givenname", "-sn", "-lock"}
-        user_attrs = {
-            s.strip()
-            for s in user_attrs.split(",")
-            if s.strip() and s.strip().lower() not in negative_set
-        }
-
-    positive_set = {"+mail", "+givenname", "+sn", "+lock"}
-    ifp.set_option("user_attributes", ", ".join(user_attrs.union(positive_set)))
+        previous = ""
+    previous = {s.strip() for s in previous.split(",") if s.strip()}
+    negative_set = {"-" + attr.lower() for attr in exported}
+    user_attrs = {s for s in previous if s.lower() not in negative_set}
+
+    positive_set = {"+" + attr for attr in exported}
+    user_attrs = user_attrs.union(positive_set)
+    try:
+        wildcard_limit = int(ifp.get_option("wildcard_limit"))
+    except (SSSDConfig.NoOptionError, ValueError):
+        wildcard_limit = None
+    # 0 lets the caller set the limit
+    limited = wildcard_limit is None or 0 < wildcard_limit < enumeration_limit()
+
+    # leave sssd.conf untouched when already configured
+    if was_active and user_attrs == previous and not limited:
+        logger.info("ifp section unchanged")
+        return
+
+    ifp.set_option("user_attributes", ", ".join(sorted(user_attrs)))
+    if limited:
+        ifp.set_option("wildcard_limit", enumeration_limit())
     sssdconfig.save_service(ifp)
 
     sssdconfig.write()
 
 
+def _realm(domain):
+    """
+    Return the Kerberos realm of a domain, the jobs created before the
+    domains had one carry only the domain name
+    """
+    return domain.get("realm") or domain["name"].upper()
+
+
 def install_client(domain):
     """
     :param domain
@@ -87,7 +122,7 @@ def install_client(domain):
         "--domain",
         domain["name"],
         "--realm",
-        domain["name"].upper(),
+        _realm(domain),
         "-p",
         domain["client_id"],
         "-w",
@@ -149,116 +184,137 @@ def ipa_api_connect(domain):
         backend.connect(ccache=os.environ.get("KRB5CCNAME", None))
 
 
-def undeploy_ipa_service(domain):
-    hostname = socket.gethostname()
-    realm = domain["name"].upper()
-    ipatuura_principal = "ipatuura/%s@%s" % (hostname, realm)
-    keytab_file = os.path.join("/var/lib/ipa/ipatuura/", "service.keytab")
-    ipa_api_connect(domain)
+# Name of the IPA role granting the ipa-tuura service its privileges
+IPATUURA_ROLE = "ipatuura writable interface"
 
-    # remove keytab
-    args = ["ipa-rmkeytab", "-p", ipatuura_principal, "-k", keytab_file]
-    proc = subprocess.run(args, capture_output=True, text=True)
-    if proc.returncode != 0:
-        logger.info(f"Error rmkeytab: {proc.stderr}")
 
-    # remove role member
+@contextmanager
+def _timed(step):
+    """
+    Log the duration of a provisioning step
+    """
+    start = time.monotonic()
     try:
-        result = api.Command["role_remove_member"](
-            cn="ipatuura writable interface", service=ipatuura_principal
-        )
-    except ipalib.errors.NotFound:
-        logger.info("role member %s does not exist", ipatuura_principal)
-        pass
-    else:
-        logger.info(f"ipa: role_remove_member result {result}")
+        yield
+    finally:
+        logger.info(f"{step} took {time.monotonic() - start:.3f}s")
 
-    # delete role
-    try:
-        result = api.Command["role_del"](cn="ipatuura writable interface")
-    except ipalib.errors.NotFound:
-        logger.info("role %s does not exist", "ipatuura writable interface")
-        pass
-    else:
-        logger.info(f"ipa: role_del result {result}")
 
-    # delete service
-    try:
-        result = api.Command["service_del"](krbcanonicalname=ipatuura_principal)
-    except ipalib.errors.NotFound:
-        logger.info("service %s does not exist", ipatuura_principal)
-        pass
-    else:
-        logger.info(f"ipa: service_del result {result}")
+def _ipa_batch(commands, ignore=()):
+    """
+    Run IPA commands in a single batch round trip, in order
 
+    :param commands: list of (command name, args, options) tuples
+    :param ignore: names of the errors ignored, for instance "DuplicateEntry"
+    :raises Exception: if a command failed with an error not ignored
+    """
+    methods = [
+        {"method": command, "params": [list(args), options]}
+        for command, args, options in commands
+    ]
+    result = api.Command["batch"](*methods)
+    for (command, _, _), item in zip(commands, result["results"]):
+        error = item.get("error")
+        if error is None:
+            logger.info(f"ipa: {command} result {item}")
+        elif item.get("error_name") in ignore:
+            logger.info(f"ipa: {command}: {error}")
+        else:
+            raise Exception("Error {}:\n{}".format(command, error))
 
-def deploy_ipa_service(domain):
-    hostname = socket.gethostname()
-    realm = domain["name"].upper()
-    ipatuura_principal = "ipatuura/%s@%s" % (hostname, realm)
-    keytab_file = os.path.join("/var/lib/ipa/ipatuura/", "service.keytab")
-    ipa_api_connect(domain)
 
-    # container image should contain the user and group
-    # groupadd scim
-    args = ["groupadd", "scim"]
+def _run(args):
     proc = subprocess.run(args, capture_output=True, text=True)
     if proc.returncode != 0:
-        logger.info(f"groupadd scim: {proc.stderr}")
+        logger.info(f"{' '.join(args[:2])}: {proc.stderr}")
+    return proc
 
-    # useradd -r -m -d /var/lib/ipa/ipatuura -g scim scim
-    args = ["useradd", "-r", "-m", "-d", "/var/lib/ipa/ipatuura", "-g", "scim", "scim"]
-    proc = subprocess.run(args, capture_output=True, text=True)
-    if proc.returncode != 0:
-        logger.info(f"useradd scim: {proc.stderr}")
 
-    # add service
-    try:
-        result = api.Command["service_add"](krbcanonicalname=ipatuura_principal)
-    except ipalib.errors.DuplicateEntry:
-        logger.info("service %s already exists", ipatuura_principal)
-        pass
-    else:
-        logger.info(f"ipa: service_add result {result}")
+def _add_scim_account():
+    # container image should contain the user and group
+    _run(["groupadd", "scim"])
+    _run(["useradd", "-r", "-m", "-d", "/var/lib/ipa/ipatuura", "-g", "scim", "scim"])
 
-    # add role
-    try:
-        result = api.Command["role_add"](cn="ipatuura writable interface")
-    except ipalib.errors.DuplicateEntry:
-        logger.info("role %s already exists", "ipatuura writable interface")
-        pass
-    else:
-        logger.info(f"ipa: role_add result {result}")
 
-    # add role member
-    try:
-        result = api.Command["role_add_member"](
-            cn="ipatuura writable interface", service=ipatuura_principal
-        )
-    except ipalib.errors.DuplicateEntry:
-        logger.info("role member %s already exists", ipatuura_principal)
-        pass
-    else:
-        logger.info(f"ipa: role_member_add result {result}")
+def undeploy_ipa_service(domain):
+    hostname = socket.gethostname()
+    realm = _realm(domain)
+    ipatuura_principal = "ipatuura/%s@%s" % (hostname, realm)
+    keytab_file = os.path.join("/var/lib/ipa/ipatuura/", "service.keytab")
 
-    # add privileges to the role member
-    try:
-        result = api.Command["role_add_privilege"](
-            cn="ipatuura writable interface", privilege="User Administrators"
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        # remove keytab, independent from the IPA commands
+        rmkeytab = executor.submit(
+            contextvars.copy_context().run,
+            _run,
+            ["ipa-rmkeytab", "-p", ipatuura_principal, "-k", keytab_file],
         )
-    except ipalib.errors.DuplicateEntry:
-        logger.info("role member %s already exists", ipatuura_principal)
-        pass
-    else:
-        logger.info(f"ipa: role_member_add result {result}")
+
+        with _timed("ipa_api_connect"):
+            ipa_api_connect(domain)
+
+        # remove role member, delete role and service
+        with _timed("ipa batch"):
+            _ipa_batch(
+                [
+                    (
+                        "role_remove_member",
+                        [IPATUURA_ROLE],
+                        {"service": ipatuura_principal},
+                    ),
+                    ("role_del", [IPATUURA_ROLE], {}),
+                    ("service_del", [ipatuura_principal], {}),
+                ],
+                ignore=("NotFound",),
+            )
+        rmkeytab.result()
+
+
+def deploy_ipa_service(domain):
+    hostname = socket.gethostname()
+    realm = _realm(domain)
+    ipatuura_principal = "ipatuura/%s@%s" % (hostname, realm)
+    keytab_file = os.path.join("/var/lib/ipa/ipatuura/", "service.keytab")
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        # the local account is created while the IPA commands run, in the
+        # context of the job step to keep its logs
+        account = executor.submit(contextvars.copy_context().run, _add_scim_account)
+
+        with _timed("ipa_api_connect"):
+            ipa_api_connect(domain)
+
+        # add service, role, role member and privileges to the role
+        with _timed("ipa batch"):
+            _ipa_batch(
+                [
+                    ("service_add", [ipatuura_principal], {}),
+                    ("role_add", [IPATUURA_ROLE], {}),
+                    (
+                        "role_add_member",
+                        [IPATUURA_ROLE],
+                        {"service": ipatuura_principal},
+                    ),
+                    (
+                        "role_add_privilege",
+                        [IPATUURA_ROLE],
+                        {"privilege": ["User Administrators", "Group Administrators"]},
+                    ),
+                ],
+                ignore=("DuplicateEntry",),
+            )
+
+        with _timed("scim account"):
+            account.result()
 
     # get keytab
-    args = ["ipa-getkeytab", "-p", ipatuura_principal, "-k", keytab_file]
-    proc = subprocess.run(args, capture_output=True, text=True)
-    if proc.returncode != 0:
-        raise Exception("Error getkeytab:\n{}".format(proc.stderr))
+    with _timed("ipa-getkeytab"):
+        args = ["ipa-getkeytab", "-p", ipatuura_principal, "-k", keytab_file]
+        proc = subprocess.run(args, capture_output=True, text=True)
+        if proc.returncode != 0:
+            raise Exception("Error getkeytab:\n{}".format(proc.stderr))
 
-    os.system("chown -R scim:scim /var/lib/ipa/ipatuura/")
+    _run(["chown", "-R", "scim:scim", "/var/lib/ipa/ipatuura/"])
 
 
 def remove_sssd_domain(domain):
@@ -310,6 +366,122 @@ def join_ad_realm(domain):
         raise Exception("Error realm join:\n{}".format(proc.stderr))
 
 
+def _read_sssd_conf(path):
+    sssdconfig = ConfigParser.RawConfigParser()
+    sssdconfig.optionxform = str
+    sssdconfig.read(path)
+    return sssdconfig
+
+
+def _add_to_list(sssdconfig, section, option, values):
+    """
+    Return a comma-separated option value with the values appended
+    """
+    current = []
+    if sssdconfig.has_option(section, option):
+        current = [x.strip() for x in sssdconfig.get(section, option).split(",")]
+    current = [x for x in current if x]
+    return ", ".join(current + [v for v in values if v not in current])
+
+
+def _write_sssd_conf(sssdconfig, path):
+    """
+    Write sssd.conf, unless its content did not change
+    """
+    content = io.StringIO()
+    sssdconfig.write(content)
+    try:
+        with open(path) as fd:
+            if fd.read() == content.getvalue():
+                logger.info(f"{path} unchanged")
+                return
+    except OSError:
+        pass
+    with open(path, "w") as fd:
+        os.fchmod(fd.fileno(), 0o600)
+        fd.write(content.getvalue())
+
+
+def _sections(sssdconfig):
+    return {name: dict(sssdconfig.items(name)) for name in sssdconfig.sections()}
+
+
+def changed_sssd_sections():
+    """
+    Return the names of the sssd.conf sections that changed since the
+    configuration was last applied, all of them if unknown.
+    """
+    current = _sections(_read_sssd_conf(SSSD_CONF))
+    if not os.path.exists(SSSD_APPLIED_CONF):
+        return set(current)
+    applied = _sections(_read_sssd_conf(SSSD_APPLIED_CONF))
+    return {
+        name
+        for name in set(current) | set(applied)
+        if current.get(name) != applied.get(name)
+    }
+
+
+def check_sssd_conf():
+    """
+    Check sssd.conf with sssctl, so that an invalid configuration fails
+    the step while SSSD still runs with the previous one.
+    """
+    try:
+        proc = subprocess.run(
+            ["sssctl", "config-check"], capture_output=True, text=True
+        )
+    except OSError as e:
+        logger.info(f"sssctl not available: {e}")
+        return
+    if proc.returncode != 0:
+        raise Exception("Invalid sssd.conf:\n{}".format(proc.stdout or proc.stderr))
+
+
+def reload_sssd(domain):
+    """
+    Apply the sssd.conf changes, restarting SSSD only when it changed.
+
+    The responders read their options from the confdb, which the SSSD
+    monitor only imports from sssd.conf when it starts: SSSD is restarted
+    for any change, once sssd.conf is checked. The lookups ipa-tuura
+    recently did are then replayed to warm the caches up. The lookup
+    latency before the change and while warming up is logged.
+    """
+    changed = changed_sssd_sections()
+    if not changed:
+        logger.info("sssd.conf unchanged, SSSD not restarted")
+        return
+    check_sssd_conf()
+
+    try:
+        sssd_if = SSSD()
+    except SSSDNotFoundException:
+        sssd_if = None
+    else:
+        logger.info(f"SSSD lookup latency before: {sssd_if.lookup_stats(reset=True)}")
+
+    # a failed restart fails the step, the job is then retried from it
+    restart_sssd()
+    logger.info(f"SSSD applied changes of sections {sorted(changed)}")
+    os.makedirs(os.path.dirname(SSSD_APPLIED_CONF), exist_ok=True)
+    shutil.copyfile(SSSD_CONF, SSSD_APPLIED_CONF)
+
+    if sssd_if is None:
+        return
+    # the lookups connect again to the restarted infopipe responder
+    start = time.monotonic()
+    try:
+        count = sssd_if.prewarm()
+    except SSSDNotFoundException as e:
+        logger.info(f"Unable to warm up SSSD: {e}")
+        return
+    logger.info(
+        f"SSSD warmed up with {count} lookups in {time.monotonic() - start:.3f}s, "
+        f"lookup latency: {sssd_if.lookup_stats(reset=True)}"
+    )
+
+
 def config_default_sssd(domain):
     """
     Setup for creating default configuration file sssd.conf
@@ -321,21 +493,30 @@ def config_default_sssd(domain):
     domainname = domain["name"]
     id_provider = domain["id_provider"]
     ldap_uri = domain["integration_domain_url"]
-    try:
-        ldap_user_extra_attrs = domain["user_extra_attrs"]
-    except KeyError:
-        ldap_user_extra_attrs = "mail:mail, sn:sn, givenname:givenname"
+    ldap_user_extra_attrs = domain.get("user_extra_attrs") or DEFAULT_USER_EXTRA_ATTRS
 
-    cfg = "/etc/sssd/sssd.conf"
-    sssdconfig = ConfigParser.RawConfigParser()
-    sssdconfig.optionxform = str
+    cfg = SSSD_CONF
+    sssdconfig = _read_sssd_conf(cfg)
 
-    sssdconfig.add_section("sssd")
+    # the other domains of the file are kept
+    if not sssdconfig.has_section("sssd"):
+        sssdconfig.add_section("sssd")
     sssdconfig.set("sssd", "config_file_version", "2")
-    sssdconfig.set("sssd", "domains", domainname)
-    sssdconfig.set("sssd", "services", "nss, pam, ifp")
+    sssdconfig.set(
+        "sssd", "domains", _add_to_list(sssdconfig, "sssd", "domains", [domainname])
+    )
+    sssdconfig.set(
+        "sssd",
+        "services",
+        _add_to_list(sssdconfig, "sssd", "services", ["nss", "pam", "ifp"]),
+    )
     domain_section = "%s/%s" % ("domain", domainname)
-    sssdconfig.add_section(domain_section)
+    # the domain section is rebuilt in place, keeping the sections order
+    if sssdconfig.has_section(domain_section):
+        for option in sssdconfig.options(domain_section):
+            sssdconfig.remove_option(domain_section, option)
+    else:
+        sssdconfig.add_section(domain_section)
     sssdconfig.set(
         domain_section, "ldap_search_base", "dc=" + suffix[0] + ", dc=" + suffix[1]
     )
@@ -351,61 +532,90 @@ def config_default_sssd(domain):
     sssdconfig.set(domain_section, "cache_credentials", "True")
     sssdconfig.set(domain_section, "enumerate", "True")
     sssdconfig.set(domain_section, "timeout", "60")
-    sssdconfig.add_section("nss")
+    for section in ("nss", "pam", "ifp"):
+        if not sssdconfig.has_section(section):
+            sssdconfig.add_section(section)
     sssdconfig.set("nss", "timeout", "60")
-    sssdconfig.add_section("pam")
     sssdconfig.set("pam", "timeout", "60")
-    sssdconfig.add_section("ifp")
 
     # TODO process ldap_tls_cacert, base64decode.
     cert_location = "/etc/openldap/certs/cacert.pem"
     sssdconfig.set(domain_section, "ldap_tls_cacert", cert_location)
 
-    with open(cfg, "w") as fd:
-        os.fchmod(fd.fileno(), 0o600)
-        sssdconfig.write(fd)
+    _write_sssd_conf(sssdconfig, cfg)
 
 
-# CRUD functions
-def add_domain(domain):
+def reset_ipa_client(domain):
     """
-    Add an integration domain with extra attribute mappings
+    Remove a previous enrollment of ipa-tuura as an IPA client
+    """
+    if is_ipa_client_configured():
+        undeploy_ipa_service(domain)
+        uninstall_ipa_client()
+
+
+def add_domain_steps(domain):
+    """
+    Steps adding an integration domain with extra attribute mappings
 
     Supported identity providers: ipa, ldap, and ad.
+
+    :returns: a list of (name, function) tuples, the functions
+              are called with the domain as argument
     """
     # IPA: enroll ipa-tuura as an IPA client to the domain
     # LDAP: add default ldap sssd.conf
     if domain["id_provider"] == "ipa":
-        if is_ipa_client_configured():
-            undeploy_ipa_service(domain)
-            uninstall_ipa_client()
-        install_client(domain)
-        deploy_ipa_service(domain)
+        steps = [
+            ("reset_ipa_client", reset_ipa_client),
+            ("install_client", install_client),
+            ("deploy_ipa_service", deploy_ipa_service),
+        ]
     elif domain["id_provider"] == "ad":
-        join_ad_realm(domain)
+        steps = [("join_ad_realm", join_ad_realm)]
     else:
-        config_default_sssd(domain)
+        steps = [("config_default_sssd", config_default_sssd)]
 
     # activate infopipe attrs and restart sssd service
-    activate_ifp(domain)
-    try:
-        restart_sssd()
-    except Exception:
-        pass
+    steps.append(("activate_ifp", activate_ifp))
+    steps.append(("reload_sssd", reload_sssd))
+    return steps
 
 
-def delete_domain(domain):
+def delete_domain_steps(domain):
     """
-    Delete an integration domain
+    Steps deleting an integration domain
+
+    :returns: a list of (name, function) tuples, the functions
+              are called with the domain as argument
     """
     if domain["id_provider"] == "ipa":
         # undeploy the service account
-        undeploy_ipa_service(domain)
-
         # ipa client uninstall moves the sssd.conf to sssd.conf.deleted
-        uninstall_ipa_client()
-        return
+        return [
+            ("undeploy_ipa_service", undeploy_ipa_service),
+            ("uninstall_ipa_client", lambda domain: uninstall_ipa_client()),
+        ]
 
     # LDAP (ad, ldap): remove domian from sssd.conf
     # TODO: undeploy LDAP service account
-    remove_sssd_domain(domain)
+    return [("remove_sssd_domain", remove_sssd_domain)]
+
+
+# CRUD functions
+def add_domain(domain):
+    """
+    Add an integration domain with extra attribute mappings
+
+    Supported identity providers: ipa, ldap, and ad.
+    """
+    for name, step in add_domain_steps(domain):
+        step(domain)
+
+
+def delete_domain(domain):
+    """
+    Delete an integration domain
+    """
+    for name, step in delete_domain_steps(domain):
+        step(domain)
@@ -4,11 +4,14 @@
 
 import logging
 
+from django.db import transaction
 from django.http import Http404
-from domains.adapters import DomainSerializer
-from domains.models import Domain
-from domains.utils import add_domain, delete_domain
+from django.urls import reverse
+from domains import jobs
+from domains.adapters import DomainJobSerializer, DomainSerializer
+from domains.models import Domain, DomainJob
 from rest_framework import status
+from rest_framework.decorators import action
 from rest_framework.mixins import (
     CreateModelMixin,
     DestroyModelMixin,
@@ -31,18 +34,26 @@ class DomainViewSet(
     serializer_class = DomainSerializer
     queryset = Domain.objects.all()
 
+    def _accepted(self, request, job):
+        location = reverse("domainjob-detail", kwargs={"pk": job.pk})
+        return Response(
+            DomainJobSerializer(job).data,
+            status=status.HTTP_202_ACCEPTED,
+            headers={"Location": request.build_absolute_uri(location)},
+        )
+
     # handles CreateModelMixin POSTs
+    # The domain is provisioned by a background job and activated
+    # once the job succeeds
     def create(self, request, *args, **kwargs):
         serializer = self.get_serializer(data=request.data)
         serializer.is_valid(raise_exception=True)
-        try:
-            add_domain(serializer.validated_data)
-        except Exception as e:
-            raise e
-        else:
-            self.perform_create(serializer)
-
-        return Response(serializer.data, status=status.HTTP_201_CREATED)
+        with transaction.atomic():
+            instance = serializer.save(is_active=False)
+            job = jobs.submit(
+                DomainJob.Operation.ADD, self.get_serializer(instance).data, instance
+            )
+        return self._accepted(request, job)
 
     # handles GETs for 1 Domain
     def retrieve(self, request, *args, **kwargs):
@@ -67,13 +78,32 @@ class DomainViewSet(
         return Response(serializer.data)
 
     # handles DELETEs for 1 Domain
+    # The domain is deactivated right away and deleted by a background job
     def destroy(self, request, *args, **kwargs):
         try:
             instance = self.get_object()
-            serializer = self.get_serializer(instance)
-            logger.info(f"domain destroy {serializer.data}")
-            delete_domain(serializer.data)
-            self.perform_destroy(instance)
         except Http404:
-            pass
-        return Response(status=status.HTTP_204_NO_CONTENT)
+            return Response(status=status.HTTP_204_NO_CONTENT)
+        serializer = self.get_serializer(instance)
+        logger.info(f"domain destroy {serializer.data}")
+        with transaction.atomic():
+            instance.is_active = False
+            instance.save()
+            job = jobs.submit(DomainJob.Operation.DELETE, serializer.data, instance)
+        return self._accepted(request, job)
+
+
+class DomainJobViewSet(GenericViewSet, ListModelMixin, RetrieveModelMixin):
+    serializer_class = DomainJobSerializer
+    queryset = DomainJob.objects.all()
+
+    # handles POSTs resuming a failed job from the step that failed
+    @action(detail=True, methods=["post"])
+    def retry(self, request, *args, **kwargs):
+        job = self.get_object()
+        if not jobs.retry(job):
+            return Response(
+                {"detail": f"Job is {job.status}"}, status=status.HTTP_409_CONFLICT
+            )
+        job.refresh_from_db()
+        return Response(self.get_serializer(job).data, status=status.HTTP_202_ACCEPTED)
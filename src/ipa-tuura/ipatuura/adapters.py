@@ -2,18 +2,111 @@
 # Copyright (C) 2022  FreeIPA Contributors see COPYING for license
 #
 
+import json
 import logging
+import re
 
-from django.contrib.auth.models import BaseUserManager
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
 from django.db import transaction
 from django_scim import exceptions
 from django_scim.adapters import SCIMGroup, SCIMUser
+from ipatuura import changelog, outbox
 from ipatuura.ipa import IPA
+from ipatuura.models import ChangeEvent, OutboxEntry, SSSDUserToUserModel
+from ipatuura.overlay import Overlay
+from ipatuura.sssd import SSSD, SSSDNotFoundException, SSSDUser
 
 logger = logging.getLogger(__name__)
 
 
+def _as_list(value):
+    """
+    Normalize a single or multi-valued attribute to a list of values
+    """
+    if not value:
+        return []
+    if isinstance(value, (list, tuple, set)):
+        return [v for v in value if v]
+    return [value]
+
+
+# Value-filtered path, e.g. emails[type eq "work"].value
+_FILTERED_PATH = re.compile(r"^(\w+)\[(.*)\](?:\.(\w+))?$")
+# One comparison of a value filter and the "or" joining it to the next one
+_FILTER_TERM = re.compile(
+    r'\s*(\w+)\s+eq\s+("(?:[^"\\]|\\.)*"|true|false)\s*(or\s+|$)', re.IGNORECASE
+)
+
+
+def _value_filter(path):
+    """
+    Parse the value filter of a PATCH path, e.g. members[value eq "123"]
+    or emails[type eq "work"].value
+
+    Only eq comparisons, possibly joined by or, are supported.
+
+    :param path: the AttrPath of the operation
+    :returns: None if the path has no filter, else a tuple (comparisons,
+              sub-attribute following the filter or None) where
+              comparisons is a list of (sub-attribute, value)
+    :raises BadRequestError: if the filter is not supported
+    """
+    if path is None or not path.is_complex:
+        return None
+    # AttrPath turns the path into a filter expression: path eq ""
+    raw = path.filter[: -len(' eq ""')].strip()
+    match = _FILTERED_PATH.match(raw)
+    if match is None:
+        raise exceptions.BadRequestError(
+            "Unsupported path {}".format(raw), scim_type="invalidPath"
+        )
+
+    expression = match.group(2)
+    comparisons = []
+    pos = 0
+    while True:
+        term = _FILTER_TERM.match(expression, pos)
+        if term is None:
+            raise exceptions.BadRequestError(
+                "Unsupported filter {}".format(expression), scim_type="invalidFilter"
+            )
+        literal = term.group(2)
+        if literal.lower() in ("true", "false"):
+            literal = literal.lower()
+        comparisons.append((term.group(1), json.loads(literal)))
+        if not term.group(3):
+            break
+        pos = term.end()
+    return comparisons, match.group(3)
+
+
+def _as_bool(value):
+    """
+    Coerce the "True" and "False" strings sent by some clients, e.g.
+    Azure AD, to booleans
+    """
+    if isinstance(value, str) and value.lower() in ("true", "false"):
+        return value.lower() == "true"
+    return value
+
+
+def local_password_policy():
+    """
+    Return the policy applied to the local copy of SCIM user passwords,
+    either "unusable" or "hash".
+    """
+    return getattr(settings, "IPATUURA_LOCAL_PASSWORD", "unusable")
+
+
 class SCIMUser(SCIMUser):
+    def __init__(self, obj, request=None):
+        super().__init__(obj, request)
+        # Snapshot of the directory attributes, used to send only the
+        # modified attributes to the writable interface
+        self._directory_state = self.directory_attrs()
+
     @property
     def meta(self):
         """
@@ -60,7 +153,7 @@ class SCIMUser(SCIMUser):
         self.obj.scim_external_id = d.get("externalId") or ""
         cleartext_password = d.get("password")
         if cleartext_password:
-            self.obj.set_password(cleartext_password)
+            # hashed once in save(), according to the local credential policy
             self.obj._scim_cleartext_password = cleartext_password
             self.password_changed = True
 
@@ -114,26 +207,184 @@ class SCIMUser(SCIMUser):
     def is_new_user(self):
         return not bool(self.obj.id)
 
+    def set_local_password(self, password):
+        """
+        Set the local password according to the local credential policy.
+
+        The password is validated against the directory, the local copy is
+        either unusable (default) or hashed once with IPATUURA_LOCAL_PASSWORD_HASHER.
+        """
+        if local_password_policy() == "hash" and password:
+            self.obj.password = make_password(
+                password,
+                hasher=getattr(settings, "IPATUURA_LOCAL_PASSWORD_HASHER", "default"),
+            )
+            self.obj._password = password
+        else:
+            self.obj.set_unusable_password()
+
+    def directory_attrs(self):
+        """
+        Return the directory attributes managed through SCIM,
+        as lists of values.
+        """
+        return {
+            "givenname": _as_list(self.obj.first_name),
+            "sn": _as_list(self.obj.last_name),
+            "mail": _as_list(self.obj.email),
+        }
+
+    def directory_changes(self):
+        """
+        Return the attribute-level diff against the directory state.
+
+        :returns: a dict mapping each modified attribute to a tuple
+                  (old values, new values), empty if nothing changed
+        """
+        changes = {}
+        for attr, values in self.directory_attrs().items():
+            old = self._directory_state.get(attr, [])
+            if values != old:
+                changes[attr] = (old, values)
+        return changes
+
+    def handle_operations(self, operations):
+        """
+        Apply all the PATCH operations to the user object, then save it
+        once so that only the resulting diff reaches the directory.
+        """
+        super().handle_operations(operations)
+        self.save()
+
+    def parse_path_and_values(self, path, value):
+        """
+        Return the paths and values of an operation, with active coerced
+        to a boolean.
+        """
+        return [
+            (p, _as_bool(v) if p.first_path == ("active", None, None) else v)
+            for p, v in super().parse_path_and_values(path, value)
+        ]
+
+    def _email_filter(self, path, operation):
+        """
+        Check a value-filtered path of the emails, e.g.
+        emails[type eq "work"].value
+
+        The directory holds a single address, matched by the work or the
+        primary email.
+
+        :returns: the sub-attribute following the filter, or None
+        :raises NotImplementedError: if the path does not target the emails
+        :raises BadRequestError: if the filter selects another email
+        """
+        comparisons, sub_attr = _value_filter(path)
+        if path.first_path[0] != "emails" or sub_attr not in (None, "value"):
+            raise exceptions.NotImplementedError(
+                "PATCH of {} is not implemented".format(operation.get("path"))
+            )
+        for attr, value in comparisons:
+            attr = attr.lower()
+            if not (
+                (attr == "type" and str(value).lower() == "work")
+                or (attr == "primary" and value is True)
+            ):
+                raise exceptions.BadRequestError(
+                    "Only the work email is supported", scim_type="invalidFilter"
+                )
+        return sub_attr
+
+    def handle_add(self, path, value, operation):
+        """
+        Handle add operations.
+        All the supported attributes are single-valued, add therefore
+        replaces the current value.
+        """
+        self.handle_replace(path, value, operation)
+
+    def handle_replace(self, path, value, operation):
+        """
+        Handle replace operations.
+        """
+        attr = path.first_path
+        if path.is_complex:
+            if self._email_filter(path, operation) == "value":
+                value = {"value": value}
+            self.parse_email(value)
+        elif attr == ("name", None, None) and isinstance(value, dict):
+            if "givenName" in value:
+                self.obj.first_name = value.get("givenName") or ""
+            if "familyName" in value:
+                self.obj.last_name = value.get("familyName") or ""
+        elif attr == ("userName", None, None):
+            if value != self.obj.scim_username:
+                raise exceptions.BadRequestError(
+                    "userName cannot be modified", scim_type="mutability"
+                )
+        elif attr == ("active", None, None):
+            self.parse_active(value)
+        elif attr == ("emails", None, None):
+            self.parse_email(value)
+        elif attr == ("externalId", None, None):
+            self.obj.scim_external_id = value or ""
+        elif attr == ("password", None, None):
+            self.obj._scim_cleartext_password = value
+            self.password_changed = True
+        elif attr in self.ATTR_MAP:
+            setattr(self.obj, self.ATTR_MAP[attr], value or "")
+        else:
+            raise exceptions.NotImplementedError(
+                "PATCH of {} is not implemented".format(operation.get("path"))
+            )
+
+    def handle_remove(self, path, value, operation):
+        """
+        Handle remove operations.
+        """
+        attr = path.first_path
+        if path.is_complex:
+            self._email_filter(path, operation)
+            self.obj.email = ""
+        elif attr == ("name", None, None):
+            self.obj.first_name = ""
+            self.obj.last_name = ""
+        elif attr == ("emails", None, None):
+            self.obj.email = ""
+        elif attr == ("externalId", None, None):
+            self.obj.scim_external_id = ""
+        elif attr in self.ATTR_MAP and attr not in (
+            ("userName", None, None),
+            ("active", None, None),
+        ):
+            setattr(self.obj, self.ATTR_MAP[attr], "")
+        else:
+            raise exceptions.BadRequestError(
+                "{} cannot be removed".format(operation.get("path")),
+                scim_type="mutability",
+            )
+
     def save(self):
-        ipa_if = IPA()
-        temp_password = None
-        if self.is_new_user:
-            password = getattr(self.obj, "_scim_cleartext_password", None)
-            # If temp password was not passed, create one.
-            if password is None:
-                self.obj.require_password_change = True
-                manager = BaseUserManager()
-                temp_password = manager.make_random_password()
-                password = temp_password
-            self.obj.set_password(password)
-            ipa_if.user_add(self)
+        if self.is_new_user or getattr(self, "password_changed", False):
+            # a new user without password gets an unusable local password
+            self.set_local_password(getattr(self.obj, "_scim_cleartext_password", None))
 
         is_new_user = self.is_new_user
-        if not is_new_user:
-            ipa_if.user_mod(self)
+        changes = None if is_new_user else self.directory_changes()
+        if outbox.enabled():
+            self._save_to_outbox(is_new_user, changes)
+            return
+
+        ipa_if = IPA(self.obj.username)
+        if is_new_user:
+            ipa_if.user_add(self)
+        elif changes:
+            ipa_if.user_mod(self, changes)
+        else:
+            logger.debug(f"No directory modification for user {self.obj.username}")
         try:
             with transaction.atomic():
                 super().save()
+                self._record_change(is_new_user, changes)
                 # if is_new_user:
                 #    # Set SCIM ID to be equal to database ID.
                 #    # Because users are uniquely identified with this value
@@ -143,18 +394,327 @@ class SCIMUser(SCIMUser):
                 logger.info(f"User saved. User id {self.obj.id}")
         except Exception as e:
             raise e
+        self._directory_state = self.directory_attrs()
+        if is_new_user or changes:
+            Overlay().record(self.to_sssd_user())
+
+    def directory_id(self):
+        """
+        Return the uidNumber of the user in the integration domain, or None
+        when SSSD does not know the user yet.
+
+        The id of the local User is only the uidNumber for the users read
+        from SSSD, the other ones are looked up by name.
+        """
+        uid_number = getattr(self.obj, "uid_number", None)
+        if uid_number is not None:
+            return uid_number
+        try:
+            return SSSD().find_user_by_name(self.obj.username).id
+        except SSSDNotFoundException:
+            return None
+        except Exception as e:
+            logger.debug(f"Unable to look up the uidNumber of {self.obj.username}: {e}")
+            return None
+
+    def to_sssd_user(self):
+        """
+        Return the SSSDUser matching the user written to the directory.
+        """
+        return SSSDUser(
+            self.directory_id(),
+            self.obj.username,
+            givenname=self.obj.first_name,
+            sn=self.obj.last_name,
+            mail=_as_list(self.obj.email),
+            active=self.obj.is_active,
+        )
+
+    def _save_to_outbox(self, is_new_user, changes):
+        """
+        Save the user locally and queue the directory write in the same
+        transaction, the write is applied later by the outbox worker.
+        """
+        with transaction.atomic():
+            super().save()
+            if is_new_user:
+                outbox.enqueue(OutboxEntry.Operation.ADD, self)
+            elif changes:
+                outbox.enqueue(OutboxEntry.Operation.MODIFY, self, changes)
+            self._record_change(is_new_user, changes)
+            logger.info(f"User saved. User id {self.obj.id}")
+        if is_new_user or changes:
+            _write_queued(self.request)
+        self._directory_state = self.directory_attrs()
+
+    def _record_change(self, is_new_user, changes):
+        """
+        Append the directory write to the change log
+        """
+        if not (is_new_user or changes):
+            return
+        changelog.record(
+            ChangeEvent.ResourceType.USER,
+            ChangeEvent.Operation.CREATE
+            if is_new_user
+            else ChangeEvent.Operation.UPDATE,
+            self.obj.username,
+            self.obj.scim_id,
+        )
+
+    def _record_delete(self):
+        changelog.record(
+            ChangeEvent.ResourceType.USER,
+            ChangeEvent.Operation.DELETE,
+            self.obj.username,
+            self.obj.scim_id,
+        )
 
     def delete(self):
         self.obj.is_active = False
-        ipa_if = IPA()
+        if outbox.enabled():
+            with transaction.atomic():
+                outbox.enqueue(OutboxEntry.Operation.DELETE, self)
+                self.obj.__class__.objects.filter(id=self.id).delete()
+                self._record_delete()
+            _write_queued(self.request)
+            return
+        # known to SSSD until the user is deleted
+        uid_number = self.directory_id()
+        ipa_if = IPA(self.obj.username)
         ipa_if.user_del(self)
-        self.obj.__class__.objects.filter(id=self.id).delete()
+        with transaction.atomic():
+            self.obj.__class__.objects.filter(id=self.id).delete()
+            self._record_delete()
+        Overlay().record_deleted(self.obj.username, uid_number)
+
+
+def _write_queued(request):
+    """
+    Flag the request so that the view acknowledges it with 202
+    """
+    if request is not None:
+        request.ipatuura_write_queued = True
 
 
 class SCIMGroup(SCIMGroup):
+    def __init__(self, obj, request=None):
+        super().__init__(obj, request)
+        # Snapshot of the group members, used to compute the membership diff
+        self._member_state = self.member_names()
+
     @property
     def display_name(self):
         """
         Return the displayName of the group per the SCIM spec.
         """
         return self.obj.scim_display_name
+
+    def member_names(self):
+        """
+        Return the set of user names member of the group.
+        """
+        return {user.scim_username for user in self.obj.user_set.all()}
+
+    def member_changes(self):
+        """
+        Return the membership diff against the directory state.
+
+        :returns: a tuple (added user names, removed user names)
+        """
+        current = self.member_names()
+        return current - self._member_state, self._member_state - current
+
+    @property
+    def group_name(self):
+        """
+        Return the name of the group in the integration domain.
+        """
+        return self.obj.scim_display_name or getattr(self.obj, "name", "")
+
+    def _find_members(self, value):
+        """
+        Return the User objects referenced by a list of SCIM member dicts.
+
+        Local users are fetched with a single query, the other members are
+        looked up in SSSD without retrieving their groups.
+        """
+        ids = [str(member.get("value")) for member in value or []]
+        users = {
+            user.scim_id: user
+            for user in get_user_model().objects.filter(scim_id__in=ids)
+        }
+        sssd_if = None
+        for id in ids:
+            if id in users:
+                continue
+            try:
+                sssd_if = sssd_if or SSSD()
+                sssduser = sssd_if.find_user_by_id(int(id))
+            except (SSSDNotFoundException, ValueError):
+                raise exceptions.BadRequestError("Can not find user {}".format(id))
+            users[id] = SSSDUserToUserModel(sssd_if, sssduser)
+        return [users[id] for id in ids]
+
+    def from_dict(self, d):
+        """
+        Consume a ``dict`` conforming to the SCIM Group Schema, updating the
+        internal group object and its members with data from the ``dict``.
+        """
+        super().from_dict(d)
+        self.obj.scim_display_name = self.obj.name
+        if "members" in d:
+            self.obj.user_set.set(self._find_members(d.get("members")))
+
+    def handle_operations(self, operations):
+        """
+        Apply all the PATCH operations to the group object, then save it
+        once so that only the resulting diff reaches the directory.
+        """
+        super().handle_operations(operations)
+        self.save()
+
+    def _member_filter(self, path, operation):
+        """
+        Check that an operation targets the members, and return the ids of
+        the members selected by its value filter, e.g. members[value eq "123"]
+
+        :returns: a set of member ids, or None if the path has no filter
+        :raises NotImplementedError: if the path does not target the members
+        :raises BadRequestError: if the filter is not on the member value
+        """
+        if path.first_path[0] != "members":
+            raise exceptions.NotImplementedError(
+                "PATCH of {} is not implemented".format(operation.get("path"))
+            )
+        filtered = _value_filter(path)
+        if filtered is None:
+            return None
+        comparisons, sub_attr = filtered
+        if sub_attr is not None or any(
+            attr.lower() != "value" for attr, _ in comparisons
+        ):
+            raise exceptions.BadRequestError(
+                "Members can only be filtered by value", scim_type="invalidFilter"
+            )
+        return {str(value) for _, value in comparisons}
+
+    def handle_add(self, path, value, operation):
+        """
+        Handle add operations.
+        """
+        if self._member_filter(path, operation) is not None:
+            raise exceptions.BadRequestError(
+                "Members cannot be added to a filter", scim_type="invalidPath"
+            )
+        members = list(self.obj.user_set.all())
+        names = {user.scim_username for user in members}
+        for user in self._find_members(value):
+            if user.scim_username not in names:
+                members.append(user)
+                names.add(user.scim_username)
+        self.obj.user_set.set(members)
+
+    def handle_remove(self, path, value, operation):
+        """
+        Handle remove operations.
+        A value filter, e.g. members[value eq "123"], selects the members
+        removed, as Azure AD and Okta send it.
+        """
+        ids = self._member_filter(path, operation)
+        if ids is not None:
+            self.obj.user_set.set(
+                [u for u in self.obj.user_set.all() if str(u.scim_id) not in ids]
+            )
+            return
+        if value is None:
+            self.obj.user_set.set([])
+            return
+        names = {user.scim_username for user in self._find_members(value)}
+        self.obj.user_set.set(
+            [u for u in self.obj.user_set.all() if u.scim_username not in names]
+        )
+
+    def handle_replace(self, path, value, operation):
+        """
+        Handle replace operations.
+        A value filter, e.g. members[value eq "123"], selects the members
+        replaced by the value.
+        """
+        if path.first_path == ("displayName", None, None):
+            if value != self.obj.scim_display_name:
+                raise exceptions.BadRequestError(
+                    "displayName cannot be modified", scim_type="mutability"
+                )
+            return
+        ids = self._member_filter(path, operation)
+        if ids is None:
+            self.obj.user_set.set(self._find_members(value))
+            return
+        members = [u for u in self.obj.user_set.all() if str(u.scim_id) not in ids]
+        names = {user.scim_username for user in members}
+        for user in self._find_members(_as_list(value)):
+            if user.scim_username not in names:
+                members.append(user)
+                names.add(user.scim_username)
+        self.obj.user_set.set(members)
+
+    def save(self):
+        is_new_group = not self.obj.id
+        added, removed = self.member_changes()
+        if not (is_new_group or added or removed):
+            logger.debug(f"No modification for group {self.group_name}")
+            return
+
+        queued = outbox.enabled()
+        if not queued:
+            # Membership changes are sent in batches of members
+            ipa_if = IPA(self.group_name)
+            if is_new_group:
+                ipa_if.group_add(self, sorted(added))
+            else:
+                if added:
+                    ipa_if.group_add_member(self, sorted(added))
+                if removed:
+                    ipa_if.group_remove_member(self, sorted(removed))
+        with transaction.atomic():
+            super().save()
+            if queued:
+                outbox.enqueue_group(
+                    OutboxEntry.Operation.ADD
+                    if is_new_group
+                    else OutboxEntry.Operation.MODIFY,
+                    self,
+                    added,
+                    removed,
+                )
+            changelog.record(
+                ChangeEvent.ResourceType.GROUP,
+                ChangeEvent.Operation.CREATE
+                if is_new_group
+                else ChangeEvent.Operation.UPDATE,
+                self.group_name,
+                self.obj.scim_id,
+            )
+            logger.info(f"Group saved. Group id {self.obj.id}")
+        if queued:
+            _write_queued(self.request)
+        self._member_state = self.member_names()
+
+    def delete(self):
+        queued = outbox.enabled()
+        if not queued:
+            ipa_if = IPA(self.group_name)
+            ipa_if.group_del(self)
+        with transaction.atomic():
+            if queued:
+                outbox.enqueue_group(OutboxEntry.Operation.DELETE, self)
+            self.obj.__class__.objects.filter(id=self.id).delete()
+            changelog.record(
+                ChangeEvent.ResourceType.GROUP,
+                ChangeEvent.Operation.DELETE,
+                self.group_name,
+                self.obj.scim_id,
+            )
+        if queued:
+            _write_queued(self.request)
@@ -0,0 +1,241 @@
+#
+# Copyright (C) 2023  FreeIPA Contributors see COPYING for license
+#
+
+import bisect
+import functools
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django_scim import exceptions
+from ipatuura.metrics import (
+    POOL_BUSY,
+    POOL_REJECTED,
+    POOL_SIZE,
+    POOL_WAIT_SECONDS,
+    POOL_WAITING,
+)
+from ipatuura.tracing import span
+
+logger = logging.getLogger(__name__)
+
+# Backends whose concurrent calls are limited
+INFOPIPE = "infopipe"
+IPA = "ipa"
+LDAP = "ldap"
+
+GATE_DEFAULTS = {
+    INFOPIPE: {"CONCURRENCY": 16, "MAX_QUEUE": 64, "TIMEOUT": 5},
+    IPA: {"CONCURRENCY": 8, "MAX_QUEUE": 32, "TIMEOUT": 10},
+    LDAP: {"CONCURRENCY": 8, "MAX_QUEUE": 32, "TIMEOUT": 10},
+}
+RETRY_AFTER = 1
+
+# Upper bounds in seconds of the queue wait histogram buckets
+WAIT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def retry_after():
+    """
+    Return the delay in seconds advertised to the rejected clients
+    """
+    return getattr(settings, "IPATUURA_ADMISSION", {}).get("RETRY_AFTER", RETRY_AFTER)
+
+
+class AdmissionException(exceptions.SCIMException):
+    """
+    Exception returned when a backend call is not admitted.
+    """
+
+    status = 503
+
+
+class BackendOverloadedException(AdmissionException):
+    """
+    Exception returned when too many calls already wait for a backend.
+    """
+
+    status = 429
+
+
+class BackendTimeoutException(AdmissionException):
+    """
+    Exception returned when a call waited too long for a backend.
+    """
+
+    status = 503
+
+
+class _Gate:
+    """
+    Limit the concurrent calls to a backend.
+
+    At most CONCURRENCY calls run at once, at most MAX_QUEUE more wait
+    for up to TIMEOUT seconds, the other calls are rejected at once.
+    A thread already admitted is not limited again by nested calls.
+    """
+
+    def __init__(self, name, concurrency, max_queue, timeout):
+        self.name = name
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(concurrency)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._waiting = 0
+        self._running = 0
+        self._counters = {"admitted": 0, "rejected": 0, "timeouts": 0}
+        self._wait = {"buckets": [0] * (len(WAIT_BUCKETS) + 1), "count": 0, "sum": 0.0}
+        self._busy_gauge = POOL_BUSY.labels(name)
+        self._waiting_gauge = POOL_WAITING.labels(name)
+        self._wait_histogram = POOL_WAIT_SECONDS.labels(name)
+        POOL_SIZE.labels(name).set(concurrency)
+
+    def _count(self, counter):
+        with self._lock:
+            self._counters[counter] += 1
+
+    def _acquire(self):
+        if self._slots.acquire(blocking=False):
+            return
+        with self._lock:
+            if self._waiting >= self.max_queue:
+                self._counters["rejected"] += 1
+                POOL_REJECTED.labels(self.name, "overloaded").inc()
+                raise BackendOverloadedException(
+                    f"Too many requests waiting for {self.name}"
+                )
+            self._waiting += 1
+        self._waiting_gauge.inc()
+        try:
+            with span(f"admission.wait.{self.name}"):
+                acquired = self._slots.acquire(timeout=self.timeout)
+        finally:
+            self._waiting_gauge.dec()
+            with self._lock:
+                self._waiting -= 1
+        if not acquired:
+            self._count("timeouts")
+            POOL_REJECTED.labels(self.name, "timeout").inc()
+            raise BackendTimeoutException(f"Timed out waiting for {self.name}")
+
+    @contextmanager
+    def admit(self):
+        """
+        Wait for a slot to call the backend.
+
+        :raises BackendOverloadedException: if too many calls are waiting
+        :raises BackendTimeoutException: if no slot was free in time
+        """
+        if getattr(self._local, "admitted", False):
+            yield
+            return
+
+        start = time.monotonic()
+        self._acquire()
+        waited = time.monotonic() - start
+        with self._lock:
+            self._counters["admitted"] += 1
+            self._running += 1
+            self._wait["buckets"][bisect.bisect_left(WAIT_BUCKETS, waited)] += 1
+            self._wait["count"] += 1
+            self._wait["sum"] += waited
+        self._wait_histogram.observe(waited)
+        self._busy_gauge.inc()
+        self._local.admitted = True
+        try:
+            yield
+        finally:
+            self._local.admitted = False
+            self._busy_gauge.dec()
+            with self._lock:
+                self._running -= 1
+            self._slots.release()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "concurrency": self.concurrency,
+                "running": self._running,
+                "waiting": self._waiting,
+                **self._counters,
+                "wait": {
+                    "buckets": list(self._wait["buckets"]),
+                    "count": self._wait["count"],
+                    "sum": self._wait["sum"],
+                },
+            }
+
+
+class _Admission:
+    """
+    Admission control of the calls to the backends shared by all the
+    clients: SSSD infopipe, IPA JSON-RPC and LDAP servers. The PAM
+    conversations are limited by the credential validation pool.
+    """
+
+    _instance = None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._gates = {}
+
+    def gate(self, backend):
+        """
+        Return the gate of a backend, configured from IPATUURA_ADMISSION
+        """
+        with self._lock:
+            gate = self._gates.get(backend)
+            if gate is None:
+                options = dict(GATE_DEFAULTS[backend])
+                options.update(
+                    getattr(settings, "IPATUURA_ADMISSION", {}).get(backend, {})
+                )
+                gate = _Gate(
+                    backend,
+                    options["CONCURRENCY"],
+                    options["MAX_QUEUE"],
+                    options["TIMEOUT"],
+                )
+                self._gates[backend] = gate
+            return gate
+
+    def admit(self, backend):
+        return self.gate(backend).admit()
+
+    def stats(self):
+        """
+        Return per backend the concurrency limit, the calls running and
+        waiting, the number of calls admitted, rejected and timed out,
+        and the histogram of the queue wait time of the admitted calls,
+        counted per bucket of WAIT_BUCKETS (plus one for the longer waits).
+        """
+        with self._lock:
+            gates = list(self._gates.values())
+        return {gate.name: gate.stats() for gate in gates}
+
+
+def Admission():
+    if _Admission._instance is None:
+        _Admission._instance = _Admission()
+    return _Admission._instance
+
+
+def admitted(backend):
+    """
+    Decorator limiting the concurrent calls of a function to a backend
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with Admission().admit(backend):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
@@ -2,8 +2,34 @@
 # Copyright (C) 2022  FreeIPA Contributors see COPYING for license
 #
 
+import os
+
 from django.apps import AppConfig
+from django.core.management import call_command
+
+
+def create_cache_tables(sender, using, **kwargs):
+    """
+    Create the tables of the database caches after the migrations, so
+    that "manage.py migrate" deploys them too.
+    """
+    call_command("createcachetable", database=using, verbosity=0)
 
 
 class IpaTuuraConfig(AppConfig):
     name = "ipatuura"
+
+    def ready(self):
+        from django.db.backends.signals import connection_created
+        from django.db.models.signals import post_migrate
+        from ipatuura.database import configure_connection
+        from ipatuura.prefork import after_fork
+
+        connection_created.connect(
+            configure_connection, dispatch_uid="ipatuura-configure-connection"
+        )
+        post_migrate.connect(
+            create_cache_tables, sender=self, dispatch_uid="ipatuura-cache-tables"
+        )
+        # the app may be loaded before the server forks its workers
+        os.register_at_fork(after_in_child=after_fork)
@@ -0,0 +1,252 @@
+#
+# Copyright (C) 2023  FreeIPA Contributors see COPYING for license
+#
+
+import hashlib
+import json
+import logging
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Count, Max, Min
+from django.utils import timezone
+from ipatuura.models import ChangeEvent
+from ipatuura.sssd import SSSD, SSSDNotFoundException
+
+logger = logging.getLogger(__name__)
+
+CHANGES_DEFAULTS = {
+    "MAX_EVENTS": 1000,
+    "LONG_POLL_TIMEOUT": 30,
+    "MAX_WAITERS": 0,
+    "POLL_INTERVAL": 0.5,
+    "SETTLE": 1,
+    "ENUMERATION_LIMIT": 100000,
+}
+
+
+def _option(name):
+    return getattr(settings, "IPATUURA_CHANGES", {}).get(name, CHANGES_DEFAULTS[name])
+
+
+def enumeration_limit():
+    """
+    Return the maximum number of users or groups enumerated by sync(),
+    wildcard_limit of the [ifp] section of sssd.conf must not be lower.
+    """
+    return _option("ENUMERATION_LIMIT")
+
+
+_waiters_lock = threading.Lock()
+_waiters = None
+
+
+def _waiter_slots():
+    """
+    Return the semaphore limiting the long-polls of the process to
+    MAX_WAITERS, created again when the setting changes.
+    """
+    global _waiters
+    size = _option("MAX_WAITERS")
+    with _waiters_lock:
+        if _waiters is None or _waiters[0] != size:
+            _waiters = (size, threading.BoundedSemaphore(size) if size else None)
+        return _waiters[1]
+
+
+def record(resource_type, operation, name, resource_id="", digest=""):
+    """
+    Append a change to the log, in the transaction of the change itself
+    so that a rolled back change is not reported.
+
+    :param resource_type: one of ChangeEvent.ResourceType
+    :param operation: one of ChangeEvent.Operation
+    :param name: userName or displayName of the resource
+    :param resource_id: SCIM id of the resource, if known
+    :param digest: digest of the resource as read from the directory
+    """
+    return ChangeEvent.objects.create(
+        resource_type=resource_type,
+        operation=operation,
+        name=name,
+        resource_id=resource_id or "",
+        digest=digest,
+    )
+
+
+def token():
+    """
+    Return the token of the latest change
+    """
+    return ChangeEvent.objects.aggregate(last=Max("id"))["last"] or 0
+
+
+def read(since, limit=None):
+    """
+    Return the changes following a token.
+
+    The changes younger than SETTLE seconds are held back: an id is
+    allocated when the change is written, a transaction committing late
+    could otherwise append a change behind a token already returned.
+
+    :param since: token of the last change received
+    :param limit: maximum number of changes, MAX_EVENTS by default
+    :returns: a tuple (list of ChangeEvent, token of the last one, whether
+              more changes follow)
+    """
+    limit = limit or _option("MAX_EVENTS")
+    settled = timezone.now() - timedelta(seconds=_option("SETTLE"))
+    events = list(
+        ChangeEvent.objects.filter(id__gt=since, created__lte=settled)[: limit + 1]
+    )
+    more = len(events) > limit
+    events = events[:limit]
+    return events, events[-1].id if events else since, more
+
+
+def wait(since, timeout, limit=None):
+    """
+    Like read(), but wait up to timeout seconds for a change when there
+    is none yet.
+
+    Each waiting request holds a thread of the worker. At most
+    MAX_WAITERS requests of the process wait at once, the others are
+    answered at once as by read() and poll again.
+    """
+    slots = _waiter_slots()
+    if slots is None or not slots.acquire(blocking=False):
+        return read(since, limit)
+    try:
+        deadline = time.monotonic() + min(timeout, _option("LONG_POLL_TIMEOUT"))
+        while True:
+            events, last, more = read(since, limit)
+            remaining = deadline - time.monotonic()
+            if events or remaining <= 0:
+                return events, last, more
+            time.sleep(min(_option("POLL_INTERVAL"), remaining))
+    finally:
+        slots.release()
+
+
+def stats():
+    """
+    Return the number of changes in the log and its tokens
+    """
+    return ChangeEvent.objects.aggregate(
+        changes=Count("id"), first=Min("id"), last=Max("id")
+    )
+
+
+def _latest(resource_type=None):
+    """
+    Return the ids of the latest change of each resource
+    """
+    events = ChangeEvent.objects.all()
+    if resource_type is not None:
+        events = events.filter(resource_type=resource_type)
+    return (
+        events.values("resource_type", "name").annotate(last=Max("id")).values("last")
+    )
+
+
+def compact():
+    """
+    Delete the changes superseded by a later change of the same resource.
+
+    The log then holds one change per resource: a consumer reading from
+    an old token still ends up with the current state, a creation
+    followed by updates being reported as the last update. The
+    deletions are kept, every token remains valid.
+
+    :returns: the number of changes deleted
+    """
+    deleted, _ = ChangeEvent.objects.exclude(id__in=_latest()).delete()
+    logger.info(f"changes: compacted {deleted} changes")
+    return deleted
+
+
+def _digest(*values):
+    return hashlib.sha256(json.dumps(values, default=str).encode("utf-8")).hexdigest()
+
+
+def _sync(resource_type, entries, fetch, complete=True):
+    latest = {
+        event.name: event
+        for event in ChangeEvent.objects.filter(id__in=_latest(resource_type))
+    }
+    counts = dict.fromkeys(ChangeEvent.Operation.values, 0)
+    seen = set()
+    for _, path in entries:
+        try:
+            resource_id, name, digest = fetch(path)
+        except SSSDNotFoundException:
+            continue
+        seen.add(name)
+        last = latest.get(name)
+        if last is None or last.operation == ChangeEvent.Operation.DELETE:
+            operation = ChangeEvent.Operation.CREATE
+        elif not last.digest:
+            # written through ipa-tuura, the directory state is now known
+            ChangeEvent.objects.filter(id=last.id).update(
+                resource_id=resource_id, digest=digest
+            )
+            continue
+        elif last.digest != digest:
+            operation = ChangeEvent.Operation.UPDATE
+        else:
+            continue
+        record(resource_type, operation, name, resource_id, digest)
+        counts[operation] += 1
+
+    # an empty enumeration is more likely an SSSD failure, and a truncated
+    # one misses resources still present
+    if entries and complete:
+        for name, last in latest.items():
+            if name not in seen and last.operation != ChangeEvent.Operation.DELETE:
+                record(
+                    resource_type, ChangeEvent.Operation.DELETE, name, last.resource_id
+                )
+                counts[ChangeEvent.Operation.DELETE] += 1
+    return counts
+
+
+def sync():
+    """
+    Record the changes made in the directory, outside of ipa-tuura.
+
+    The users and groups enumerated through SSSD are compared with the
+    digest of their latest change, the resources missing from the
+    enumeration are recorded as deleted. An enumeration reaching
+    enumeration_limit() may be truncated: its deletions are not recorded.
+
+    :returns: the number of changes recorded by resource type and operation
+    :raises SSSDNotFoundException: if the infopipe is not available
+    """
+    sssd_if = SSSD()
+
+    def user(path):
+        u = sssd_if.get_user(path)
+        digest = _digest(u.username, u.first_name, u.last_name, u.mail, u.active)
+        return str(u.id), str(u.username), digest
+
+    def group(path):
+        g = sssd_if.get_group(path, retrieve_members=True)
+        return str(g.id), str(g.name), _digest(g.name, sorted(g.members))
+
+    limit = enumeration_limit()
+    counts = {}
+    for resource_type, entries, fetch in (
+        (ChangeEvent.ResourceType.USER, sssd_if.list_users(limit=limit), user),
+        (ChangeEvent.ResourceType.GROUP, sssd_if.list_groups(limit=limit), group),
+    ):
+        complete = len(entries) < limit
+        if not complete:
+            logger.warning(
+                f"changes: {len(entries)} {resource_type}s enumerated, the "
+                f"enumeration may be truncated and the deletions are skipped"
+            )
+        counts[resource_type] = _sync(resource_type, entries, fetch, complete)
+    logger.info(f"changes: directory sync recorded {counts}")
+    return counts
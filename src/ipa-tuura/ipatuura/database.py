@@ -0,0 +1,34 @@
+#
+# Copyright (C) 2023  FreeIPA Contributors see COPYING for license
+#
+
+from django.conf import settings
+
+SQLITE_DEFAULTS = {
+    "JOURNAL_MODE": "WAL",
+    "SYNCHRONOUS": "NORMAL",
+    "BUSY_TIMEOUT": 20,
+    "TRANSACTION_MODE": "IMMEDIATE",
+}
+
+
+def _option(name):
+    return getattr(settings, "IPATUURA_SQLITE", {}).get(name, SQLITE_DEFAULTS[name])
+
+
+def configure_connection(sender, connection, **kwargs):
+    """
+    Apply the IPATUURA_SQLITE pragmas to each new SQLite connection.
+
+    In WAL mode the readers no longer block the writer, and a writer
+    waits up to BUSY_TIMEOUT seconds for the lock held by another worker
+    instead of failing with "database is locked". NORMAL synchronous
+    skips the fsync of each commit, a power loss may lose the last
+    transactions but does not corrupt the database.
+    """
+    if connection.vendor != "sqlite":
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f"PRAGMA journal_mode={_option('JOURNAL_MODE')}")
+        cursor.execute(f"PRAGMA synchronous={_option('SYNCHRONOUS')}")
+        cursor.execute(f"PRAGMA busy_timeout={int(_option('BUSY_TIMEOUT') * 1000)}")
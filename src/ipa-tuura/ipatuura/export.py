@@ -0,0 +1,85 @@
+#
+# Copyright (C) 2023  FreeIPA Contributors see COPYING for license
+#
+
+import logging
+from itertools import dropwhile
+
+from ipatuura import serializers
+from ipatuura.models import merge_pending_writes
+from ipatuura.sssd import SSSD, SSSDNotFoundException
+
+logger = logging.getLogger(__name__)
+
+NDJSON_CONTENT_TYPE = "application/x-ndjson"
+
+
+def _lines(entries, cursor, document):
+    """
+    Generate one JSON line per entry following the cursor
+
+    :param entries: list of (id, object path) sorted by id
+    :param cursor: id of the last entry received by the client, or None
+    :param document: function returning the SCIM document of an object
+                     path, None to skip it
+    """
+    if cursor is not None:
+        entries = dropwhile(lambda entry: entry[0] <= cursor, entries)
+    for id, path in entries:
+        try:
+            d = document(path)
+        except SSSDNotFoundException:
+            # removed since the enumeration
+            logger.debug(f"export: {path} not found")
+            continue
+        if d is not None:
+            yield serializers.dumps(d) + b"\n"
+
+
+def export_users(request, cursor=None):
+    """
+    Enumerate the users of the integration domains and return the
+    generator of their SCIM documents, as newline-delimited JSON.
+
+    Only the ids of the users are kept in memory, each user is looked
+    up when the client is ready to read it. The users are ordered by
+    id, an interrupted export resumes from the id of the last user
+    received.
+
+    :param cursor: id of the last user received, or None
+    :raises SSSDNotFoundException: if the infopipe is not available
+    """
+    sssd_if = SSSD()
+    locations = serializers.Locations(request)
+
+    def document(path):
+        sssduser = merge_pending_writes(sssd_if.get_user(path, retrieve_groups=True))
+        if sssduser is None:
+            # deletion pending in the outbox
+            return None
+        groups = serializers.directory_groups(sssd_if, sssduser.groups)
+        return serializers.user_to_dict(sssduser, groups, locations)
+
+    return _lines(sssd_if.list_users(), cursor, document)
+
+
+def export_groups(request, cursor=None):
+    """
+    Enumerate the groups of the integration domains and return the
+    generator of their SCIM documents, with their members, as
+    newline-delimited JSON. See export_users().
+
+    :param cursor: id of the last group received, or None
+    :raises SSSDNotFoundException: if the infopipe is not available
+    """
+    sssd_if = SSSD()
+    locations = serializers.Locations(request)
+
+    def document(path):
+        sssdgroup = sssd_if.get_group(path, retrieve_members=True)
+        members = serializers.directory_members(sssd_if, sssdgroup.members)
+        return serializers.group_to_dict(
+            sssdgroup.id, sssdgroup.name, members, locations
+        )
+
+    return _lines(sssd_if.list_groups(), cursor, document)
@@ -2,37 +2,33 @@
 # Copyright (C) 2022  FreeIPA Contributors see COPYING for license
 #
 
-import datetime
-import logging
-import os
-import uuid
-from decimal import Decimal
+import copy
 
-import domains
-import gssapi
-import ldap
-import ldap.modlist as modlist
-import six
-from cryptography import x509 as crypto_x509
-from cryptography.hazmat.primitives import serialization as x509
-from ipalib import api
-from ipalib.errors import EmptyModlist
-from ipalib.facts import is_ipa_client_configured
-from ipalib.install.kinit import kinit_keytab
-from ipalib.krb_utils import get_credentials_if_valid
-from ipapython import admintool
-from ipapython.dn import DN
-from ipapython.dnsutil import DNSName
-from ipapython.kerberos import Principal
+from django.utils.module_loading import import_string
+from ipatuura import admission
+from ipatuura.registry import Registry
+from ipatuura.sssd import invalidate_cache
+from ipatuura.tracing import traced
 
-if six.PY3:
-    unicode = str
+# Number of members added or removed per directory round trip
+GROUP_MEMBERS_BATCH_SIZE = 1000
 
+# Writable interface of each id provider. They are imported when a domain
+# of the provider is first written to: an ldap or ad deployment does not
+# load the FreeIPA client libraries.
+WRITERS = {
+    "ipa": "ipatuura.ipa_writer.IPAAPI",
+    "ldap": "ipatuura.ldap_writer.LDAP",
+    "ad": "ipatuura.ldap_writer.AD",
+}
 
-logger = logging.getLogger(__name__)
 
-
-LDAP_GENERALIZED_TIME_FORMAT = "%Y%m%d%H%M%SZ"
+def _batches(values, size=GROUP_MEMBERS_BATCH_SIZE):
+    """
+    Split a list of values into batches of at most size values
+    """
+    for i in range(0, len(values), size):
+        yield values[i : i + size]
 
 
 class LDAPNotFoundException(Exception):
@@ -43,563 +39,136 @@ class LDAPNotFoundException(Exception):
     pass
 
 
-class IPANotFoundException(Exception):
+class LDAPWriteException(Exception):
     """
-    Exception returned when an IPA user or group is not found.
+    Exception returned when an LDAP server rejects a write.
     """
 
     pass
 
 
-class IPAAPI(admintool.AdminTool):
+class IPANotFoundException(Exception):
     """
-    Initialization of the IPA API writable interface
+    Exception returned when an IPA user or group is not found.
     """
 
-    def __init__(self):
-        """
-        Initialize IPA API.
-        Set IPA API execution client context
-        """
-        if not is_ipa_client_configured():
-            logger.error("IPA client is not configured on this system.")
-            raise admintool.ScriptError()
-
-        self._conn = None
-        self._backend = None
-        self._context = "client"
-        self._ccache_dir = None
-        self._ccache_name = None
-        self._ipa_connect()
-
-    def _ipa_connect(self):
-        """
-        Initialize IPA API
-        """
-        base_config = dict(context=self._context, in_server=False, debug=False)
-        try:
-            self._valid_creds()
-        except Exception as e:
-            logger.error(f"Failed to find default ccache {e}")
-
-        try:
-            api.bootstrap(**base_config)
-            if not api.isdone("finalize"):
-                api.finalize()
-        except Exception as e:
-            logger.info(f"bootstrap already done {e}")
-
-        self._backend = api.Backend.rpcclient
-        if not self._backend.isconnected():
-            self._backend.connect(ccache=os.environ.get("KRB5CCNAME", None))
-
-    def _valid_creds(self):
-        # try GSSAPI first
-        if "KRB5CCNAME" in os.environ:
-            ccache = os.environ["KRB5CCNAME"]
-            logger.info(f"ipa: init KRB5CCNAME set to {ccache}")
-
-            try:
-                cred = gssapi.Credentials(usage="initiate", store={"ccache": ccache})
-            except gssapi.raw.misc.GSSError as e:
-                logger.error(f"Failed to find default ccache {e}")
-            else:
-                logger.info(f"Using principal {cred.name}")
-                return True
-
-        # KRB5_CLIENT_KTNAME os env is defined in settings.py
-        elif "KRB5_CLIENT_KTNAME" in os.environ:
-            keytab = os.environ.get("KRB5_CLIENT_KTNAME", None)
-            logger.info(f"KRB5_CLIENT_KTNAME set to {keytab}")
-            ccache_name = "MEMORY:%s" % str(uuid.uuid4())
-            os.environ["KRB5CCNAME"] = ccache_name
-
-            try:
-                logger.info("kinit keytab")
-                cred = kinit_keytab(
-                    domains.models.Domain.objects.last().client_id, keytab, ccache_name
-                )
-            except gssapi.raw.misc.GSSError as e:
-                logger.error(f"Kerberos authentication failed {e}")
-            else:
-                logger.info(f"Using principal {cred.name}")
-                return True
-
-        creds = get_credentials_if_valid()
-        if (
-            creds
-            and creds.lifetime > 0
-            and "%s@" % domains.models.Domain.objects.last().client_id
-            in creds.name.display_as(creds.name.name_type)
-        ):
-            return True
-        return False
-
-    def add(self, scim_user):
-        """
-        Add a new user
-
-        :param scim_user: user object conforming to the SCIM User Schema
-        """
-        self._ipa_connect()
-        result = api.Command["user_add"](
-            uid=scim_user.obj.username,
-            givenname=scim_user.obj.first_name,
-            sn=scim_user.obj.last_name,
-            mail=scim_user.obj.email,
-        )
-        logger.info(f"ipa user_add result {result}")
-
-    def modify(self, scim_user):
-        """
-        Modify user
-
-        :param scim_user: user object conforming to the SCIM User Schema
-        :raises IPANotFoundException: if no user matching the username exists
-        """
-        self._ipa_connect()
-        try:
-            result = api.Command["user_mod"](
-                scim_user.obj.username,
-                givenname=scim_user.obj.first_name,
-                sn=scim_user.obj.last_name,
-                mail=scim_user.obj.email,
-            )
-        except EmptyModlist:
-            logger.debug("No modification for user {}".format(scim_user.obj.username))
-            return
-        except Exception:
-            raise IPANotFoundException(
-                "User {} not found".format(scim_user.obj.username)
-            )
-        logger.info(f"ipa: user_mod result {result}")
-
-    def delete(self, scim_user):
-        """
-        Delete user
-
-        :param scim_user: user object conforming to the SCIM User Schema
-        :raises IPANotFoundException: if no user matching the username exists
-        """
-        self._ipa_connect()
-        try:
-            result = api.Command["user_del"](uid=scim_user.obj.username)
-        except Exception:
-            raise IPANotFoundException(
-                "User {} not found".format(scim_user.obj.username)
-            )
-        logger.info(f"ipa: user_del result {result}")
+    pass
 
 
-class LDAP:
+class _IPA:
     """
-    Initialization of the LDAP writable interface
+    Writable interface of an integration domain, use IPA() to get the
+    one of the domain serving a user or group.
     """
 
-    def __init__(self):
-        self._conn = None
-        self._dn = None
-        self._users_dn = None
-        self._ldap_uri = None
-        self._ldap_search_base = None
-        self._ldap_user_extra_attrs = None
-        self._user_object_classes = None
-        # TLS
-        self._ldap_tls_cacert = None
-        self._sasl_gssapi = ldap.sasl.sasl({}, "GSSAPI")
-        self._client_id = None
-        self._client_secret = None
-        # init and connect
-        self._fetch_domain()
-        self._conn = self._bind()
-
-    def _fetch_domain(self):
-        """
-        Fetch relevant information from the integration domain
-        """
-        domain = domains.models.Domain.objects.last()
-        suffix = domain.name.split(".")
-
-        self._dn = domain.client_id
-        self._ldap_uri = domain.integration_domain_url
-        self._ldap_user_extra_attrs = domain.user_extra_attrs
-        self._ldap_search_base = "dc=" + suffix[0] + ", dc=" + suffix[1]
-        self._ldap_tls_cacert = domain.ldap_tls_cacert
-        self._client_id = domain.client_id
-        self._client_secret = domain.client_secret
-        self._users_dn = domain.users_dn
-        self._user_object_classes = [
-            x.strip() for x in domain.user_object_classes.split(",")
-        ]
-
-        logger.info(f"Domain info: {domain}")
-
-    def _bind(self):
-        """
-        Bind to ldap server
-        """
-        self._fetch_domain()
-        # TODO enable TLS support
-        # self._conn = ldap.initialize(self._ldap_uri)
-        # self._conn.set_option(ldap.OPT_X_TLS_CACERTFILE, self._tls_cacert)
-        # self._conn.sasl_interactive_bind_s('', self._sasl_gssapi)
-        self._conn = ldap.initialize(self._ldap_uri)
-        self._conn.protocol_version = 3
-        self._conn.set_option(ldap.OPT_REFERRALS, 0)
-        try:
-            self._conn.simple_bind_s(self._dn, self._client_secret)
-        except Exception as e:
-            logger.error(f"Unable to bind to LDAP server {e}")
-        else:
-            return self._conn
-
-    def encode(self, val):
-        """
-        Encode attribute value to LDAP representation (str/bytes)
+    def __init__(self, domain):
         """
-        # Booleans are both an instance of bool and int, therefore
-        # test for bool before int otherwise the int clause will be
-        # entered for a boolean value instead of the boolean clause.
-        if isinstance(val, bool):
-            if val:
-                return b"TRUE"
-            else:
-                return b"FALSE"
-        elif isinstance(val, (unicode, int, Decimal, DN, Principal)):
-            return str(val).encode("utf-8")
-        elif isinstance(val, DNSName):
-            return val.to_text().encode("ascii")
-        elif isinstance(val, bytes):
-            return val
-        elif isinstance(val, list):
-            return [self.encode(m) for m in val]
-        elif isinstance(val, tuple):
-            return tuple(self.encode(m) for m in val)
-        elif isinstance(val, dict):
-            # key in dict must be str not bytes
-            dct = dict((k, self.encode(v)) for k, v in val.items())
-            return dct
-        elif isinstance(val, datetime.datetime):
-            return val.strftime(LDAP_GENERALIZED_TIME_FORMAT).encode("utf-8")
-        elif isinstance(val, crypto_x509.Certificate):
-            return val.public_bytes(x509.Encoding.DER)
-        elif val is None:
-            return None
-        else:
-            raise TypeError(
-                "attempt to pass unsupported type to ldap, "
-                "value=%s type=%s" % (val, type(val))
-            )
-
-    def add(self, scim_user):
-        """
-        Add a new user
-
-        :param scim_user: user object conforming to the SCIM User Schema
-        For a RHDS deployment:
-        dc=ipa,dc=com
-          cn=accounts
-            cn=users
-              uid=oneuser
-        """
-        # TODO: implement dynamic list based on _ldap_user_extra_attrs
-        attrs = {}
-        attrs["cn"] = self.encode(scim_user.obj.username)
-        attrs["sn"] = self.encode(scim_user.obj.last_name)
-        attrs["givenname"] = self.encode(scim_user.obj.first_name)
-        attrs["mail"] = self.encode(scim_user.obj.email)
-        attrs["objectClass"] = self.encode(self._user_object_classes)
-        ldif = modlist.addModlist(attrs)
-
-        self._bind()
-        try:
-            # AD: cn, LDAP: uid
-            self._conn.add_s(
-                "uid={uid},{usersdn},{basedn}".format(
-                    uid=scim_user.obj.username,
-                    usersdn=self._users_dn,
-                    basedn=self._ldap_search_base,
-                ),
-                ldif,
-            )
-        except ldap.LDAPError as e:
-            desc = e.args[0]["desc"].strip()
-            info = e.args[0].get("info", "").strip()
-            logger.error(f"LDAP Error: {desc}: {info}")
-
-    def modify(self, scim_user):
-        """
-        Modify user
-
-        :param scim_user: user object conforming to the SCIM User Schema
+        Initialize writable interface
         """
-        dn = "uid={uid},{usersdn},{basedn}".format(
-            uid=scim_user.obj.username,
-            usersdn=self._users_dn,
-            basedn=self._ldap_search_base,
+        self.domain = domain
+        self._apiconn = self._write(domain)
+        self._gate = admission.Admission().gate(
+            admission.IPA if domain.id_provider == "ipa" else admission.LDAP
         )
 
-        sn = self.encode(scim_user.obj.last_name)
-        givenname = self.encode(scim_user.obj.first_name)
-        mail = self.encode(scim_user.obj.email)
-
-        mod_attrs = [
-            (ldap.MOD_REPLACE, "sn", sn),
-            (ldap.MOD_REPLACE, "givenname", givenname),
-            (ldap.MOD_REPLACE, "mail", mail),
-        ]
-
-        self._bind()
-        try:
-            self._conn.modify_ext_s(dn, mod_attrs)
-        except ldap.TYPE_OR_VALUE_EXISTS:
-            pass
-        except ldap.NO_SUCH_OBJECT:
-            raise LDAPNotFoundException(
-                "User {} not found".format(scim_user.obj.username)
-            )
-
-    def delete(self, scim_user):
-        """
-        Delete user
-
-        :param scim_user: user object conforming to the SCIM User Schema
-        """
-        self._bind()
-        try:
-            self._conn.delete_s(
-                "uid={uid},{usersdn},{basedn}".format(
-                    uid=scim_user.obj.username,
-                    usersdn=self._users_dn,
-                    basedn=self._ldap_search_base,
-                )
-            )
-        except ldap.LDAPError as e:
-            desc = e.args[0]["desc"].strip()
-            info = e.args[0].get("info", "").strip()
-            logger.error(f"LDAP Error: {desc}: {info}")
-
-
-class AD:
-    """
-    Initialization of the LDAP AD writable interface
-    """
-
-    def __init__(self):
-        self._conn = None
-        self._dn = None
-        self._users_dn = None
-        self._ldap_uri = None
-        self._ldap_search_base = None
-        self._ldap_user_extra_attrs = None
-        self._user_object_classes = None
-        # TLS
-        self._ldap_tls_cacert = None
-        self._sasl_gssapi = ldap.sasl.sasl({}, "GSSAPI")
-        self._client_id = None
-        self._client_secret = None
-        # init and connect
-        self._fetch_domain()
-        self._conn = self._bind()
-
-    def _fetch_domain(self):
-        """
-        Fetch relevant information from the integration domain
+    def _write(self, domain):
         """
-        domain = domains.models.Domain.objects.last()
-        suffix = domain.name.split(".")
-
-        self._dn = domain.client_id + "@" + domain.name
-        self._ldap_uri = domain.integration_domain_url
-        self._ldap_user_extra_attrs = domain.user_extra_attrs
-        self._ldap_search_base = "dc=" + suffix[0] + ", dc=" + suffix[1]
-        self._ldap_tls_cacert = domain.ldap_tls_cacert
-        self._client_id = domain.client_id
-        self._client_secret = domain.client_secret
-        self._users_dn = domain.users_dn
-        self._user_object_classes = [
-            x.strip() for x in domain.user_object_classes.split(",")
-        ]
-        logger.info(f"Domain info: {domain}")
-
-    def _bind(self):
-        """
-        Bind to ldap server
-        """
-        self._fetch_domain()
-        # TODO enable TLS support
-        # self._conn = ldap.initialize(self._ldap_uri)
-        # self._conn.set_option(ldap.OPT_X_TLS_CACERTFILE, self._tls_cacert)
-        # self._conn.sasl_interactive_bind_s('', self._sasl_gssapi)
-        self._conn = ldap.initialize(self._ldap_uri)
-        self._conn.protocol_version = 3
-        self._conn.set_option(ldap.OPT_REFERRALS, 0)
-        try:
-            self._conn.simple_bind_s(self._dn, self._client_secret)
-        except Exception as e:
-            logger.error(f"Unable to bind to LDAP server {e}")
-        else:
-            return self._conn
-
-    def encode(self, val):
-        """
-        Encode attribute value to LDAP representation (str/bytes)
-        """
-        # Booleans are both an instance of bool and int, therefore
-        # test for bool before int otherwise the int clause will be
-        # entered for a boolean value instead of the boolean clause.
-        if isinstance(val, bool):
-            if val:
-                return b"TRUE"
-            else:
-                return b"FALSE"
-        elif isinstance(val, (unicode, int, Decimal, DN, Principal)):
-            return str(val).encode("utf-8")
-        elif isinstance(val, DNSName):
-            return val.to_text().encode("ascii")
-        elif isinstance(val, bytes):
-            return val
-        elif isinstance(val, list):
-            return [self.encode(m) for m in val]
-        elif isinstance(val, tuple):
-            return tuple(self.encode(m) for m in val)
-        elif isinstance(val, dict):
-            # key in dict must be str not bytes
-            dct = dict((k, self.encode(v)) for k, v in val.items())
-            return dct
-        elif isinstance(val, datetime.datetime):
-            return val.strftime(LDAP_GENERALIZED_TIME_FORMAT).encode("utf-8")
-        elif isinstance(val, crypto_x509.Certificate):
-            return val.public_bytes(x509.Encoding.DER)
-        elif val is None:
-            return None
-        else:
-            raise TypeError(
-                "attempt to pass unsupported type to ldap, "
-                "value=%s type=%s" % (val, type(val))
-            )
-
-    def add(self, scim_user):
-        """
-        Add a new user
-
-        :param scim_user: user object conforming to the SCIM User Schema
-
-        For an AD deployment:
-        dc=ad,dc=com
-          cn=users
-            cn=oneuser
+        Factory Method
         """
-        # TODO: implement dynamic list based on _ldap_user_extra_attrs
-        attrs = {}
-        attrs["objectclass"] = self.encode(self._user_object_classes)
-        attrs["cn"] = self.encode(scim_user.obj.username)
-        attrs["mail"] = self.encode(scim_user.obj.email)
-        attrs["givenname"] = self.encode(scim_user.obj.first_name)
-        attrs["sn"] = self.encode(scim_user.obj.last_name)
-        ldif = modlist.addModlist(attrs)
-
-        self._bind()
-        try:
-            # AD: cn, LDAP: uid
-            self._conn.add_s(
-                "cn={cn},{usersdn},{basedn}".format(
-                    cn=scim_user.obj.username,
-                    usersdn=self._users_dn,
-                    basedn=self._ldap_search_base,
-                ),
-                ldif,
-            )
-        except ldap.LDAPError as e:
-            desc = e.args[0]["desc"].strip()
-            info = e.args[0].get("info", "").strip()
-            logger.error(f"LDAP Error: {desc}: {info}")
+        return import_string(WRITERS[domain.id_provider])(domain)
 
-    def modify(self, scim_user):
+    def _short_name(self, name):
         """
-        Modify user
-
-        :param scim_user: user object conforming to the SCIM User Schema
+        Strip the suffix routing a name to the domain, see Registry.route(),
+        the domain only knows the name without it.
         """
-        dn = "cn={cn},{usersdn},{basedn}".format(
-            cn=scim_user.obj.username,
-            usersdn=self._users_dn,
-            basedn=self._ldap_search_base,
-        )
+        if name and "@" in name:
+            short, suffix = name.rsplit("@", 1)
+            if suffix.lower() == self.domain.name.lower():
+                return short
+        return name
 
-        sn = self.encode(scim_user.obj.last_name)
-        givenname = self.encode(scim_user.obj.first_name)
-        mail = self.encode(scim_user.obj.email)
-
-        mod_attrs = [
-            (ldap.MOD_REPLACE, "sn", sn),
-            (ldap.MOD_REPLACE, "givenname", givenname),
-            (ldap.MOD_REPLACE, "mail", mail),
-        ]
-
-        self._bind()
-        try:
-            self._conn.modify_ext_s(dn, mod_attrs)
-        except ldap.TYPE_OR_VALUE_EXISTS:
-            pass
-        except ldap.NO_SUCH_OBJECT:
-            raise LDAPNotFoundException(
-                "User {} not found".format(scim_user.obj.username)
-            )
-
-    def delete(self, scim_user):
+    def _renamed(self, scim_object, field, name):
         """
-        Delete user
-
-        :param scim_user: user object conforming to the SCIM User Schema
+        Return a copy of a SCIM user or group adapter, whose object has
+        its field set to name.
         """
-        self._bind()
-        try:
-            self._conn.delete_s(
-                "cn={uid},{usersdn},{basedn}".format(
-                    uid=scim_user.obj.username,
-                    usersdn=self._users_dn,
-                    basedn=self._ldap_search_base,
-                )
-            )
-        except ldap.LDAPError as e:
-            desc = e.args[0]["desc"].strip()
-            info = e.args[0].get("info", "").strip()
-            logger.error(f"LDAP Error: {desc}: {info}")
+        scim_object = copy.copy(scim_object)
+        scim_object.obj = copy.copy(scim_object.obj)
+        setattr(scim_object.obj, field, name)
+        return scim_object
 
+    def _user(self, scim_user):
+        name = self._short_name(scim_user.obj.username)
+        if name == scim_user.obj.username:
+            return scim_user
+        return self._renamed(scim_user, "scim_username", name)
 
-class _IPA:
-    _instance = None
+    def _group(self, scim_group):
+        name = self._short_name(scim_group.group_name)
+        if name == scim_group.group_name:
+            return scim_group
+        return self._renamed(scim_group, "scim_display_name", name)
 
-    def __init__(self):
-        """
-        Initialize writable interface
-        """
-        self._apiconn = self._write(domains.models.Domain.objects.last().id_provider)
-
-    def _write(self, iface="ipa"):
-        """
-        Factory Method
-        """
-        ifaces = {
-            "ipa": IPAAPI,
-            "ldap": LDAP,
-            "ad": AD,
-        }
-        return ifaces[iface]()
+    def _members(self, members):
+        return [self._short_name(m) for m in members]
 
     # CRUD Operations
+    # Each write waits for a slot at the gate of its backend, then
+    # invalidates the SSSD cache entry of the modified object
+    @traced("writer.user_add")
     def user_add(self, scim_user):
-        self._apiconn.add(scim_user)
+        with self._gate.admit(), Registry().measure(self.domain):
+            self._apiconn.add(self._user(scim_user))
+        invalidate_cache(user=scim_user.obj.username)
 
-    def user_mod(self, scim_user):
-        self._apiconn.modify(scim_user)
+    @traced("writer.user_mod")
+    def user_mod(self, scim_user, changes=None):
+        with self._gate.admit(), Registry().measure(self.domain):
+            self._apiconn.modify(self._user(scim_user), changes)
+        invalidate_cache(user=scim_user.obj.username)
 
+    @traced("writer.user_del")
     def user_del(self, scim_user):
-        self._apiconn.delete(scim_user)
+        with self._gate.admit(), Registry().measure(self.domain):
+            self._apiconn.delete(self._user(scim_user))
+        invalidate_cache(user=scim_user.obj.username)
+
+    @traced("writer.group_add")
+    def group_add(self, scim_group, members=()):
+        with self._gate.admit(), Registry().measure(self.domain):
+            self._apiconn.group_add(self._group(scim_group), self._members(members))
+        invalidate_cache(group=scim_group.group_name)
+
+    @traced("writer.group_del")
+    def group_del(self, scim_group):
+        with self._gate.admit(), Registry().measure(self.domain):
+            self._apiconn.group_delete(self._group(scim_group))
+        invalidate_cache(group=scim_group.group_name)
+
+    @traced("writer.group_add_member")
+    def group_add_member(self, scim_group, members):
+        with self._gate.admit(), Registry().measure(self.domain):
+            self._apiconn.group_add_members(
+                self._group(scim_group), self._members(members)
+            )
+        invalidate_cache(group=scim_group.group_name)
+
+    @traced("writer.group_remove_member")
+    def group_remove_member(self, scim_group, members):
+        with self._gate.admit(), Registry().measure(self.domain):
+            self._apiconn.group_remove_members(
+                self._group(scim_group), self._members(members)
+            )
+        invalidate_cache(group=scim_group.group_name)
 
 
-def IPA():
-    if _IPA._instance is None:
-        _IPA._instance = _IPA()
-    return _IPA._instance
+def IPA(name=None):
+    """
+    Return the writable interface of the domain serving a user or group.
+
+    :param name: a user or group name, qualified names are routed to their
+                 domain, the others to the default domain
+    """
+    registry = Registry()
+    return registry.writer(registry.route(name))
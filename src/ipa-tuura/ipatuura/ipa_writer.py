@@ -0,0 +1,254 @@
+#
+# Copyright (C) 2023  FreeIPA Contributors see COPYING for license
+#
+
+import logging
+import os
+import uuid
+
+import gssapi
+from ipalib import api
+from ipalib.errors import EmptyModlist, NotFound
+from ipalib.facts import is_ipa_client_configured
+from ipalib.install.kinit import kinit_keytab
+from ipalib.krb_utils import get_credentials_if_valid
+from ipapython import admintool
+from ipatuura.ipa import IPANotFoundException, _batches
+from ipatuura.mapping import attribute_map
+from ipatuura.metrics import IPA_SECONDS
+from ipatuura.tracing import KIND_CLIENT, span
+
+logger = logging.getLogger(__name__)
+
+
+def _ipa_value(values):
+    """
+    Convert a list of attribute values to an IPA API option value,
+    None meaning that the attribute is deleted.
+    """
+    if not values:
+        return None
+    if len(values) == 1:
+        return values[0]
+    return values
+
+
+class IPAAPI(admintool.AdminTool):
+    """
+    Initialization of the IPA API writable interface
+    """
+
+    def __init__(self, domain):
+        """
+        Initialize IPA API.
+        Set IPA API execution client context
+
+        The IPA API is bound to the realm the host is enrolled in,
+        hence only one IPA integration domain can be served.
+
+        :param domain: the integration domain
+        """
+        if not is_ipa_client_configured():
+            logger.error("IPA client is not configured on this system.")
+            raise admintool.ScriptError()
+
+        self._conn = None
+        self._backend = None
+        self._context = "client"
+        self._ccache_dir = None
+        self._ccache_name = None
+        self._domain = domain
+        self._attribute_map = attribute_map(domain.user_extra_attrs, ipa_api=True)
+        self._ipa_connect()
+
+    def _ipa_connect(self):
+        """
+        Initialize IPA API
+        """
+        base_config = dict(context=self._context, in_server=False, debug=False)
+        try:
+            self._valid_creds()
+        except Exception as e:
+            logger.error(f"Failed to find default ccache {e}")
+
+        try:
+            api.bootstrap(**base_config)
+            if not api.isdone("finalize"):
+                api.finalize()
+        except Exception as e:
+            logger.info(f"bootstrap already done {e}")
+
+        self._backend = api.Backend.rpcclient
+        if not self._backend.isconnected():
+            self._backend.connect(ccache=os.environ.get("KRB5CCNAME", None))
+
+    def _valid_creds(self):
+        # try GSSAPI first
+        if "KRB5CCNAME" in os.environ:
+            ccache = os.environ["KRB5CCNAME"]
+            logger.info(f"ipa: init KRB5CCNAME set to {ccache}")
+
+            try:
+                cred = gssapi.Credentials(usage="initiate", store={"ccache": ccache})
+            except gssapi.raw.misc.GSSError as e:
+                logger.error(f"Failed to find default ccache {e}")
+            else:
+                logger.info(f"Using principal {cred.name}")
+                return True
+
+        # KRB5_CLIENT_KTNAME os env is defined in settings.py
+        elif "KRB5_CLIENT_KTNAME" in os.environ:
+            keytab = os.environ.get("KRB5_CLIENT_KTNAME", None)
+            logger.info(f"KRB5_CLIENT_KTNAME set to {keytab}")
+            ccache_name = "MEMORY:%s" % str(uuid.uuid4())
+            os.environ["KRB5CCNAME"] = ccache_name
+
+            try:
+                logger.info("kinit keytab")
+                cred = kinit_keytab(self._domain.client_id, keytab, ccache_name)
+            except gssapi.raw.misc.GSSError as e:
+                logger.error(f"Kerberos authentication failed {e}")
+            else:
+                logger.info(f"Using principal {cred.name}")
+                return True
+
+        creds = get_credentials_if_valid()
+        if (
+            creds
+            and creds.lifetime > 0
+            and "%s@" % self._domain.client_id
+            in creds.name.display_as(creds.name.name_type)
+        ):
+            return True
+        return False
+
+    def _command(self, name, *args, **kwargs):
+        """
+        Run an IPA command, record its latency and a span
+        """
+        with IPA_SECONDS.labels(name).time(), span(f"ipa.{name}", KIND_CLIENT):
+            return api.Command[name](*args, **kwargs)
+
+    def add(self, scim_user):
+        """
+        Add a new user
+
+        :param scim_user: user object conforming to the SCIM User Schema
+        """
+        self._ipa_connect()
+        result = self._command(
+            "user_add",
+            uid=scim_user.obj.username,
+            **self._attribute_map.entry(scim_user.obj),
+        )
+        logger.info(f"ipa user_add result {result}")
+
+    def modify(self, scim_user, changes=None):
+        """
+        Modify user
+
+        :param scim_user: user object conforming to the SCIM User Schema
+        :param changes: optional attribute-level diff, only the modified
+                        attributes are sent when provided
+        :raises IPANotFoundException: if no user matching the username exists
+        """
+        if changes is None:
+            kwargs = self._attribute_map.entry(scim_user.obj)
+        else:
+            kwargs = {
+                attr: _ipa_value(new)
+                for attr, (old, new) in self._attribute_map.changes(changes).items()
+            }
+        if not kwargs:
+            logger.debug("No modification for user {}".format(scim_user.obj.username))
+            return
+
+        self._ipa_connect()
+        try:
+            result = self._command("user_mod", scim_user.obj.username, **kwargs)
+        except EmptyModlist:
+            logger.debug("No modification for user {}".format(scim_user.obj.username))
+            return
+        except Exception:
+            raise IPANotFoundException(
+                "User {} not found".format(scim_user.obj.username)
+            )
+        logger.info(f"ipa: user_mod result {result}")
+
+    def delete(self, scim_user):
+        """
+        Delete user
+
+        :param scim_user: user object conforming to the SCIM User Schema
+        :raises IPANotFoundException: if no user matching the username exists
+        """
+        self._ipa_connect()
+        try:
+            result = self._command("user_del", uid=scim_user.obj.username)
+        except Exception:
+            raise IPANotFoundException(
+                "User {} not found".format(scim_user.obj.username)
+            )
+        logger.info(f"ipa: user_del result {result}")
+
+    def group_add(self, scim_group, members=()):
+        """
+        Add a new group
+
+        :param scim_group: group object conforming to the SCIM Group Schema
+        :param members: list of user names, member of the new group
+        """
+        self._ipa_connect()
+        result = self._command("group_add", cn=scim_group.group_name)
+        logger.info(f"ipa: group_add result {result}")
+        self.group_add_members(scim_group, members)
+
+    def group_delete(self, scim_group):
+        """
+        Delete group
+
+        :param scim_group: group object conforming to the SCIM Group Schema
+        :raises IPANotFoundException: if no group matching the name exists
+        """
+        self._ipa_connect()
+        try:
+            result = self._command("group_del", cn=scim_group.group_name)
+        except Exception:
+            raise IPANotFoundException(
+                "Group {} not found".format(scim_group.group_name)
+            )
+        logger.info(f"ipa: group_del result {result}")
+
+    def group_add_members(self, scim_group, members):
+        """
+        Add users to a group, with one command per batch of members
+
+        :param scim_group: group object conforming to the SCIM Group Schema
+        :param members: list of user names
+        """
+        self._member_command("group_add_member", scim_group, members)
+
+    def group_remove_members(self, scim_group, members):
+        """
+        Remove users from a group, with one command per batch of members
+
+        :param scim_group: group object conforming to the SCIM Group Schema
+        :param members: list of user names
+        """
+        self._member_command("group_remove_member", scim_group, members)
+
+    def _member_command(self, command, scim_group, members):
+        if not members:
+            return
+        self._ipa_connect()
+        for batch in _batches(list(members)):
+            try:
+                result = self._command(command, cn=scim_group.group_name, user=batch)
+            except NotFound:
+                raise IPANotFoundException(
+                    "Group {} not found".format(scim_group.group_name)
+                )
+            logger.info(
+                f"ipa: {command} completed {result['completed']} "
+                f"failed {result['failed']}"
+            )
@@ -0,0 +1,592 @@
+#
+# Copyright (C) 2023  FreeIPA Contributors see COPYING for license
+#
+
+import datetime
+import logging
+import threading
+from decimal import Decimal
+
+import ldap
+import ldap.modlist as modlist
+from ipatuura.ipa import (
+    GROUP_MEMBERS_BATCH_SIZE,
+    LDAPNotFoundException,
+    LDAPWriteException,
+    _batches,
+)
+from ipatuura.mapping import attribute_map
+from ipatuura.metrics import LDAP_SECONDS
+from ipatuura.tracing import KIND_CLIENT, span
+from ldap.ldapobject import ReconnectLDAPObject
+
+logger = logging.getLogger(__name__)
+
+
+LDAP_GENERALIZED_TIME_FORMAT = "%Y%m%d%H%M%SZ"
+
+
+def _encode_bool(val):
+    return b"TRUE" if val else b"FALSE"
+
+
+def _encode_str(val):
+    return str(val).encode("utf-8")
+
+
+def _encode_list(val):
+    return [encode(m) for m in val]
+
+
+def _encode_tuple(val):
+    return tuple(encode(m) for m in val)
+
+
+def _encode_dict(val):
+    # key in dict must be str not bytes
+    return {k: encode(v) for k, v in val.items()}
+
+
+def _encode_datetime(val):
+    return val.strftime(LDAP_GENERALIZED_TIME_FORMAT).encode("utf-8")
+
+
+# Encoders by value type, checked in order for the subclasses. Booleans are
+# both an instance of bool and int, therefore bool comes before int.
+_ENCODERS = {
+    bool: _encode_bool,
+    str: _encode_str,
+    int: _encode_str,
+    Decimal: _encode_str,
+    bytes: lambda val: val,
+    list: _encode_list,
+    tuple: _encode_tuple,
+    dict: _encode_dict,
+    datetime.datetime: _encode_datetime,
+    type(None): lambda val: None,
+}
+
+
+def encode(val):
+    """
+    Encode attribute value to LDAP representation (str/bytes)
+    """
+    encoder = _ENCODERS.get(type(val))
+    if encoder is None:
+        for cls, candidate in list(_ENCODERS.items()):
+            if isinstance(val, cls):
+                encoder = candidate
+                break
+        else:
+            raise TypeError(
+                "attempt to pass unsupported type to ldap, "
+                "value=%s type=%s" % (val, type(val))
+            )
+        # remember the subclass to skip the lookup next time
+        _ENCODERS[type(val)] = encoder
+    return encoder(val)
+
+
+def _write_error(e):
+    """
+    Log an error returned by the LDAP server and return the exception
+    raised to the caller, so that the write is not taken as applied
+    """
+    details = e.args[0] if e.args and isinstance(e.args[0], dict) else {}
+    desc = details.get("desc", str(e)).strip()
+    info = details.get("info", "").strip()
+    logger.error(f"LDAP Error: {desc}: {info}")
+    return LDAPWriteException(f"{desc}: {info}" if info else desc)
+
+
+def _ldap_modlist(changes, encode):
+    """
+    Build a minimal LDAP modlist from an attribute-level diff
+
+    :param changes: dict mapping attributes to (old values, new values)
+    :param encode: function encoding values to their LDAP representation
+    """
+    mod_attrs = []
+    for attr, (old, new) in changes.items():
+        if not new:
+            mod_attrs.append((ldap.MOD_DELETE, attr, None))
+        elif not old:
+            mod_attrs.append((ldap.MOD_ADD, attr, encode(new)))
+        else:
+            mod_attrs.append((ldap.MOD_REPLACE, attr, encode(new)))
+    return mod_attrs
+
+
+class _TimedLDAPObject(ReconnectLDAPObject):
+    """
+    LDAP connection recording the latency and a span of its synchronous
+    operations
+    """
+
+    def __init__(self, uri, provider, **kwargs):
+        super().__init__(uri, **kwargs)
+        self._histograms = {
+            op: LDAP_SECONDS.labels(provider, op)
+            for op in ("bind", "add", "modify", "delete", "search")
+        }
+
+    def simple_bind_s(self, *args, **kwargs):
+        with self._histograms["bind"].time(), span("ldap.bind", KIND_CLIENT):
+            return super().simple_bind_s(*args, **kwargs)
+
+    def add_s(self, *args, **kwargs):
+        with self._histograms["add"].time(), span("ldap.add", KIND_CLIENT):
+            return super().add_s(*args, **kwargs)
+
+    def modify_ext_s(self, *args, **kwargs):
+        with self._histograms["modify"].time(), span("ldap.modify", KIND_CLIENT):
+            return super().modify_ext_s(*args, **kwargs)
+
+    def delete_s(self, *args, **kwargs):
+        with self._histograms["delete"].time(), span("ldap.delete", KIND_CLIENT):
+            return super().delete_s(*args, **kwargs)
+
+    def search_s(self, *args, **kwargs):
+        with self._histograms["search"].time(), span("ldap.search", KIND_CLIENT):
+            return super().search_s(*args, **kwargs)
+
+
+class _DirectoryWriter:
+    """
+    Group writes shared by the LDAP and AD writable interfaces
+
+    The subclasses bind the connection and provide the DN of the users
+    and the object classes of the groups.
+    """
+
+    encode = staticmethod(encode)
+
+    def _group_dn(self, name):
+        return "cn={name},{groupsdn},{basedn}".format(
+            name=name,
+            groupsdn=self._groups_dn,
+            basedn=self._ldap_search_base,
+        )
+
+    def group_add(self, scim_group, members=()):
+        """
+        Add a new group
+
+        :param scim_group: group object conforming to the SCIM Group Schema
+        :param members: list of user names, member of the new group
+        """
+        members = [self._user_dn(m) for m in members]
+        # the first batch of members is part of the new entry
+        initial = members[:GROUP_MEMBERS_BATCH_SIZE]
+        attrs = {}
+        attrs["objectClass"] = self.encode(self._group_object_classes)
+        attrs["cn"] = self.encode(scim_group.group_name)
+        if initial:
+            attrs["member"] = self.encode(initial)
+        ldif = modlist.addModlist(attrs)
+
+        self._bind()
+        try:
+            self._conn.add_s(self._group_dn(scim_group.group_name), ldif)
+        except ldap.LDAPError as e:
+            raise _write_error(e)
+        self._modify_members(
+            ldap.MOD_ADD, scim_group, members[GROUP_MEMBERS_BATCH_SIZE:]
+        )
+
+    def group_delete(self, scim_group):
+        """
+        Delete group
+
+        :param scim_group: group object conforming to the SCIM Group Schema
+        """
+        self._bind()
+        try:
+            self._conn.delete_s(self._group_dn(scim_group.group_name))
+        except ldap.LDAPError as e:
+            raise _write_error(e)
+
+    def group_add_members(self, scim_group, members):
+        """
+        Add users to a group, with one multi-valued modification
+        per batch of members
+
+        :param scim_group: group object conforming to the SCIM Group Schema
+        :param members: list of user names
+        """
+        if not members:
+            return
+        self._bind()
+        self._modify_members(
+            ldap.MOD_ADD, scim_group, [self._user_dn(m) for m in members]
+        )
+
+    def group_remove_members(self, scim_group, members):
+        """
+        Remove users from a group, with one multi-valued modification
+        per batch of members
+
+        :param scim_group: group object conforming to the SCIM Group Schema
+        :param members: list of user names
+        """
+        if not members:
+            return
+        self._bind()
+        self._modify_members(
+            ldap.MOD_DELETE, scim_group, [self._user_dn(m) for m in members]
+        )
+
+    def _modify_members(self, op, scim_group, member_dns):
+        dn = self._group_dn(scim_group.group_name)
+        for batch in _batches(member_dns):
+            try:
+                self._conn.modify_ext_s(dn, [(op, "member", self.encode(batch))])
+            except (ldap.TYPE_OR_VALUE_EXISTS, ldap.NO_SUCH_ATTRIBUTE):
+                # A single value already present (or already absent) rejects
+                # the whole batch, apply it value by value instead
+                for member_dn in batch:
+                    try:
+                        self._conn.modify_ext_s(
+                            dn, [(op, "member", self.encode(member_dn))]
+                        )
+                    except (ldap.TYPE_OR_VALUE_EXISTS, ldap.NO_SUCH_ATTRIBUTE):
+                        pass
+            except ldap.NO_SUCH_OBJECT:
+                raise LDAPNotFoundException(
+                    "Group {} not found".format(scim_group.group_name)
+                )
+
+
+class LDAP(_DirectoryWriter):
+    """
+    Initialization of the LDAP writable interface
+    """
+
+    def __init__(self, domain):
+        self._local = threading.local()
+        self._dn = None
+        self._users_dn = None
+        self._ldap_uri = None
+        self._ldap_search_base = None
+        self._attribute_map = None
+        self._user_object_classes = None
+        self._groups_dn = None
+        self._group_object_classes = ["groupOfNames", "top"]
+        # TLS
+        self._ldap_tls_cacert = None
+        self._sasl_gssapi = ldap.sasl.sasl({}, "GSSAPI")
+        self._client_id = None
+        self._client_secret = None
+        # init and connect, bound again on first write if the server is down
+        self._fetch_domain(domain)
+        try:
+            self._bind()
+        except LDAPWriteException:
+            pass
+
+    def _fetch_domain(self, domain):
+        """
+        Fetch relevant information from the integration domain
+        """
+        suffix = domain.name.split(".")
+
+        self._dn = domain.client_id
+        self._ldap_uri = domain.integration_domain_url
+        self._attribute_map = attribute_map(domain.user_extra_attrs)
+        self._ldap_search_base = "dc=" + suffix[0] + ", dc=" + suffix[1]
+        self._ldap_tls_cacert = domain.ldap_tls_cacert
+        self._client_id = domain.client_id
+        self._client_secret = domain.client_secret
+        self._users_dn = domain.users_dn
+        self._user_object_classes = [
+            x.strip() for x in domain.user_object_classes.split(",")
+        ]
+        self._groups_dn = domain.groups_dn
+
+        logger.info(f"Domain info: {domain}")
+
+    @property
+    def _conn(self):
+        return getattr(self._local, "conn", None)
+
+    def _bind(self):
+        """
+        Bind to ldap server
+
+        Each thread keeps its own connection open, python-ldap reconnects
+        and binds again when the server drops it.
+
+        :raises LDAPWriteException: if the bind fails
+        """
+        if self._conn is not None:
+            return self._conn
+        # TODO enable TLS support
+        # conn.set_option(ldap.OPT_X_TLS_CACERTFILE, self._tls_cacert)
+        # conn.sasl_interactive_bind_s('', self._sasl_gssapi)
+        conn = _TimedLDAPObject(self._ldap_uri, "ldap", retry_max=3)
+        conn.protocol_version = 3
+        conn.set_option(ldap.OPT_REFERRALS, 0)
+        try:
+            conn.simple_bind_s(self._dn, self._client_secret)
+        except ldap.LDAPError as e:
+            logger.error(f"Unable to bind to LDAP server {e}")
+            raise LDAPWriteException(f"Unable to bind to LDAP server {e}")
+        self._local.conn = conn
+        return conn
+
+    def add(self, scim_user):
+        """
+        Add a new user
+
+        :param scim_user: user object conforming to the SCIM User Schema
+        For a RHDS deployment:
+        dc=ipa,dc=com
+          cn=accounts
+            cn=users
+              uid=oneuser
+        """
+        attrs = self.encode(self._attribute_map.entry(scim_user.obj))
+        attrs["cn"] = self.encode(scim_user.obj.username)
+        attrs["objectClass"] = self.encode(self._user_object_classes)
+        ldif = modlist.addModlist(attrs)
+
+        self._bind()
+        try:
+            # AD: cn, LDAP: uid
+            self._conn.add_s(
+                "uid={uid},{usersdn},{basedn}".format(
+                    uid=scim_user.obj.username,
+                    usersdn=self._users_dn,
+                    basedn=self._ldap_search_base,
+                ),
+                ldif,
+            )
+        except ldap.LDAPError as e:
+            raise _write_error(e)
+
+    def modify(self, scim_user, changes=None):
+        """
+        Modify user
+
+        :param scim_user: user object conforming to the SCIM User Schema
+        :param changes: optional attribute-level diff, only the modified
+                        attributes are sent when provided
+        """
+        dn = "uid={uid},{usersdn},{basedn}".format(
+            uid=scim_user.obj.username,
+            usersdn=self._users_dn,
+            basedn=self._ldap_search_base,
+        )
+
+        if changes is None:
+            mod_attrs = [
+                (ldap.MOD_REPLACE, attr, self.encode(value))
+                for attr, value in self._attribute_map.entry(scim_user.obj).items()
+            ]
+        else:
+            mod_attrs = _ldap_modlist(self._attribute_map.changes(changes), self.encode)
+        if not mod_attrs:
+            logger.debug("No modification for user {}".format(scim_user.obj.username))
+            return
+
+        self._bind()
+        try:
+            self._conn.modify_ext_s(dn, mod_attrs)
+        except ldap.TYPE_OR_VALUE_EXISTS:
+            pass
+        except ldap.NO_SUCH_OBJECT:
+            raise LDAPNotFoundException(
+                "User {} not found".format(scim_user.obj.username)
+            )
+
+    def delete(self, scim_user):
+        """
+        Delete user
+
+        :param scim_user: user object conforming to the SCIM User Schema
+        """
+        self._bind()
+        try:
+            self._conn.delete_s(
+                "uid={uid},{usersdn},{basedn}".format(
+                    uid=scim_user.obj.username,
+                    usersdn=self._users_dn,
+                    basedn=self._ldap_search_base,
+                )
+            )
+        except ldap.LDAPError as e:
+            raise _write_error(e)
+
+    def _user_dn(self, username):
+        return "uid={name},{usersdn},{basedn}".format(
+            name=username,
+            usersdn=self._users_dn,
+            basedn=self._ldap_search_base,
+        )
+
+
+class AD(_DirectoryWriter):
+    """
+    Initialization of the LDAP AD writable interface
+    """
+
+    def __init__(self, domain):
+        self._local = threading.local()
+        self._dn = None
+        self._users_dn = None
+        self._ldap_uri = None
+        self._ldap_search_base = None
+        self._attribute_map = None
+        self._user_object_classes = None
+        self._groups_dn = None
+        self._group_object_classes = ["group", "top"]
+        # TLS
+        self._ldap_tls_cacert = None
+        self._sasl_gssapi = ldap.sasl.sasl({}, "GSSAPI")
+        self._client_id = None
+        self._client_secret = None
+        # init and connect, bound again on first write if the server is down
+        self._fetch_domain(domain)
+        try:
+            self._bind()
+        except LDAPWriteException:
+            pass
+
+    def _fetch_domain(self, domain):
+        """
+        Fetch relevant information from the integration domain
+        """
+        suffix = domain.name.split(".")
+
+        self._dn = domain.client_id + "@" + domain.name
+        self._ldap_uri = domain.integration_domain_url
+        self._attribute_map = attribute_map(domain.user_extra_attrs)
+        self._ldap_search_base = "dc=" + suffix[0] + ", dc=" + suffix[1]
+        self._ldap_tls_cacert = domain.ldap_tls_cacert
+        self._client_id = domain.client_id
+        self._client_secret = domain.client_secret
+        self._users_dn = domain.users_dn
+        self._user_object_classes = [
+            x.strip() for x in domain.user_object_classes.split(",")
+        ]
+        self._groups_dn = domain.groups_dn
+        logger.info(f"Domain info: {domain}")
+
+    @property
+    def _conn(self):
+        return getattr(self._local, "conn", None)
+
+    def _bind(self):
+        """
+        Bind to ldap server
+
+        Each thread keeps its own connection open, python-ldap reconnects
+        and binds again when the server drops it.
+
+        :raises LDAPWriteException: if the bind fails
+        """
+        if self._conn is not None:
+            return self._conn
+        # TODO enable TLS support
+        # conn.set_option(ldap.OPT_X_TLS_CACERTFILE, self._tls_cacert)
+        # conn.sasl_interactive_bind_s('', self._sasl_gssapi)
+        conn = _TimedLDAPObject(self._ldap_uri, "ad", retry_max=3)
+        conn.protocol_version = 3
+        conn.set_option(ldap.OPT_REFERRALS, 0)
+        try:
+            conn.simple_bind_s(self._dn, self._client_secret)
+        except ldap.LDAPError as e:
+            logger.error(f"Unable to bind to LDAP server {e}")
+            raise LDAPWriteException(f"Unable to bind to LDAP server {e}")
+        self._local.conn = conn
+        return conn
+
+    def add(self, scim_user):
+        """
+        Add a new user
+
+        :param scim_user: user object conforming to the SCIM User Schema
+
+        For an AD deployment:
+        dc=ad,dc=com
+          cn=users
+            cn=oneuser
+        """
+        attrs = self.encode(self._attribute_map.entry(scim_user.obj))
+        attrs["objectclass"] = self.encode(self._user_object_classes)
+        attrs["cn"] = self.encode(scim_user.obj.username)
+        ldif = modlist.addModlist(attrs)
+
+        self._bind()
+        try:
+            # AD: cn, LDAP: uid
+            self._conn.add_s(
+                "cn={cn},{usersdn},{basedn}".format(
+                    cn=scim_user.obj.username,
+                    usersdn=self._users_dn,
+                    basedn=self._ldap_search_base,
+                ),
+                ldif,
+            )
+        except ldap.LDAPError as e:
+            raise _write_error(e)
+
+    def modify(self, scim_user, changes=None):
+        """
+        Modify user
+
+        :param scim_user: user object conforming to the SCIM User Schema
+        :param changes: optional attribute-level diff, only the modified
+                        attributes are sent when provided
+        """
+        dn = "cn={cn},{usersdn},{basedn}".format(
+            cn=scim_user.obj.username,
+            usersdn=self._users_dn,
+            basedn=self._ldap_search_base,
+        )
+
+        if changes is None:
+            mod_attrs = [
+                (ldap.MOD_REPLACE, attr, self.encode(value))
+                for attr, value in self._attribute_map.entry(scim_user.obj).items()
+            ]
+        else:
+            mod_attrs = _ldap_modlist(self._attribute_map.changes(changes), self.encode)
+        if not mod_attrs:
+            logger.debug("No modification for user {}".format(scim_user.obj.username))
+            return
+
+        self._bind()
+        try:
+            self._conn.modify_ext_s(dn, mod_attrs)
+        except ldap.TYPE_OR_VALUE_EXISTS:
+            pass
+        except ldap.NO_SUCH_OBJECT:
+            raise LDAPNotFoundException(
+                "User {} not found".format(scim_user.obj.username)
+            )
+
+    def delete(self, scim_user):
+        """
+        Delete user
+
+        :param scim_user: user object conforming to the SCIM User Schema
+        """
+        self._bind()
+        try:
+            self._conn.delete_s(
+                "cn={uid},{usersdn},{basedn}".format(
+                    uid=scim_user.obj.username,
+                    usersdn=self._users_dn,
+                    basedn=self._ldap_search_base,
+                )
+            )
+        except ldap.LDAPError as e:
+            raise _write_error(e)
+
+    def _user_dn(self, username):
+        return "cn={name},{usersdn},{basedn}".format(
+            name=username,
+            usersdn=self._users_dn,
+            basedn=self._ldap_search_base,
+        )
@@ -0,0 +1,3 @@
+#
+# Copyright (C) 2023  FreeIPA Contributors see COPYING for license
+#
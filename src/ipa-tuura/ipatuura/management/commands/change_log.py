@@ -0,0 +1,46 @@
+#
+# Copyright (C) 2023  FreeIPA Contributors see COPYING for license
+#
+
+import json
+import logging
+
+from django.core.management.base import BaseCommand, CommandError
+from ipatuura import changelog
+from ipatuura.sssd import SSSDNotFoundException
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Maintain the change log served at /scim/v2/.changes"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--sync",
+            action="store_true",
+            help="record the changes made in the directory, outside of ipa-tuura",
+        )
+        parser.add_argument(
+            "--compact",
+            action="store_true",
+            help="delete the changes superseded by a later change",
+        )
+        parser.add_argument(
+            "--stats",
+            action="store_true",
+            help="print the number of changes and the tokens",
+        )
+
+    def handle(self, *args, **options):
+        if not (options["sync"] or options["compact"] or options["stats"]):
+            raise CommandError("one of --sync, --compact or --stats is required")
+        if options["sync"]:
+            try:
+                changelog.sync()
+            except SSSDNotFoundException as e:
+                raise CommandError(f"SSSD infopipe not available: {e}")
+        if options["compact"]:
+            changelog.compact()
+        if options["stats"]:
+            self.stdout.write(json.dumps(changelog.stats()))
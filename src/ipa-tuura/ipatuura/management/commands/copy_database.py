@@ -0,0 +1,88 @@
+#
+# Copyright (C) 2023  FreeIPA Contributors see COPYING for license
+#
+
+import logging
+import os
+import tempfile
+
+from django.apps import apps
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.db.migrations.executor import MigrationExecutor
+
+logger = logging.getLogger(__name__)
+
+# Populated by migrate on the target or not worth copying
+EXCLUDED = ("contenttypes", "auth.permission", "sessions")
+
+
+class Command(BaseCommand):
+    help = (
+        "Copy the data of the source database (IPATUURA_DATABASE_SOURCE) "
+        "to the configured one, e.g. when switching from SQLite to PostgreSQL"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--source",
+            default="source",
+            help="alias of the database copied",
+        )
+        parser.add_argument(
+            "--database",
+            default="default",
+            help="alias of the database written, it must be empty",
+        )
+
+    def _check_migrated(self, alias):
+        executor = MigrationExecutor(connections[alias])
+        plan = executor.migration_plan(executor.loader.graph.leaf_nodes())
+        if plan:
+            raise CommandError(
+                f"Database {alias} has {len(plan)} unapplied migrations, "
+                f"run migrate --database {alias} first"
+            )
+
+    def _check_empty(self, alias):
+        for model in apps.get_models():
+            label = model._meta.label_lower
+            if label in EXCLUDED or model._meta.app_label in EXCLUDED:
+                continue
+            if not model._meta.managed or model._meta.proxy:
+                continue
+            if model._base_manager.using(alias).exists():
+                raise CommandError(f"Database {alias} already holds {label} rows")
+
+    def handle(self, *args, **options):
+        source = options["source"]
+        target = options["database"]
+        if source not in connections:
+            raise CommandError(
+                f"Unknown database {source}, set IPATUURA_DATABASE_SOURCE"
+            )
+
+        # both schemas must be at the same migration state
+        self._check_migrated(source)
+        self._check_migrated(target)
+        self._check_empty(target)
+
+        fd, path = tempfile.mkstemp(prefix="ipatuura-copy-", suffix=".json")
+        os.close(fd)
+        try:
+            call_command(
+                "dumpdata",
+                database=source,
+                # the content types may have other ids in the target,
+                # the other rows keep their primary key
+                natural_foreign=True,
+                exclude=list(EXCLUDED),
+                output=path,
+                verbosity=0,
+            )
+            call_command("loaddata", path, database=target, verbosity=0)
+        finally:
+            os.unlink(path)
+        logger.info(f"database: copied {source} to {target}")
+        self.stdout.write(f"Copied database {source} to {target}")
@@ -0,0 +1,63 @@
+#
+# Copyright (C) 2023  FreeIPA Contributors see COPYING for license
+#
+
+import json
+import logging
+import signal
+import threading
+
+from django.core.management.base import BaseCommand
+from ipatuura import outbox
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Apply the directory writes queued in the outbox"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=None,
+            help="number of worker threads",
+        )
+        parser.add_argument(
+            "--stats",
+            action="store_true",
+            help="print the queue depth and lag, then exit",
+        )
+        parser.add_argument(
+            "--retry-failed",
+            action="store_true",
+            help="requeue the writes that failed permanently, then exit",
+        )
+        parser.add_argument(
+            "--discard-failed",
+            action="store_true",
+            help="delete the writes that failed permanently, then exit",
+        )
+
+    def handle(self, *args, **options):
+        if options["stats"]:
+            self.stdout.write(json.dumps(outbox.stats()))
+            return
+        if options["retry_failed"]:
+            self.stdout.write(f"{outbox.retry_failed()} writes requeued")
+            return
+        if options["discard_failed"]:
+            self.stdout.write(f"{outbox.discard_failed()} writes discarded")
+            return
+
+        stop = threading.Event()
+        signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+        signal.signal(signal.SIGINT, lambda signum, frame: stop.set())
+
+        worker = outbox.OutboxWorker(options["workers"])
+        worker.start()
+        logger.info("outbox: worker started")
+        while not stop.wait(60):
+            logger.info(f"outbox: {outbox.stats()}")
+        worker.stop()
+        logger.info("outbox: worker stopped")
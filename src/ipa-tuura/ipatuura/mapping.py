@@ -0,0 +1,125 @@
+#
+# Copyright (C) 2023  FreeIPA Contributors see COPYING for license
+#
+
+import functools
+
+# Default value of Domain.user_extra_attrs, same syntax as the SSSD
+# ldap_user_extra_attrs option: "sssd name:ldap name" pairs
+DEFAULT_USER_EXTRA_ATTRS = "mail:mail, sn:sn, givenname:givenname"
+
+# SSSD attribute names bound to the SCIM User fields:
+# (sssd name, User field, multi-valued)
+USER_FIELDS = (
+    ("givenname", "first_name", False),
+    ("sn", "last_name", False),
+    ("mail", "email", True),
+)
+
+# Options of the IPA API user_add and user_mod commands bound to the SCIM
+# User fields, the IPA writer sets them whatever their ldap name
+IPA_USER_OPTIONS = {
+    "first_name": "givenname",
+    "last_name": "sn",
+    "email": "mail",
+}
+
+# SSSD attribute holding the lock state of the user
+LOCK_ATTR = "lock"
+
+
+def parse_extra_attrs(user_extra_attrs):
+    """
+    Parse a user_extra_attrs value
+
+    :param user_extra_attrs: comma-separated list of "sssd name:ldap name",
+                             the ldap name defaults to the sssd name
+    :returns: a list of (sssd name, ldap name) tuples
+    """
+    pairs = []
+    for item in user_extra_attrs.split(","):
+        sssd_name, _, ldap_name = item.partition(":")
+        sssd_name = sssd_name.strip()
+        if sssd_name:
+            pairs.append((sssd_name, ldap_name.strip() or sssd_name))
+    return pairs
+
+
+class AttributeMap:
+    """
+    Compiled mapping between the SCIM User fields and the attributes
+    written by a writable interface of an integration domain: their ldap
+    names for the LDAP and AD writers, the IPA API options for the IPA
+    writer.
+
+    Use attribute_map() to get the cached instance for a domain.
+    """
+
+    def __init__(self, user_extra_attrs, ipa_api=False):
+        pairs = parse_extra_attrs(user_extra_attrs or DEFAULT_USER_EXTRA_ATTRS)
+        ldap_names = dict(pairs)
+
+        # (sssd name, User field, written name, multi-valued)
+        self.fields = tuple(
+            (
+                sssd_name,
+                field,
+                IPA_USER_OPTIONS[field]
+                if ipa_api
+                else ldap_names.get(sssd_name, sssd_name),
+                multivalued,
+            )
+            for sssd_name, field, multivalued in USER_FIELDS
+        )
+        self.names = {sssd_name: name for sssd_name, _, name, _ in self.fields}
+
+        # Attributes exported by the infopipe responder
+        exported = [sssd_name for sssd_name, _ in pairs]
+        exported += [sssd_name for sssd_name, _, _ in USER_FIELDS]
+        exported.append(LOCK_ATTR)
+        self.ifp_user_attributes = tuple(dict.fromkeys(exported))
+
+    def read(self, extra_attrs):
+        """
+        Convert the extraAttributes of an SSSD user to SSSDUser keyword
+        arguments.
+
+        :param extra_attrs: dict of lists of values, keyed by sssd name
+        """
+        kwargs = {}
+        for sssd_name, _, _, multivalued in self.fields:
+            values = extra_attrs.get(sssd_name)
+            if values:
+                if multivalued:
+                    kwargs[sssd_name] = [str(x) for x in values]
+                else:
+                    kwargs[sssd_name] = str(values[0])
+        locked = extra_attrs.get(LOCK_ATTR)
+        kwargs["active"] = not (locked and str(locked[0]).lower() == "true")
+        return kwargs
+
+    def entry(self, user):
+        """
+        Return the attributes of a User, keyed by written name.
+        """
+        return {name: getattr(user, field) for _, field, name, _ in self.fields}
+
+    def changes(self, changes):
+        """
+        Translate an attribute-level diff keyed by sssd name to the written
+        names.
+        """
+        return {self.names.get(attr, attr): diff for attr, diff in changes.items()}
+
+
+@functools.lru_cache(maxsize=32)
+def attribute_map(user_extra_attrs=None, ipa_api=False):
+    """
+    Return the compiled AttributeMap for a user_extra_attrs value.
+
+    The value is only parsed again when the domain configuration changes.
+
+    :param user_extra_attrs: the user_extra_attrs of the domain
+    :param ipa_api: map to the IPA API options instead of the ldap names
+    """
+    return AttributeMap(user_extra_attrs or DEFAULT_USER_EXTRA_ATTRS, ipa_api)
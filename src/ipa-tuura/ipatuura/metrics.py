@@ -0,0 +1,162 @@
+#
+# Copyright (C) 2023  FreeIPA Contributors see COPYING for license
+#
+
+"""Prometheus metrics
+
+The instruments are shared by the whole process. When the server runs
+several worker processes, set PROMETHEUS_MULTIPROC_DIR to an empty
+directory writable by all of them: each process then writes its samples
+to that directory and the /metrics endpoint aggregates them.
+"""
+
+import logging
+import os
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+from prometheus_client.core import GaugeMetricFamily
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds in seconds of the latency buckets
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+REQUEST_SECONDS = Histogram(
+    "ipatuura_request_seconds",
+    "Latency of the HTTP requests by view, method and status",
+    ["view", "method", "status"],
+    buckets=BUCKETS,
+)
+INFOPIPE_SECONDS = Histogram(
+    "ipatuura_infopipe_call_seconds",
+    "Latency of the SSSD infopipe DBus calls by method",
+    ["method"],
+    buckets=BUCKETS,
+)
+IPA_SECONDS = Histogram(
+    "ipatuura_ipa_command_seconds",
+    "Latency of the IPA JSON-RPC commands",
+    ["command"],
+    buckets=BUCKETS,
+)
+LDAP_SECONDS = Histogram(
+    "ipatuura_ldap_operation_seconds",
+    "Latency of the LDAP operations by provider",
+    ["provider", "operation"],
+    buckets=BUCKETS,
+)
+VALIDATION_SECONDS = Histogram(
+    "ipatuura_credential_validation_seconds",
+    "Latency of the credential validations by PAM result code",
+    ["code"],
+    buckets=BUCKETS,
+)
+CACHE_REQUESTS = Counter(
+    "ipatuura_cache_requests",
+    "Lookups of the local caches by result, hit or miss",
+    ["cache", "result"],
+)
+POOL_SIZE = Gauge(
+    "ipatuura_pool_size",
+    "Number of slots of the worker pools and backend gates",
+    ["pool"],
+    multiprocess_mode="livesum",
+)
+POOL_BUSY = Gauge(
+    "ipatuura_pool_busy",
+    "Number of slots in use",
+    ["pool"],
+    multiprocess_mode="livesum",
+)
+POOL_WAITING = Gauge(
+    "ipatuura_pool_waiting",
+    "Number of calls waiting for a slot",
+    ["pool"],
+    multiprocess_mode="livesum",
+)
+POOL_WAIT_SECONDS = Histogram(
+    "ipatuura_pool_wait_seconds",
+    "Time spent waiting for a slot",
+    ["pool"],
+    buckets=BUCKETS,
+)
+POOL_REJECTED = Counter(
+    "ipatuura_pool_rejected",
+    "Calls rejected by the worker pools and backend gates",
+    ["pool", "reason"],
+)
+
+
+class _OutboxCollector:
+    """
+    Queue of the outbox, read from the database when the metrics are
+    scraped: shared by all the processes, it is not aggregated.
+    """
+
+    GAUGES = (
+        ("depth", "Number of directory writes queued in the outbox"),
+        ("lag", "Age in seconds of the oldest write queued in the outbox"),
+        ("failed", "Number of outbox writes that failed permanently"),
+        ("blocked", "Number of outbox writes queued behind a failed write"),
+    )
+
+    def describe(self):
+        return [
+            GaugeMetricFamily(f"ipatuura_outbox_{name}", documentation)
+            for name, documentation in self.GAUGES
+        ]
+
+    def collect(self):
+        from ipatuura import outbox
+
+        try:
+            stats = outbox.stats()
+        except Exception as e:
+            logger.error(f"metrics: unable to read the outbox: {e}")
+            return
+        for name, documentation in self.GAUGES:
+            yield GaugeMetricFamily(
+                f"ipatuura_outbox_{name}", documentation, value=stats[name]
+            )
+
+
+OUTBOX = _OutboxCollector()
+REGISTRY.register(OUTBOX)
+
+
+def cache_lookup(cache, hit):
+    """
+    Count a lookup of a local cache
+    """
+    CACHE_REQUESTS.labels(cache, "hit" if hit else "miss").inc()
+
+
+def render():
+    """
+    Return the metrics of all the worker processes in the Prometheus
+    text format, with its content type.
+    """
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        registry.register(OUTBOX)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+def mark_process_dead(pid):
+    """
+    Drop the live gauges of a worker process that exited
+    """
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        multiprocess.mark_process_dead(pid)
@@ -0,0 +1,122 @@
+#
+# Copyright (C) 2023  FreeIPA Contributors see COPYING for license
+#
+
+import json
+import logging
+import time
+from contextlib import ExitStack
+
+from django.db import connections
+from django.http import HttpResponse
+from django_scim import constants
+from django_scim import middleware as scim_middleware
+from ipatuura import tracing
+from ipatuura.admission import AdmissionException, retry_after
+from ipatuura.metrics import REQUEST_SECONDS
+
+
+class SCIMAuthCheckMiddleware(scim_middleware.SCIMAuthCheckMiddleware):
+    """
+    Check the authentication of the SCIM requests like django_scim.
+
+    The bodies are logged only when the debug logging of django_scim is
+    enabled: they are decoded and parsed to mask the passwords, which
+    costs as much as encoding the response. The body of a streamed
+    response is not read.
+    """
+
+    def log_request(self, request):
+        if scim_middleware.logger.isEnabledFor(logging.DEBUG):
+            super().log_request(request)
+
+    def log_response(self, request, response):
+        if not scim_middleware.logger.isEnabledFor(logging.DEBUG):
+            return
+        if response.streaming:
+            scim_middleware.logger.debug(
+                f"PATH\n{request.path}\nMETHOD\n{request.method}\n"
+                f"BODY\n(streamed)\nSTATUS_CODE\n{response.status_code}"
+            )
+            return
+        super().log_response(request, response)
+
+
+class AdmissionMiddleware:
+    """
+    Answer the requests rejected by the admission control with their
+    status and ask the client to retry later.
+
+    The SCIM views already turn the AdmissionException into a SCIM error
+    response, the Retry-After header is added to every 429 and 503
+    response that does not have one.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        if response.status_code in (429, 503) and not response.has_header(
+            "Retry-After"
+        ):
+            response["Retry-After"] = str(retry_after())
+        return response
+
+    def process_exception(self, request, exception):
+        if not isinstance(exception, AdmissionException):
+            return None
+        return HttpResponse(
+            content=json.dumps(exception.to_dict()),
+            content_type=constants.SCIM_CONTENT_TYPE,
+            status=exception.status,
+        )
+
+
+class MetricsMiddleware:
+    """
+    Record the latency of the requests by view, method and status.
+
+    Streamed responses are timed until their first byte.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        start = time.perf_counter()
+        response = self.get_response(request)
+        match = request.resolver_match
+        REQUEST_SECONDS.labels(
+            match.view_name if match else "unresolved",
+            request.method,
+            response.status_code,
+        ).observe(time.perf_counter() - start)
+        return response
+
+
+class TracingMiddleware:
+    """
+    Trace the requests when IPATUURA_TRACING is enabled, including their
+    database queries. The trace of a streamed response ends once its
+    content is sent.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not tracing.enabled():
+            return self.get_response(request)
+        name = f"{request.method} {request.path}"
+        with tracing.trace(name, request.META.get("HTTP_TRACEPARENT")) as root:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(tracing.db_wrapper))
+                response = self.get_response(request)
+            root.attributes["http.status_code"] = response.status_code
+            if response.streaming:
+                response.streaming_content = tracing.stream(
+                    root, response.streaming_content
+                )
+        return response
@@ -0,0 +1,22 @@
+# Generated by Django 5.2.18 on 2026-10-19 18:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("ipatuura", "0002_outboxentry"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="outboxentry",
+            name="resource_type",
+            field=models.CharField(
+                choices=[("user", "User"), ("group", "Group")],
+                default="user",
+                max_length=5,
+            ),
+        ),
+    ]
@@ -0,0 +1,57 @@
+# Generated by Django 5.2.18 on 2026-10-19 18:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("ipatuura", "0003_outboxentry_resource_type"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ChangeEvent",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "resource_type",
+                    models.CharField(
+                        choices=[("User", "User"), ("Group", "Group")], max_length=5
+                    ),
+                ),
+                ("resource_id", models.CharField(blank=True, max_length=254)),
+                ("name", models.CharField(max_length=254)),
+                (
+                    "operation",
+                    models.CharField(
+                        choices=[
+                            ("create", "Create"),
+                            ("update", "Update"),
+                            ("delete", "Delete"),
+                        ],
+                        max_length=6,
+                    ),
+                ),
+                ("digest", models.CharField(blank=True, max_length=64)),
+                ("created", models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                "ordering": ["id"],
+                "indexes": [
+                    models.Index(
+                        fields=["resource_type", "name"],
+                        name="ipatuura_ch_resourc_b74c12_idx",
+                    )
+                ],
+            },
+        ),
+    ]
@@ -4,12 +4,14 @@
 
 from urllib.parse import urljoin
 
+from django.conf import settings
 from django.contrib.auth.models import AbstractBaseUser, GroupManager, UserManager
 from django.db import models
 from django.db.utils import NotSupportedError
 from django.urls import reverse
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
-from django_scim import constants
+from django_scim import constants, exceptions
 from django_scim.models import (
     AbstractSCIMGroupMixin,
     AbstractSCIMUserMixin,
@@ -17,6 +19,8 @@ from django_scim.models import (
 )
 from django_scim.settings import scim_settings
 from django_scim.utils import get_base_scim_location_getter
+from ipatuura.overlay import DELETED, Overlay
+from ipatuura.registry import Registry
 from ipatuura.sssd import SSSD, SSSDNotFoundException
 
 
@@ -37,6 +41,7 @@ def SSSDUserToUserModel(sssd_if, sssduser):
     usermodel.scim_username = sssduser.username
     usermodel.id = sssduser.id
     usermodel.scim_id = str(usermodel.id)
+    usermodel.uid_number = sssduser.id
     usermodel.first_name = sssduser.first_name
     usermodel.last_name = sssduser.last_name
     usermodel.email = sssduser.mail
@@ -84,6 +89,105 @@ def SSSDGroupToGroupModel(sssd_if, sssdgroup):
     return groupmodel
 
 
+def merge_pending_writes(sssduser):
+    """
+    Apply the outbox writes not yet applied to a user read from SSSD,
+    so that clients read their own writes.
+
+    :param sssduser: SSSDUser object
+    :returns: the updated SSSDUser object, or None if a deletion is pending
+    """
+    if getattr(settings, "IPATUURA_WRITE_MODE", "sync") != "outbox":
+        return sssduser
+    for entry in OutboxEntry.objects.filter(
+        resource_type=OutboxEntry.ResourceType.USER,
+        username=sssduser.username,
+        status__in=[OutboxEntry.Status.PENDING, OutboxEntry.Status.RUNNING],
+    ):
+        if entry.operation == OutboxEntry.Operation.DELETE:
+            return None
+        sssduser.first_name = entry.payload.get("first_name")
+        sssduser.last_name = entry.payload.get("last_name")
+        sssduser.mail = entry.payload.get("email")
+    return sssduser
+
+
+def find_directory_user(scim_id=None, scim_username=None):
+    """
+    Find a user of the integration domain by id or name.
+
+    :returns: a User object
+    :raises User.DoesNotExist: when no User matching the criteria is found
+    """
+    sssd_if, sssduser = find_directory_sssduser(scim_id, scim_username)
+    return SSSDUserToUserModel(sssd_if, sssduser)
+
+
+def find_directory_sssduser(scim_id=None, scim_username=None):
+    """
+    Find a user of the integration domain by id or name, with its groups.
+
+    The overlay of recent writes is consulted first since SSSD may not
+    reflect them yet, then the pending outbox writes are merged.
+
+    :returns: a tuple (SSSD interface, SSSDUser object)
+    :raises User.DoesNotExist: when no User matching the criteria is found
+    """
+    recent = Overlay().lookup(username=scim_username, id=scim_id)
+    if recent is DELETED:
+        raise User.DoesNotExist
+
+    sssd_if = None
+    try:
+        sssd_if = SSSD()
+        if scim_username is not None:
+            sssduser = sssd_if.find_user_by_name(scim_username, retrieve_groups=True)
+        else:
+            sssduser = sssd_if.find_user_by_id(scim_id, retrieve_groups=True)
+    except SSSDNotFoundException:
+        if recent is None:
+            raise User.DoesNotExist
+        sssduser = recent
+    else:
+        if recent is not None:
+            # SSSD may still return the attributes prior to the write
+            sssduser.first_name = recent.first_name
+            sssduser.last_name = recent.last_name
+            sssduser.mail = recent.mail
+            sssduser.active = recent.active
+
+    sssduser = merge_pending_writes(sssduser)
+    if sssduser is None:
+        raise User.DoesNotExist
+    return sssd_if, sssduser
+
+
+def find_directory_users(scim_username):
+    """
+    Find the users with a given name across the integration domains.
+
+    A name qualified with its domain is looked up in that domain only,
+    otherwise the lookup is sent to all the active domains in parallel.
+
+    :returns: a list of User objects
+    """
+    registry = Registry()
+    domains = registry.domains()
+    if "@" in scim_username or len(domains) < 2:
+        try:
+            return [find_directory_user(scim_username=scim_username)]
+        except User.DoesNotExist:
+            return []
+
+    def lookup(domain):
+        try:
+            return find_directory_user(scim_username=f"{scim_username}@{domain.name}")
+        except User.DoesNotExist:
+            return None
+
+    return [user for _, user in registry.fan_out(lookup, domains) if user is not None]
+
+
 class CustomUserGroupRelationManager:
     """
     Manager allowing to access Groups linked to a User object.
@@ -160,25 +264,11 @@ class CustomUserManager(UserManager):
             # Look in SSSD
             pass
 
-        # Support only search by scim_id
+        # Support only search by scim_id or scim_username
         if "scim_id" in kwargs.keys():
-            try:
-                sssd_if = SSSD()
-                sssduser = sssd_if.find_user_by_id(
-                    kwargs["scim_id"], retrieve_groups=True
-                )
-            except SSSDNotFoundException:
-                raise User.DoesNotExist
-            return SSSDUserToUserModel(sssd_if, sssduser)
+            return find_directory_user(scim_id=kwargs["scim_id"])
         elif "scim_username" in kwargs.keys():
-            try:
-                sssd_if = SSSD()
-                sssduser = sssd_if.find_user_by_name(
-                    kwargs["scim_username"], retrieve_groups=True
-                )
-            except SSSDNotFoundException:
-                raise User.DoesNotExist
-            return SSSDUserToUserModel(sssd_if, sssduser)
+            return find_directory_user(scim_username=kwargs["scim_username"])
         else:
             raise NotSupportedError(
                 "Support only exact search by scim_id or scim_username"
@@ -266,6 +356,14 @@ class CustomGroupUserRelationManager:
         self.users = userlist
 
 
+class GroupUnavailableException(exceptions.SCIMException):
+    """
+    Exception returned when the membership of a group cannot be read.
+    """
+
+    status = 503
+
+
 class CustomGroupManager(GroupManager):
     """
     Manager specific to the Group objects.
@@ -284,15 +382,34 @@ class CustomGroupManager(GroupManager):
         :raises Group.DoesNotExist: when no Group matching the criteria is
         found
         :raises NotSupportedError: when the criteria are too complex
+        :raises GroupUnavailableException: when the members of a local group
+        cannot be read
         """
 
         # Look for a group in the local DB first
         try:
             localgroup = super().get(*args, **kwargs)
-            return localgroup
         except Group.DoesNotExist:
             # Look in SSSD
             pass
+        else:
+            # The membership is only stored in the integration domain
+            try:
+                sssd_if = SSSD()
+                sssdgroup = sssd_if.find_group_by_name(
+                    localgroup.scim_display_name, retrieve_members=True
+                )
+            except SSSDNotFoundException:
+                # The membership is not stored locally, an empty one must
+                # not become the base of a PATCH
+                raise GroupUnavailableException(
+                    "Unable to read the members of group {}".format(
+                        localgroup.scim_display_name
+                    )
+                )
+            groupmodel = SSSDGroupToGroupModel(sssd_if, sssdgroup)
+            localgroup.user_set.set(groupmodel.user_set.all())
+            return localgroup
 
         # Support only search by scim_id or scim_display_name
         if "scim_id" in kwargs.keys():
@@ -340,6 +457,93 @@ class Group(AbstractSCIMGroupMixin):
             return self._user_set
 
 
+class OutboxEntry(models.Model):
+    """
+    Directory write persisted by the outbox, waiting to be applied
+    to the writable interface.
+    """
+
+    class Operation(models.TextChoices):
+        ADD = "add", _("Add")
+        MODIFY = "mod", _("Modify")
+        DELETE = "del", _("Delete")
+
+    class Status(models.TextChoices):
+        PENDING = "pending", _("Pending")
+        RUNNING = "running", _("Running")
+        FAILED = "failed", _("Failed")
+
+    class ResourceType(models.TextChoices):
+        USER = "user", _("User")
+        GROUP = "group", _("Group")
+
+    resource_type = models.CharField(
+        max_length=5, choices=ResourceType.choices, default=ResourceType.USER
+    )
+    # name of the user, or of the group for the group writes
+    username = models.CharField(max_length=254, db_index=True)
+    operation = models.CharField(max_length=3, choices=Operation.choices)
+
+    # User attributes and attribute-level diff, the password is never
+    # stored, or group members added and removed
+    payload = models.JSONField(default=dict)
+
+    status = models.CharField(
+        max_length=7,
+        choices=Status.choices,
+        default=Status.PENDING,
+        db_index=True,
+    )
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    next_attempt = models.DateTimeField(default=timezone.now)
+
+    # Worker applying the write and end of its lease, renewed as long as
+    # the worker is alive
+    owner = models.CharField(max_length=64, blank=True)
+    lease_expires = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ["id"]
+
+    def __str__(self):
+        return "{} {} ({})".format(self.operation, self.username, self.status)
+
+
+class ChangeEvent(models.Model):
+    """
+    Entry of the change log: a user or group created, updated or deleted.
+    The id of the entry is the token of the change feed.
+    """
+
+    class ResourceType(models.TextChoices):
+        USER = "User", _("User")
+        GROUP = "Group", _("Group")
+
+    class Operation(models.TextChoices):
+        CREATE = "create", _("Create")
+        UPDATE = "update", _("Update")
+        DELETE = "delete", _("Delete")
+
+    resource_type = models.CharField(max_length=5, choices=ResourceType.choices)
+    # SCIM id, empty when not known yet (user created through ipa-tuura)
+    resource_id = models.CharField(max_length=254, blank=True)
+    # userName or displayName, identifies the resource in the log
+    name = models.CharField(max_length=254)
+    operation = models.CharField(max_length=6, choices=Operation.choices)
+    # digest of the resource as read from the directory by the sync
+    digest = models.CharField(max_length=64, blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ["id"]
+        indexes = [models.Index(fields=["resource_type", "name"])]
+
+    def __str__(self):
+        return "{} {} {}".format(self.operation, self.resource_type, self.name)
+
+
 class ServiceProviderConfig(SCIMServiceProviderConfig):
     """
     Service Provider Config model.
@@ -367,12 +571,10 @@ class ServiceProviderConfig(SCIMServiceProviderConfig):
         return {
             "schemas": [constants.SchemaURI.SERVICE_PROVIDER_CONFIG],
             "documentationUri": scim_settings.DOCUMENTATION_URI,
-            # In order to support the PATCH method both:
-            # - ScimUser.handle_add
-            # - ScimUser.handle_replace
-            # must be implemented.
+            # PATCH operations are applied to the adapters and only
+            # the resulting diff is sent to the writable interface
             "patch": {
-                "supported": False,
+                "supported": True,
             },
             "bulk": {
                 "supported": False,
@@ -0,0 +1,354 @@
+#
+# Copyright (C) 2023  FreeIPA Contributors see COPYING for license
+#
+
+import logging
+import os
+import socket
+import threading
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import Exists, Min, OuterRef, Q
+from django.utils import timezone
+from django_scim.utils import get_group_adapter, get_user_adapter
+from ipatuura.ipa import IPA
+from ipatuura.models import Group, OutboxEntry, User
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_DEFAULTS = {
+    "WORKERS": 4,
+    "MAX_ATTEMPTS": 8,
+    "BACKOFF": 2,
+    "MAX_BACKOFF": 300,
+    "POLL_INTERVAL": 1,
+    "LEASE": 60,
+}
+
+
+def _option(name):
+    return getattr(settings, "IPATUURA_OUTBOX", {}).get(name, OUTBOX_DEFAULTS[name])
+
+
+def enabled():
+    """
+    Return True if the directory writes go through the outbox
+    """
+    return getattr(settings, "IPATUURA_WRITE_MODE", "sync") == "outbox"
+
+
+def enqueue(operation, scim_user, changes=None):
+    """
+    Persist a directory write for the given user.
+
+    Must be called in the same transaction as the local user update,
+    so that the outbox and the local database stay consistent.
+
+    :param operation: one of OutboxEntry.Operation
+    :param scim_user: user object conforming to the SCIM User Schema
+    :param changes: optional attribute-level diff for modifications
+    """
+    payload = {
+        "first_name": scim_user.obj.first_name,
+        "last_name": scim_user.obj.last_name,
+        "email": scim_user.obj.email,
+    }
+    if changes is not None:
+        payload["changes"] = {attr: [old, new] for attr, (old, new) in changes.items()}
+    entry = OutboxEntry.objects.create(
+        username=scim_user.obj.username, operation=operation, payload=payload
+    )
+    logger.debug(f"outbox: queued {entry}")
+    return entry
+
+
+def enqueue_group(operation, scim_group, added=(), removed=()):
+    """
+    Persist a directory write for the given group, see enqueue().
+
+    A group write is applied once the writes queued before it are, so
+    that its members exist in the directory, and the writes queued after
+    it wait for it.
+
+    :param operation: one of OutboxEntry.Operation
+    :param scim_group: group object conforming to the SCIM Group Schema
+    :param added: names of the users added to the group, or its members
+                  for a new group
+    :param removed: names of the users removed from the group
+    """
+    entry = OutboxEntry.objects.create(
+        resource_type=OutboxEntry.ResourceType.GROUP,
+        username=scim_group.group_name,
+        operation=operation,
+        payload={"added": sorted(added), "removed": sorted(removed)},
+    )
+    logger.debug(f"outbox: queued group {entry}")
+    return entry
+
+
+def stats():
+    """
+    Return the outbox queue depth, the lag in seconds of the oldest
+    pending write, the number of writes that failed permanently and the
+    number of writes blocked behind them.
+    """
+    failed = OutboxEntry.objects.filter(status=OutboxEntry.Status.FAILED)
+    queued = OutboxEntry.objects.exclude(status=OutboxEntry.Status.FAILED)
+    oldest = queued.aggregate(oldest=Min("created"))["oldest"]
+    lag = (timezone.now() - oldest).total_seconds() if oldest else 0
+    return {
+        "depth": queued.count(),
+        "lag": lag,
+        "failed": failed.count(),
+        "blocked": queued.filter(Exists(_earlier(failed))).count(),
+    }
+
+
+def _earlier(entries):
+    """
+    Return the entries queued before a write of the outer query for the
+    same user or group
+    """
+    return entries.filter(
+        resource_type=OuterRef("resource_type"),
+        username=OuterRef("username"),
+        id__lt=OuterRef("id"),
+    )
+
+
+def worker_id():
+    """
+    Return a name identifying a worker across the hosts and processes
+    """
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"[-64:]
+
+
+def _lease_end():
+    return timezone.now() + timedelta(seconds=_option("LEASE"))
+
+
+def renew(owner):
+    """
+    Extend the lease of the writes being applied by a worker
+    """
+    OutboxEntry.objects.filter(status=OutboxEntry.Status.RUNNING, owner=owner).update(
+        lease_expires=_lease_end()
+    )
+
+
+def recover():
+    """
+    Requeue the writes whose lease expired, their worker stopped. The
+    writes still applied by a live worker, in any process, are left
+    running.
+    """
+    count = (
+        OutboxEntry.objects.filter(status=OutboxEntry.Status.RUNNING)
+        .filter(Q(lease_expires__lt=timezone.now()) | Q(lease_expires__isnull=True))
+        .update(status=OutboxEntry.Status.PENDING, owner="", lease_expires=None)
+    )
+    if count:
+        logger.info(f"outbox: requeued {count} interrupted writes")
+    return count
+
+
+def claim(owner):
+    """
+    Claim the next write to apply.
+
+    Only the oldest write of each user or group can be claimed, which
+    keeps their ordering even with several workers or processes, and a
+    group write only once the writes queued before it are applied. A
+    write that failed permanently blocks the writes of its user or group
+    queued after it, until it is retried or discarded.
+
+    :param owner: worker claiming the write, see worker_id()
+    :returns: an OutboxEntry or None if nothing is ready
+    """
+    live = OutboxEntry.objects.filter(
+        status__in=[OutboxEntry.Status.PENDING, OutboxEntry.Status.RUNNING],
+        id__lt=OuterRef("id"),
+    )
+    live_groups = live.filter(resource_type=OutboxEntry.ResourceType.GROUP)
+    heads = OutboxEntry.objects.filter(
+        # no earlier write of the same user or group, pending or failed
+        ~Exists(_earlier(OutboxEntry.objects.all())),
+        # the group writes apply after the writes queued before them, and
+        # before the writes queued after them
+        ~Exists(live_groups),
+        Q(resource_type=OutboxEntry.ResourceType.USER) | ~Exists(live),
+        status=OutboxEntry.Status.PENDING,
+    ).order_by("id")
+    while True:
+        entry = heads.filter(next_attempt__lte=timezone.now()).first()
+        if entry is None:
+            return None
+        claimed = OutboxEntry.objects.filter(
+            id=entry.id, status=OutboxEntry.Status.PENDING
+        ).update(
+            status=OutboxEntry.Status.RUNNING, owner=owner, lease_expires=_lease_end()
+        )
+        if claimed:
+            entry.status = OutboxEntry.Status.RUNNING
+            entry.owner = owner
+            return entry
+        # claimed by another worker in the meantime, take the next one
+
+
+def retry_failed():
+    """
+    Requeue the writes that failed permanently, the writes of their users
+    queued after them then follow.
+
+    :returns: the number of writes requeued
+    """
+    return OutboxEntry.objects.filter(status=OutboxEntry.Status.FAILED).update(
+        status=OutboxEntry.Status.PENDING, attempts=0, next_attempt=timezone.now()
+    )
+
+
+def discard_failed():
+    """
+    Delete the writes that failed permanently, the writes of their users
+    queued after them then follow.
+
+    :returns: the number of writes deleted
+    """
+    deleted, _ = OutboxEntry.objects.filter(status=OutboxEntry.Status.FAILED).delete()
+    return deleted
+
+
+def apply(entry):
+    """
+    Apply a write to the writable interface
+
+    :raises: the error of the writable interface if the write failed
+    """
+    if entry.resource_type == OutboxEntry.ResourceType.GROUP:
+        _apply_group(entry)
+        return
+    usermodel = User(
+        scim_username=entry.username,
+        first_name=entry.payload.get("first_name") or "",
+        last_name=entry.payload.get("last_name") or "",
+        email=entry.payload.get("email") or "",
+    )
+    scim_user = get_user_adapter()(usermodel)
+    changes = entry.payload.get("changes")
+    if changes is not None:
+        changes = {attr: (old, new) for attr, (old, new) in changes.items()}
+
+    ipa_if = IPA(entry.username)
+    if entry.operation == OutboxEntry.Operation.ADD:
+        ipa_if.user_add(scim_user)
+    elif entry.operation == OutboxEntry.Operation.MODIFY:
+        ipa_if.user_mod(scim_user, changes)
+    else:
+        ipa_if.user_del(scim_user)
+
+
+def _apply_group(entry):
+    scim_group = get_group_adapter()(Group(scim_display_name=entry.username))
+    added = entry.payload.get("added", [])
+    removed = entry.payload.get("removed", [])
+
+    ipa_if = IPA(entry.username)
+    if entry.operation == OutboxEntry.Operation.ADD:
+        ipa_if.group_add(scim_group, added)
+    elif entry.operation == OutboxEntry.Operation.MODIFY:
+        if added:
+            ipa_if.group_add_member(scim_group, added)
+        if removed:
+            ipa_if.group_remove_member(scim_group, removed)
+    else:
+        ipa_if.group_del(scim_group)
+
+
+def process(entry):
+    """
+    Apply a claimed write, retrying later with an exponential backoff
+    if the writable interface fails.
+
+    The outcome is only recorded while the worker holds the lease.
+    """
+    mine = OutboxEntry.objects.filter(id=entry.id, owner=entry.owner)
+    try:
+        apply(entry)
+    except Exception as e:
+        attempts = entry.attempts + 1
+        if attempts >= _option("MAX_ATTEMPTS"):
+            status = OutboxEntry.Status.FAILED
+            logger.error(f"outbox: giving up {entry} after {attempts} attempts: {e}")
+        else:
+            status = OutboxEntry.Status.PENDING
+            logger.info(f"outbox: attempt {attempts} failed for {entry}: {e}")
+        delay = min(_option("BACKOFF") ** attempts, _option("MAX_BACKOFF"))
+        updated = mine.update(
+            status=status,
+            attempts=attempts,
+            last_error=str(e),
+            next_attempt=timezone.now() + timedelta(seconds=delay),
+            owner="",
+            lease_expires=None,
+        )
+    else:
+        updated, _ = mine.delete()
+        logger.info(f"outbox: applied {entry}")
+    if not updated:
+        logger.warning(f"outbox: lease of {entry} lost while applying it")
+
+
+class OutboxWorker:
+    """
+    Pool of threads applying the outbox writes to the writable interface
+    """
+
+    def __init__(self, workers=None):
+        self._workers = workers or _option("WORKERS")
+        self._stop = threading.Event()
+        self._threads = []
+        self.owner = worker_id()
+
+    def _heartbeat(self):
+        # Renew the leases well before they expire, and take over the
+        # writes of the workers that stopped
+        while not self._stop.wait(_option("LEASE") / 3):
+            close_old_connections()
+            try:
+                renew(self.owner)
+                recover()
+            except Exception as e:
+                logger.error(f"outbox: unable to renew the leases: {e}")
+        close_old_connections()
+
+    def _run(self):
+        while not self._stop.is_set():
+            close_old_connections()
+            try:
+                entry = claim(self.owner)
+            except Exception as e:
+                logger.error(f"outbox: unable to claim a write: {e}")
+                entry = None
+            if entry is None:
+                self._stop.wait(_option("POLL_INTERVAL"))
+                continue
+            process(entry)
+        close_old_connections()
+
+    def start(self):
+        recover()
+        targets = [(f"outbox-{i}", self._run) for i in range(self._workers)]
+        targets.append(("outbox-heartbeat", self._heartbeat))
+        for name, target in targets:
+            thread = threading.Thread(target=target, name=name, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        self._stop.set()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
@@ -0,0 +1,104 @@
+#
+# Copyright (C) 2023  FreeIPA Contributors see COPYING for license
+#
+
+import hashlib
+import logging
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.base import InvalidCacheBackendError
+from django.db import DatabaseError
+from ipatuura.metrics import cache_lookup
+
+logger = logging.getLogger(__name__)
+
+# Marker returned for the users deleted through the writable interface
+DELETED = object()
+
+# Value stored in the cache for the deleted users
+_DELETED_VALUE = "deleted"
+
+
+class _Overlay:
+    """
+    Short-lived overlay of the users written through the writable interface.
+
+    SSSD may return stale data (or nothing) until its cache entry expires,
+    the read path consults the overlay first so that clients see their
+    writes without polling. The overlay is kept in the "overlay" cache,
+    shared by the worker processes, the users are recorded by name and by
+    their id in the integration domain (uidNumber). When the cache table
+    is missing, the users are only read from SSSD.
+    """
+
+    _instance = None
+
+    @property
+    def ttl(self):
+        return getattr(settings, "IPATUURA_OVERLAY_TTL", 60)
+
+    @property
+    def cache(self):
+        try:
+            return caches["overlay"]
+        except InvalidCacheBackendError:
+            return caches["default"]
+
+    @staticmethod
+    def _key(kind, value):
+        digest = hashlib.sha256(str(value).encode("utf-8")).hexdigest()
+        return "overlay:{}:{}".format(kind, digest)
+
+    def _store(self, username, id, value):
+        entries = {self._key("name", username): value}
+        if id is not None:
+            entries[self._key("id", id)] = value
+        try:
+            self.cache.set_many(entries, self.ttl)
+        except DatabaseError as e:
+            # the write is done, only read your own writes is lost
+            logger.warning(f"overlay: unable to record {username}: {e}")
+
+    def record(self, sssduser):
+        """
+        Record a user created or modified through the writable interface.
+
+        :param sssduser: SSSDUser object, its id is the uidNumber of the
+                         user or None if not yet known
+        """
+        self._store(sssduser.username, sssduser.id, sssduser)
+
+    def record_deleted(self, username, id=None):
+        """
+        Record a user deleted through the writable interface.
+
+        :param username: name of the user
+        :param id: uidNumber of the user, None if not known
+        """
+        self._store(username, id, _DELETED_VALUE)
+
+    def lookup(self, username=None, id=None):
+        """
+        Find a recently written user by name or by uidNumber.
+
+        :returns: a SSSDUser object, DELETED, or None if not in the overlay
+        """
+        key = (
+            self._key("name", username) if username is not None else self._key("id", id)
+        )
+        try:
+            value = self.cache.get(key)
+        except DatabaseError as e:
+            logger.warning(f"overlay: lookup failed, reading SSSD: {e}")
+            return None
+        cache_lookup("overlay", value is not None)
+        if value == _DELETED_VALUE:
+            return DELETED
+        return value
+
+
+def Overlay():
+    if _Overlay._instance is None:
+        _Overlay._instance = _Overlay()
+    return _Overlay._instance
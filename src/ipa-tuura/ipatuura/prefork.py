@@ -0,0 +1,73 @@
+#
+# Copyright (C) 2023  FreeIPA Contributors see COPYING for license
+#
+
+import logging
+
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+
+def before_fork():
+    """
+    Close the database connections of the master process, a connection
+    shared with the workers would mix their queries on the same socket.
+    """
+    connections.close_all()
+
+
+def after_fork():
+    """
+    Forget the singletons a worker inherited from the process it was
+    forked from: the DBus connection, the thread pools and the locks are
+    not usable in the child, they are created again on first use.
+    """
+    from creds.pool import _ValidationPool
+    from ipatuura.admission import _Admission
+    from ipatuura.overlay import _Overlay
+    from ipatuura.registry import _Registry
+    from ipatuura.sssd import _SSSD
+
+    for cls in (_SSSD, _Registry, _Admission, _ValidationPool, _Overlay):
+        cls._instance = None
+
+
+def warm_up():
+    """
+    Open the connections of a new worker before it serves its first
+    request: the database, the SSSD infopipe and the writable interface
+    of each active domain (IPA API finalization, LDAP bind), and start
+    the credential validation pool and the domain job scheduler, which
+    picks up the jobs left pending.
+
+    A backend not available is only logged, the worker connects to it
+    again on first use.
+    """
+    from creds.pool import ValidationPool
+    from domains.jobs import Scheduler
+    from ipatuura.admission import Admission
+    from ipatuura.registry import Registry
+    from ipatuura.sssd import SSSD
+
+    connections["default"].ensure_connection()
+    Admission()
+    ValidationPool()
+    Scheduler()
+    try:
+        SSSD()
+    except Exception as e:
+        logger.warning(f"prefork: SSSD infopipe not available: {e!r}")
+
+    registry = Registry()
+    try:
+        domains = registry.domains()
+    except Exception as e:
+        logger.warning(f"prefork: unable to load the domains: {e}")
+        return
+    for domain in domains:
+        try:
+            registry.writer(domain)
+        except Exception as e:
+            logger.warning(f"prefork: writable interface of {domain.name}: {e}")
+    logger.info(f"prefork: worker ready, {len(domains)} domains")
@@ -0,0 +1,193 @@
+#
+# Copyright (C) 2023  FreeIPA Contributors see COPYING for license
+#
+
+import contextvars
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connections
+from django.db.models.signals import post_delete, post_save
+from domains.models import Domain
+from ipatuura.admission import AdmissionException
+
+logger = logging.getLogger(__name__)
+
+
+class _Registry:
+    """
+    Registry of the active integration domains.
+
+    Keeps one warm writable interface per domain, routes the SCIM requests
+    to their domain by realm or name suffix, and fans the cross-domain
+    searches out in parallel.
+    """
+
+    _instance = None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._domains = None
+        self._refreshed = 0
+        self._writers = {}
+        self._executor = None
+        self._stats = {}
+
+    @property
+    def refresh_interval(self):
+        return getattr(settings, "IPATUURA_DOMAIN_REFRESH", 30)
+
+    def reset(self, **kwargs):
+        """
+        Forget the active domains and their writable interfaces, they are
+        loaded again on the next request.
+        """
+        with self._lock:
+            self._domains = None
+            self._writers = {}
+
+    def domains(self):
+        """
+        Return the active integration domains, the most recent last
+        """
+        now = time.monotonic()
+        with self._lock:
+            if self._domains is None or now - self._refreshed > self.refresh_interval:
+                self._domains = list(
+                    Domain.objects.filter(is_active=True).order_by("id")
+                )
+                self._refreshed = now
+                # drop the writable interfaces of the removed domains
+                active = {d.pk for d in self._domains}
+                self._writers = {k: v for k, v in self._writers.items() if k in active}
+            return self._domains
+
+    def route(self, name=None):
+        """
+        Find the domain of a user or group name.
+
+        A name qualified with a domain name or realm (user@example.com,
+        user@EXAMPLE.COM) is routed to that domain, any other name to the
+        default domain, which is the most recent active one.
+
+        :param name: a user or group name
+        :returns: a Domain object
+        :raises Domain.DoesNotExist: if no domain is active
+        """
+        domains = self.domains()
+        if not domains:
+            raise Domain.DoesNotExist("No active integration domain")
+        if name and "@" in name:
+            suffix = name.rsplit("@", 1)[1].lower()
+            for domain in domains:
+                if suffix in (domain.name.lower(), domain.realm.lower()):
+                    return domain
+        return domains[-1]
+
+    def writer(self, domain):
+        """
+        Return the writable interface of a domain, created on first use.
+        """
+        from ipatuura.ipa import _IPA
+
+        with self._lock:
+            writer = self._writers.get(domain.pk)
+        if writer is None:
+            writer = _IPA(domain)
+            with self._lock:
+                writer = self._writers.setdefault(domain.pk, writer)
+        return writer
+
+    @contextmanager
+    def measure(self, domain):
+        """
+        Record the latency of an operation on a domain
+        """
+        start = time.monotonic()
+        failed = False
+        try:
+            yield
+        except Exception:
+            failed = True
+            raise
+        finally:
+            elapsed = time.monotonic() - start
+            with self._lock:
+                stats = self._stats.setdefault(
+                    domain.name, {"calls": 0, "errors": 0, "seconds": 0.0, "max": 0.0}
+                )
+                stats["calls"] += 1
+                stats["errors"] += failed
+                stats["seconds"] += elapsed
+                stats["max"] = max(stats["max"], elapsed)
+
+    def stats(self):
+        """
+        Return the number of calls, errors, total and maximum latency
+        in seconds of the operations, per domain name.
+        """
+        with self._lock:
+            return {name: dict(stats) for name, stats in self._stats.items()}
+
+    def _run(self, func, domain):
+        try:
+            with self.measure(domain):
+                return func(domain)
+        finally:
+            # the pooled threads outlive the request, close the database
+            # connections they opened
+            connections.close_all()
+
+    def fan_out(self, func, domains=None):
+        """
+        Call func(domain) in parallel for each active domain.
+
+        :param func: function called with a Domain object
+        :param domains: optional list of Domain objects, all the active
+                        domains by default
+        :returns: a list of (domain, result) for the calls that did not
+                  raise an exception, in the domains order
+        :raises AdmissionException: if a call was not admitted
+        """
+        if domains is None:
+            domains = self.domains()
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=getattr(settings, "IPATUURA_FANOUT_WORKERS", 8),
+                        thread_name_prefix="fanout",
+                    )
+
+        # the calls run in the context of the caller, within its trace
+        futures = [
+            (
+                d,
+                self._executor.submit(
+                    contextvars.copy_context().run, self._run, func, d
+                ),
+            )
+            for d in domains
+        ]
+        results = []
+        for domain, future in futures:
+            try:
+                results.append((domain, future.result()))
+            except AdmissionException:
+                # partial results would be mistaken for missing entries
+                raise
+            except Exception as e:
+                logger.debug(f"registry: {domain.name}: {e}")
+        return results
+
+
+def Registry():
+    if _Registry._instance is None:
+        _Registry._instance = _Registry()
+        post_save.connect(_Registry._instance.reset, sender=Domain)
+        post_delete.connect(_Registry._instance.reset, sender=Domain)
+    return _Registry._instance
@@ -0,0 +1,203 @@
+#
+# Copyright (C) 2023  FreeIPA Contributors see COPYING for license
+#
+
+import json
+import logging
+from itertools import islice
+from urllib.parse import urljoin
+
+from django.urls import reverse
+from django_scim import constants
+from django_scim.utils import get_base_scim_location_getter
+from ipatuura.sssd import SSSDNotFoundException
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+# Number of members encoded per chunk of a streamed group
+MEMBERS_PER_CHUNK = 100
+
+
+def dumps(d):
+    """
+    Encode a SCIM document as JSON, with orjson when it is installed.
+
+    :returns: bytes
+    """
+    if orjson is not None:
+        return orjson.dumps(d)
+    return json.dumps(d, separators=(",", ":")).encode(constants.ENCODING)
+
+
+class Locations:
+    """
+    Locations of the users and groups served in a request.
+
+    The URL of the resources is resolved once per request, instead of
+    once per group or member of the document.
+    """
+
+    def __init__(self, request):
+        base = get_base_scim_location_getter()(request)
+        self._users = self._prefix(base, "scim:users")
+        self._groups = self._prefix(base, "scim:groups")
+
+    @staticmethod
+    def _prefix(base, url_name):
+        path = reverse(url_name, kwargs={"uuid": "0"})
+        return urljoin(base, path[:-1])
+
+    def user(self, id):
+        return self._users + str(id)
+
+    def group(self, id):
+        return self._groups + str(id)
+
+
+def directory_groups(sssd_if, names):
+    """
+    Look up the groups of a user by name, skipping the groups not found.
+
+    :returns: a generator of SSSDGroup objects, without their members
+    """
+    for name in names:
+        try:
+            yield sssd_if.find_group_by_name(name)
+        except SSSDNotFoundException:
+            logger.debug(f"serializers: group {name} not found")
+
+
+def directory_members(sssd_if, names):
+    """
+    Look up the members of a group by name, skipping the users not found.
+
+    :returns: a generator of SSSDUser objects, without their groups
+    """
+    for name in names:
+        try:
+            yield sssd_if.find_user_by_name(name)
+        except SSSDNotFoundException:
+            logger.debug(f"serializers: user {name} not found")
+
+
+def _display_name(sssduser):
+    if sssduser.first_name and sssduser.last_name:
+        return f"{sssduser.first_name} {sssduser.last_name}"
+    return sssduser.username
+
+
+def _emails(mail):
+    if isinstance(mail, list):
+        return [
+            {"value": value, "primary": index == 0} for index, value in enumerate(mail)
+        ]
+    if mail:
+        return [{"value": mail, "primary": True}]
+    return []
+
+
+def _member(sssduser, locations):
+    return {
+        "value": str(sssduser.id),
+        "$ref": locations.user(sssduser.id),
+        "display": _display_name(sssduser),
+    }
+
+
+def user_to_dict(sssduser, groups, locations):
+    """
+    Return the SCIM document of a user of the integration domain, as
+    returned by the user adapter for the User built from it.
+
+    :param sssduser: SSSDUser object
+    :param groups: iterable of the SSSDGroup objects the user is member of
+    :param locations: Locations of the request
+    """
+    id = str(sssduser.id)
+    display_name = _display_name(sssduser)
+    return {
+        "id": id,
+        "externalId": None,
+        "schemas": [constants.SchemaURI.USER],
+        "userName": sssduser.username,
+        "name": {
+            "givenName": sssduser.first_name,
+            "familyName": sssduser.last_name,
+            "formatted": display_name,
+        },
+        "displayName": display_name,
+        "emails": _emails(sssduser.mail),
+        "active": sssduser.active,
+        "groups": [
+            {
+                "value": str(group.id),
+                "$ref": locations.group(group.id),
+                "display": group.name,
+            }
+            for group in groups
+        ],
+        "meta": {"resourceType": "User", "location": locations.user(id)},
+    }
+
+
+def group_to_dict(id, display_name, members, locations, external_id=None):
+    """
+    Return the SCIM document of a group, as returned by the group
+    adapter for the Group built from it.
+
+    :param id: SCIM id of the group
+    :param display_name: name of the group
+    :param members: iterable of the SSSDUser objects member of the group
+    :param locations: Locations of the request
+    :param external_id: externalId of a group stored locally
+    """
+    return {
+        "id": str(id),
+        "externalId": external_id,
+        "schemas": [constants.SchemaURI.GROUP],
+        "displayName": display_name,
+        "members": [_member(sssduser, locations) for sssduser in members],
+        "meta": {"resourceType": "Group", "location": locations.group(id)},
+    }
+
+
+def iter_group_json(id, display_name, members, locations, external_id=None):
+    """
+    Generate the JSON document of a group by chunks, see group_to_dict().
+
+    The members are looked up and encoded as the client reads the
+    document, MEMBERS_PER_CHUNK at a time. The status of the response is
+    already sent: when a lookup fails, the error is logged and the
+    document ends with the members encoded so far.
+
+    :returns: a generator of bytes
+    """
+    document = group_to_dict(id, display_name, (), locations, external_id)
+    meta = document.pop("meta")
+    # the members are the last attribute, leave their list open
+    yield dumps(document)[: -len(b"]}")]
+    members = iter(members)
+    separator = b""
+    count = 0
+    while True:
+        try:
+            chunk = [
+                dumps(_member(u, locations)) for u in islice(members, MEMBERS_PER_CHUNK)
+            ]
+        except Exception as e:
+            logger.error(
+                f"serializers: group {display_name} truncated after {count} "
+                f"members: {e}"
+            )
+            break
+        if not chunk:
+            break
+        yield separator + b",".join(chunk)
+        separator = b","
+        count += len(chunk)
+    yield b'],"meta":' + dumps(meta) + b"}"
@@ -2,7 +2,20 @@
 # Copyright (C) 2022  FreeIPA Contributors see COPYING for license
 #
 
+import functools
+import logging
+import subprocess
+import threading
+import time
+from collections import OrderedDict, deque
+
 import dbus
+from ipatuura.admission import INFOPIPE, admitted
+from ipatuura.mapping import attribute_map
+from ipatuura.metrics import INFOPIPE_SECONDS
+from ipatuura.tracing import KIND_CLIENT, span, traced
+
+logger = logging.getLogger(__name__)
 
 DBUS_SSSD_NAME = "org.freedesktop.sssd.infopipe"
 DBUS_SSSD_PATH = "/org/freedesktop/sssd/infopipe"
@@ -15,6 +28,105 @@ DBUS_SSSD_GROUPS_PATH = "/org/freedesktop/sssd/infopipe/Groups"
 DBUS_SSSD_GROUPS_IF = "org.freedesktop.sssd.infopipe.Groups"
 DBUS_SSSD_GROUP_IF = "org.freedesktop.sssd.infopipe.Groups.Group"
 
+# Number of recently looked up users and groups kept to pre-warm the caches
+HOT_SET_SIZE = 256
+# Number of lookup latencies kept for the statistics
+LATENCY_WINDOW = 1000
+
+# DBus errors of the calls to an infopipe responder that restarted, the
+# DBus objects are still bound to the connection of the previous process
+STALE_CONNECTION_ERRORS = (
+    "org.freedesktop.DBus.Error.ServiceUnknown",
+    "org.freedesktop.DBus.Error.NameHasNoOwner",
+    "org.freedesktop.DBus.Error.Disconnected",
+)
+# DBus error of a lookup matching no user or group
+NOT_FOUND_ERROR = "org.freedesktop.sssd.Error.NotFound"
+
+
+def _path_id(path):
+    # the object path of a user or group ends with its uidNumber/gidNumber
+    return int(str(path).rsplit("/", 1)[1])
+
+
+def invalidate_cache(user=None, group=None):
+    """
+    Invalidate the SSSD cache entry of a single user or group,
+    so that the next lookup fetches it from the identity provider.
+
+    :param user: a str containing the user name
+    :param group: a str containing the group name
+    """
+    args = ["sss_cache"]
+    if user is not None:
+        args += ["-u", user]
+    if group is not None:
+        args += ["-g", group]
+    try:
+        proc = subprocess.run(args, capture_output=True, text=True)
+    except OSError as e:
+        logger.info(f"sss_cache not available: {e}")
+        return
+    if proc.returncode != 0:
+        logger.info(f"sss_cache {args[1:]}: {proc.stderr}")
+
+
+class _TimedInterface:
+    """
+    DBus interface recording the latency and a span of its method calls
+    """
+
+    def __init__(self, obj, interface):
+        self._iface = dbus.Interface(obj, interface)
+        self._name = interface.rsplit(".", 1)[-1]
+
+    def __getattr__(self, method):
+        call = getattr(self._iface, method)
+        name = f"{self._name}.{method}"
+        histogram = INFOPIPE_SECONDS.labels(name)
+
+        def timed(*args, **kwargs):
+            with histogram.time(), span(f"dbus.{name}", KIND_CLIENT):
+                try:
+                    return call(*args, **kwargs)
+                except dbus.exceptions.DBusException as e:
+                    if e.get_dbus_name() in STALE_CONNECTION_ERRORS:
+                        raise StaleConnectionException(str(e)) from e
+                    raise
+
+        return timed
+
+
+class StaleConnectionException(Exception):
+    """
+    Exception returned when the infopipe responder restarted since the
+    connection to it was opened.
+    """
+
+    pass
+
+
+def _reconnecting(func):
+    """
+    Connect again to the infopipe responder once it restarted, and retry
+    the call once.
+    """
+
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        generation = self._generation
+        try:
+            return func(self, *args, **kwargs)
+        except StaleConnectionException as e:
+            logger.info(f"SSSD infopipe restarted, connecting again: {e}")
+            self._reconnect_stale(generation)
+        try:
+            return func(self, *args, **kwargs)
+        except StaleConnectionException as e:
+            raise SSSDNotFoundException(f"SSSD infopipe not available: {e}")
+
+    return wrapper
+
 
 class SSSDNotFoundException(Exception):
     """
@@ -74,20 +186,98 @@ class _SSSD:
         """
         Initialization of the DBus objects and interfaces.
         """
+        self._lock = threading.Lock()
+        self._hot_users = OrderedDict()
+        self._hot_groups = OrderedDict()
+        self._latencies = deque(maxlen=LATENCY_WINDOW)
+        self._connect_lock = threading.Lock()
+        self._generation = 0
+        self.reconnect()
+
+    @traced("sssd.reconnect")
+    def reconnect(self):
+        """
+        Connect again to the infopipe responder, needed once it restarted
+        since the DBus objects are bound to the previous process. The
+        lookups do it when they fail with a stale connection.
+        """
+        self._generation += 1
         try:
             self._bus = dbus.SystemBus()
             self._sssd_obj = self._bus.get_object(DBUS_SSSD_NAME, DBUS_SSSD_PATH)
-            self._sssd_iface = dbus.Interface(self._sssd_obj, DBUS_SSSD_IF)
+            self._sssd_iface = _TimedInterface(self._sssd_obj, DBUS_SSSD_IF)
             self._users_obj = self._bus.get_object(DBUS_SSSD_NAME, DBUS_SSSD_USERS_PATH)
-            self._users_iface = dbus.Interface(self._users_obj, DBUS_SSSD_USERS_IF)
+            self._users_iface = _TimedInterface(self._users_obj, DBUS_SSSD_USERS_IF)
             self._groups_obj = self._bus.get_object(
                 DBUS_SSSD_NAME, DBUS_SSSD_GROUPS_PATH
             )
-            self._groups_iface = dbus.Interface(self._groups_obj, DBUS_SSSD_GROUPS_IF)
+            self._groups_iface = _TimedInterface(self._groups_obj, DBUS_SSSD_GROUPS_IF)
         except dbus.DBusException:
             # TBD: add some logging
             raise SSSDNotFoundException
 
+    def _reconnect_stale(self, generation):
+        """
+        Connect again, unless another thread did it since the connection
+        of the given generation went stale
+        """
+        with self._connect_lock:
+            if self._generation == generation:
+                self.reconnect()
+
+    def _record(self, hot, name, start):
+        with self._lock:
+            self._latencies.append(time.monotonic() - start)
+            hot[name] = None
+            hot.move_to_end(name)
+            if len(hot) > HOT_SET_SIZE:
+                hot.popitem(last=False)
+
+    def lookup_stats(self, reset=False):
+        """
+        Return the count, mean, median, 95th percentile and maximum
+        in seconds of the latest lookup latencies.
+
+        :param reset: if True, start a new measurement window
+        """
+        with self._lock:
+            samples = sorted(self._latencies)
+            if reset:
+                self._latencies.clear()
+        if not samples:
+            return {"count": 0}
+        return {
+            "count": len(samples),
+            "mean": sum(samples) / len(samples),
+            "p50": samples[len(samples) // 2],
+            "p95": samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+            "max": samples[-1],
+        }
+
+    @traced("sssd.prewarm")
+    def prewarm(self):
+        """
+        Look up again the recently used users and groups, so that SSSD
+        fills its caches before the clients need them.
+
+        :returns: the number of entries looked up
+        """
+        with self._lock:
+            users = list(self._hot_users)
+            groups = list(self._hot_groups)
+        for name in users:
+            try:
+                self.find_user_by_name(name)
+            except SSSDNotFoundException:
+                pass
+        for name in groups:
+            try:
+                self.find_group_by_name(name)
+            except SSSDNotFoundException:
+                pass
+        return len(users) + len(groups)
+
+    @traced("sssd._get_user_name")
     def _get_user_name(self, user_path):
         """
         Retrieve the user name for a given DBus user_path.
@@ -96,10 +286,11 @@ class _SSSD:
         :returns: a str containing the user name
         """
         user_obj = self._bus.get_object(DBUS_SSSD_NAME, user_path)
-        user_iface = dbus.Interface(user_obj, DBUS_PROPERTY_IF)
+        user_iface = _TimedInterface(user_obj, DBUS_PROPERTY_IF)
         name = user_iface.Get(DBUS_SSSD_USER_IF, "name")
         return str(name)
 
+    @traced("sssd._get_group_from_path")
     def _get_group_from_path(self, group_path, retrieve_members=False):
         """
         Retrieve the group for a given DBus group_path.
@@ -109,14 +300,14 @@ class _SSSD:
         :returns: a SSSDGroup object
         """
         group_obj = self._bus.get_object(DBUS_SSSD_NAME, group_path)
-        group_props = dbus.Interface(group_obj, DBUS_PROPERTY_IF)
+        group_props = _TimedInterface(group_obj, DBUS_PROPERTY_IF)
         name = group_props.Get(DBUS_SSSD_GROUP_IF, "name")
         id = group_props.Get(DBUS_SSSD_GROUP_IF, "gidNumber")
 
         sssdgroup = SSSDGroup(int(id), str(name))
 
         if retrieve_members:
-            group_iface = dbus.Interface(group_obj, DBUS_SSSD_GROUP_IF)
+            group_iface = _TimedInterface(group_obj, DBUS_SSSD_GROUP_IF)
             group_iface.UpdateMemberList(id)
             members = group_props.Get(DBUS_SSSD_GROUP_IF, "users")
             # Transform the users (object path) into names
@@ -124,6 +315,9 @@ class _SSSD:
             sssdgroup.set_members(users)
         return sssdgroup
 
+    @traced("sssd.find_group_by_name")
+    @_reconnecting
+    @admitted(INFOPIPE)
     def find_group_by_name(self, name, retrieve_members=False):
         """
         Find the group with the specified name.
@@ -133,12 +327,18 @@ class _SSSD:
         :returns: a SSSDGroup object
         :raises SSSDNotFoundException: if no group matching the name exists
         """
+        start = time.monotonic()
         try:
             group_path = self._groups_iface.FindByName(name)
-            return self._get_group_from_path(group_path, retrieve_members)
+            sssdgroup = self._get_group_from_path(group_path, retrieve_members)
         except dbus.exceptions.DBusException:
             raise SSSDNotFoundException("Group {} not found".format(name))
+        self._record(self._hot_groups, sssdgroup.name, start)
+        return sssdgroup
 
+    @traced("sssd.find_group_by_id")
+    @_reconnecting
+    @admitted(INFOPIPE)
     def find_group_by_id(self, id, retrieve_members=False):
         """
         Find the group with the specified id.
@@ -148,12 +348,16 @@ class _SSSD:
         :returns: a SSSDGroup object
         :raises SSSDNotFoundException: if no group matching the id exists
         """
+        start = time.monotonic()
         try:
             group_path = self._groups_iface.FindByID(id)
-            return self._get_group_from_path(group_path, retrieve_members)
+            sssdgroup = self._get_group_from_path(group_path, retrieve_members)
         except dbus.exceptions.DBusException:
             raise SSSDNotFoundException("Group {} not found".format(id))
+        self._record(self._hot_groups, sssdgroup.name, start)
+        return sssdgroup
 
+    @traced("sssd._get_user_from_path")
     def _get_user_from_path(self, user_path, retrieve_groups=False):
         """
         Retrieve the user for a given DBus user_path.
@@ -163,31 +367,14 @@ class _SSSD:
         :returns: a SSSDUser object
         """
         user_obj = self._bus.get_object(DBUS_SSSD_NAME, user_path)
-        user_iface = dbus.Interface(user_obj, DBUS_PROPERTY_IF)
+        user_iface = _TimedInterface(user_obj, DBUS_PROPERTY_IF)
         name = user_iface.Get(DBUS_SSSD_USER_IF, "name")
         id = user_iface.Get(DBUS_SSSD_USER_IF, "uidNumber")
 
-        kwargs = dict()
+        # The SSSD names bound to the SCIM fields do not depend on the
+        # domain, only their LDAP names do
         extra_attrs = user_iface.Get(DBUS_SSSD_USER_IF, "extraAttributes")
-
-        # Retrieve firstname
-        givenname = extra_attrs.get("givenname")
-        if givenname:
-            kwargs["givenname"] = str(givenname[0])
-        # Retrieve lastname
-        sn = extra_attrs.get("sn")
-        if sn:
-            kwargs["sn"] = str(sn[0])
-        # Retrieve email
-        mail = extra_attrs.get("mail")
-        if mail:
-            kwargs["mail"] = [str(x) for x in mail]
-        # Retrieve active state
-        locked = extra_attrs.get("lock")
-        if locked and str(locked[0]).lower() == "true":
-            kwargs["active"] = False
-        else:
-            kwargs["active"] = True
+        kwargs = attribute_map().read(extra_attrs)
 
         if retrieve_groups:
             groups = self._sssd_iface.GetUserGroups(name)
@@ -197,6 +384,9 @@ class _SSSD:
         sssduser = SSSDUser(id, name, **kwargs)
         return sssduser
 
+    @traced("sssd.find_user_by_name")
+    @_reconnecting
+    @admitted(INFOPIPE)
     def find_user_by_name(self, username, retrieve_groups=False):
         """
         Find the user with the specified name.
@@ -206,12 +396,18 @@ class _SSSD:
         :returns: a SSSDUser object
         :raises SSSDNotFoundException: if no user matching the name exists
         """
+        start = time.monotonic()
         try:
             user_path = self._users_iface.FindByName(username)
-            return self._get_user_from_path(user_path, retrieve_groups)
+            sssduser = self._get_user_from_path(user_path, retrieve_groups)
         except dbus.exceptions.DBusException:
             raise SSSDNotFoundException("User {} not found".format(username))
+        self._record(self._hot_users, str(sssduser.username), start)
+        return sssduser
 
+    @traced("sssd.find_user_by_id")
+    @_reconnecting
+    @admitted(INFOPIPE)
     def find_user_by_id(self, id, retrieve_groups=False):
         """
         Find the user with the specified id.
@@ -221,12 +417,18 @@ class _SSSD:
         :returns: a SSSDUser object
         :raises SSSDNotFoundException: if no user matching the id exists
         """
+        start = time.monotonic()
         try:
             user_path = self._users_iface.FindByID(id)
-            return self._get_user_from_path(user_path, retrieve_groups)
+            sssduser = self._get_user_from_path(user_path, retrieve_groups)
         except dbus.exceptions.DBusException:
             raise SSSDNotFoundException("User {} not found".format(id))
+        self._record(self._hot_users, str(sssduser.username), start)
+        return sssduser
 
+    @traced("sssd.find_user_groups")
+    @_reconnecting
+    @admitted(INFOPIPE)
     def find_user_groups(self, username):
         """
         Find the groups for the specified user.
@@ -247,6 +449,79 @@ class _SSSD:
         except dbus.exceptions.DBusException:
             raise SSSDNotFoundException("User {} not found".format(username))
 
+    def _list(self, iface, name_filter, limit):
+        try:
+            paths = iface.ListByName(name_filter, dbus.UInt32(limit))
+        except dbus.exceptions.DBusException as e:
+            if e.get_dbus_name() != NOT_FOUND_ERROR:
+                raise
+            # no entry matches the filter
+            return []
+        return sorted((_path_id(path), path) for path in paths)
+
+    @traced("sssd.list_users")
+    @_reconnecting
+    @admitted(INFOPIPE)
+    def list_users(self, name_filter="*", limit=0):
+        """
+        Enumerate the users whose name matches a filter, without their
+        attributes. SSSD returns at most limit users, or wildcard_limit
+        of its [ifp] section when limit is 0.
+
+        :param name_filter: a name, * matches any string
+        :returns: a list of (uidNumber, object path) sorted by uidNumber
+        """
+        return self._list(self._users_iface, name_filter, limit)
+
+    @traced("sssd.list_groups")
+    @_reconnecting
+    @admitted(INFOPIPE)
+    def list_groups(self, name_filter="*", limit=0):
+        """
+        Enumerate the groups whose name matches a filter, without their
+        attributes, see list_users().
+
+        :returns: a list of (gidNumber, object path) sorted by gidNumber
+        """
+        return self._list(self._groups_iface, name_filter, limit)
+
+    @traced("sssd.get_user")
+    @_reconnecting
+    @admitted(INFOPIPE)
+    def get_user(self, user_path, retrieve_groups=False):
+        """
+        Retrieve a user enumerated by list_users().
+
+        Unlike the find methods, the user is not recorded as recently
+        used: an enumeration would evict the users pre-warmed by prewarm().
+
+        :param user_path: the object path of the user
+        :param retrieve_groups: if True, also fill in the groups of the user
+        :returns: a SSSDUser object
+        :raises SSSDNotFoundException: if the user no longer exists
+        """
+        try:
+            return self._get_user_from_path(user_path, retrieve_groups)
+        except dbus.exceptions.DBusException:
+            raise SSSDNotFoundException("User {} not found".format(user_path))
+
+    @traced("sssd.get_group")
+    @_reconnecting
+    @admitted(INFOPIPE)
+    def get_group(self, group_path, retrieve_members=False):
+        """
+        Retrieve a group enumerated by list_groups(), see get_user().
+
+        :param group_path: the object path of the group
+        :param retrieve_members: if True, also fill in the members of the group
+        :returns: a SSSDGroup object
+        :raises SSSDNotFoundException: if the group no longer exists
+        """
+        try:
+            return self._get_group_from_path(group_path, retrieve_members)
+        except dbus.exceptions.DBusException:
+            raise SSSDNotFoundException("Group {} not found".format(group_path))
+
 
 def SSSD():
     if _SSSD._instance is None:
@@ -2,6 +2,1137 @@
 # Copyright (C) 2022  FreeIPA Contributors see COPYING for license
 #
 
-# from django.test import TestCase
+import json
+import os
+import threading
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+import dbus
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import caches
+from django.core.management import call_command
+from django.db import connection, connections
+from django.http import HttpResponse, StreamingHttpResponse
+from django.test import RequestFactory, TestCase
+from django.utils import timezone
+from django.views.generic import View
+from django_scim import exceptions
+from domains.models import Domain
+from ipatuura import changelog, metrics, outbox, serializers, tracing
+from ipatuura.adapters import SCIMGroup, SCIMUser
+from ipatuura.admission import (
+    Admission,
+    BackendOverloadedException,
+    BackendTimeoutException,
+    _Gate,
+)
+from ipatuura.ipa import _IPA, LDAPWriteException
+from ipatuura.mapping import attribute_map
+from ipatuura.middleware import AdmissionMiddleware, TracingMiddleware
+from ipatuura.models import (
+    ChangeEvent,
+    Group,
+    GroupUnavailableException,
+    OutboxEntry,
+    SSSDGroupToGroupModel,
+    SSSDUserToUserModel,
+    User,
+)
+from ipatuura.overlay import DELETED, Overlay
+from ipatuura.prefork import after_fork
+from ipatuura.registry import Registry
+from ipatuura.sssd import (
+    _SSSD,
+    SSSD,
+    SSSDGroup,
+    SSSDNotFoundException,
+    SSSDUser,
+    StaleConnectionException,
+    _TimedInterface,
+)
+from ipatuura.views import ChangesView, GroupsView, IdempotencyMixin, MetricsView
+
+
+@mock.patch("ipatuura.adapters.IPA")
+class UserPatchTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(
+            scim_username="alice", email="alice@example.test"
+        )
+
+    def patch(self, *operations):
+        scim_user = SCIMUser(User.objects.get(id=self.user.id))
+        scim_user.handle_operations(list(operations))
+        return scim_user.obj
+
+    def test_typed_email(self, ipa):
+        self.patch(
+            {
+                "op": "replace",
+                "path": 'emails[type eq "work"].value',
+                "value": "alice@ipa.test",
+            }
+        )
+        ipa.return_value.user_mod.assert_called_once_with(
+            mock.ANY, {"mail": (["alice@example.test"], ["alice@ipa.test"])}
+        )
+
+    def test_typed_email_without_path(self, ipa):
+        # Azure AD sends the filtered paths as keys of the value
+        user = self.patch(
+            {"op": "add", "value": {'emails[type eq "work"].value': "alice@ipa.test"}}
+        )
+        self.assertEqual(user.email, "alice@ipa.test")
+
+    def test_typed_email_removed(self, ipa):
+        user = self.patch({"op": "remove", "path": 'emails[type eq "work"]'})
+        self.assertEqual(user.email, "")
+
+    def test_other_email_type(self, ipa):
+        with self.assertRaises(exceptions.BadRequestError):
+            self.patch(
+                {
+                    "op": "replace",
+                    "path": 'emails[type eq "home"].value',
+                    "value": "alice@home.test",
+                }
+            )
+        ipa.return_value.user_mod.assert_not_called()
+
+    def test_active_string(self, ipa):
+        user = self.patch({"op": "replace", "value": {"active": "False"}})
+        self.assertFalse(user.is_active)
+        user = self.patch({"op": "replace", "path": "active", "value": "True"})
+        self.assertTrue(user.is_active)
+
+    def test_unchanged(self, ipa):
+        self.patch(
+            {
+                "op": "replace",
+                "path": "emails",
+                "value": [{"value": "alice@example.test"}],
+            }
+        )
+        ipa.return_value.user_mod.assert_not_called()
+
+
+@mock.patch("ipatuura.adapters.IPA")
+class GroupPatchTest(TestCase):
+    def setUp(self):
+        for id, name in enumerate(("alice", "bob", "carol"), start=1001):
+            user = User.objects.create(scim_username=name)
+            User.objects.filter(id=user.id).update(scim_id=str(id))
+        self.group = Group(scim_display_name="admins")
+        self.group.name = "admins"
+        self.group.save()
+        # the membership is read from SSSD
+        self.group.user_set.set(
+            list(User.objects.filter(scim_username__in=("alice", "bob")))
+        )
+
+    def patch(self, *operations):
+        scim_group = SCIMGroup(self.group)
+        scim_group.handle_operations(list(operations))
+        return scim_group
+
+    def test_add(self, ipa):
+        scim_group = self.patch(
+            {"op": "add", "path": "members", "value": [{"value": "1003"}]}
+        )
+        ipa.return_value.group_add_member.assert_called_once_with(scim_group, ["carol"])
+        ipa.return_value.group_remove_member.assert_not_called()
+
+    def test_remove_filtered(self, ipa):
+        scim_group = self.patch({"op": "remove", "path": 'members[value eq "1001"]'})
+        ipa.return_value.group_remove_member.assert_called_once_with(
+            scim_group, ["alice"]
+        )
+        self.assertEqual(scim_group.member_names(), {"bob"})
+
+    def test_remove_filtered_or(self, ipa):
+        scim_group = self.patch(
+            {"op": "remove", "path": 'members[value eq "1001" or value eq "1002"]'}
+        )
+        ipa.return_value.group_remove_member.assert_called_once_with(
+            scim_group, ["alice", "bob"]
+        )
+
+    def test_remove_values(self, ipa):
+        scim_group = self.patch(
+            {"op": "remove", "path": "members", "value": [{"value": "1002"}]}
+        )
+        ipa.return_value.group_remove_member.assert_called_once_with(
+            scim_group, ["bob"]
+        )
+
+    def test_replace_filtered(self, ipa):
+        scim_group = self.patch(
+            {
+                "op": "replace",
+                "path": 'members[value eq "1001"]',
+                "value": {"value": "1003"},
+            }
+        )
+        ipa.return_value.group_add_member.assert_called_once_with(scim_group, ["carol"])
+        ipa.return_value.group_remove_member.assert_called_once_with(
+            scim_group, ["alice"]
+        )
+
+    def test_replace(self, ipa):
+        scim_group = self.patch(
+            {
+                "op": "replace",
+                "path": "members",
+                "value": [{"value": "1002"}, {"value": "1003"}],
+            }
+        )
+        ipa.return_value.group_add_member.assert_called_once_with(scim_group, ["carol"])
+        ipa.return_value.group_remove_member.assert_called_once_with(
+            scim_group, ["alice"]
+        )
+
+    def test_unsupported_filters(self, ipa):
+        for operation in (
+            {"op": "add", "path": 'members[value eq "1003"]', "value": []},
+            {"op": "remove", "path": 'members[display eq "alice"]'},
+            {"op": "remove", "path": 'members[value ne "1001"]'},
+        ):
+            with self.assertRaises(exceptions.BadRequestError):
+                self.patch(operation)
+        ipa.assert_not_called()
+
+    @mock.patch("ipatuura.models.SSSD")
+    def test_membership_unavailable(self, sssd, ipa):
+        sssd.return_value.find_group_by_name.side_effect = SSSDNotFoundException
+        with self.assertRaises(GroupUnavailableException):
+            Group.objects.get(id=self.group.id)
+
+
+class OutboxTest(TestCase):
+    def queue(self, username, operation=OutboxEntry.Operation.MODIFY, **kwargs):
+        return OutboxEntry.objects.create(
+            username=username, operation=operation, **kwargs
+        )
+
+    def test_claim_oldest_write_of_each_user(self):
+        first = self.queue("alice", OutboxEntry.Operation.ADD)
+        self.queue("alice")
+        other = self.queue("bob")
+
+        claimed = {outbox.claim("w1").id, outbox.claim("w2").id}
+        self.assertEqual(claimed, {first.id, other.id})
+        # the second write of alice waits for the first one
+        self.assertIsNone(outbox.claim("w3"))
+
+    def test_claim_large_backlog(self):
+        # a long queue of a single user ahead of the others
+        OutboxEntry.objects.bulk_create(
+            OutboxEntry(username="alice", operation=OutboxEntry.Operation.MODIFY)
+            for _ in range(20000)
+        )
+        OutboxEntry.objects.bulk_create(
+            OutboxEntry(username=f"user{i}", operation=OutboxEntry.Operation.MODIFY)
+            for i in range(20000)
+        )
+        first = OutboxEntry.objects.first()
+
+        # one query to find the head, one to claim it
+        with self.assertNumQueries(2):
+            self.assertEqual(outbox.claim("w1").id, first.id)
+        with self.assertNumQueries(2):
+            self.assertEqual(outbox.claim("w2").username, "user0")
+
+    def test_group_writes_in_order(self):
+        user = self.queue("alice", OutboxEntry.Operation.ADD)
+        group = self.queue(
+            "admins",
+            OutboxEntry.Operation.ADD,
+            resource_type=OutboxEntry.ResourceType.GROUP,
+        )
+        after = self.queue("bob", OutboxEntry.Operation.ADD)
+
+        # the group waits for the user it may have as member
+        self.assertEqual(outbox.claim("w1").id, user.id)
+        self.assertIsNone(outbox.claim("w2"))
+        OutboxEntry.objects.filter(id=user.id).delete()
+        self.assertEqual(outbox.claim("w2").id, group.id)
+        # and the next writes wait for the group
+        self.assertIsNone(outbox.claim("w3"))
+        OutboxEntry.objects.filter(id=group.id).delete()
+        self.assertEqual(outbox.claim("w3").id, after.id)
+
+    @mock.patch("ipatuura.adapters.IPA")
+    def test_group_save_queued(self, ipa):
+        request = RequestFactory().post("/scim/v2/Groups")
+        scim_group = SCIMGroup(Group(), request=request)
+        scim_group.from_dict({"displayName": "admins"})
+        scim_group.obj.user_set.set([User(scim_username="alice")])
+        with self.settings(IPATUURA_WRITE_MODE="outbox"):
+            scim_group.save()
+
+        ipa.assert_not_called()
+        self.assertTrue(request.ipatuura_write_queued)
+        entry = OutboxEntry.objects.get()
+        self.assertEqual(
+            (entry.resource_type, entry.username, entry.operation, entry.payload),
+            (
+                OutboxEntry.ResourceType.GROUP,
+                "admins",
+                OutboxEntry.Operation.ADD,
+                {"added": ["alice"], "removed": []},
+            ),
+        )
+
+        with mock.patch.object(outbox, "IPA") as writer:
+            outbox.process(outbox.claim("w1"))
+        written, members = writer.return_value.group_add.call_args.args
+        self.assertEqual((written.group_name, members), ("admins", ["alice"]))
+        self.assertFalse(OutboxEntry.objects.exists())
+
+    def test_gauges(self):
+        self.queue("alice")
+        self.queue("bob", status=OutboxEntry.Status.FAILED)
+        self.queue("bob")
+
+        content = metrics.render()[0].decode()
+        self.assertIn("ipatuura_outbox_depth 2.0", content)
+        self.assertIn("ipatuura_outbox_failed 1.0", content)
+        self.assertIn("ipatuura_outbox_blocked 1.0", content)
+
+    def test_claim_sets_the_lease(self):
+        self.queue("alice")
+        entry = outbox.claim("w1")
+        entry.refresh_from_db()
+        self.assertEqual(entry.status, OutboxEntry.Status.RUNNING)
+        self.assertEqual(entry.owner, "w1")
+        self.assertGreater(entry.lease_expires, timezone.now())
+
+    def test_failed_write_blocks_its_user(self):
+        self.queue("alice", OutboxEntry.Operation.ADD, status=OutboxEntry.Status.FAILED)
+        self.queue("alice")
+        self.queue("alice", OutboxEntry.Operation.DELETE)
+
+        self.assertIsNone(outbox.claim("w1"))
+        self.assertEqual(outbox.stats()["blocked"], 2)
+
+        self.assertEqual(outbox.retry_failed(), 1)
+        self.assertEqual(outbox.claim("w1").operation, OutboxEntry.Operation.ADD)
+
+    def test_discard_failed_unblocks_its_user(self):
+        self.queue("alice", OutboxEntry.Operation.ADD, status=OutboxEntry.Status.FAILED)
+        modify = self.queue("alice")
+
+        self.assertEqual(outbox.discard_failed(), 1)
+        self.assertEqual(outbox.claim("w1").id, modify.id)
+
+    def test_recover_only_expired_leases(self):
+        now = timezone.now()
+        live = self.queue(
+            "alice",
+            status=OutboxEntry.Status.RUNNING,
+            owner="w1",
+            lease_expires=now + timedelta(seconds=60),
+        )
+        expired = self.queue(
+            "bob",
+            status=OutboxEntry.Status.RUNNING,
+            owner="w2",
+            lease_expires=now - timedelta(seconds=1),
+        )
+
+        self.assertEqual(outbox.recover(), 1)
+        live.refresh_from_db()
+        expired.refresh_from_db()
+        self.assertEqual(live.status, OutboxEntry.Status.RUNNING)
+        self.assertEqual(expired.status, OutboxEntry.Status.PENDING)
+        self.assertEqual(expired.owner, "")
+
+    def test_renew_extends_own_leases(self):
+        soon = timezone.now() + timedelta(seconds=1)
+        mine = self.queue(
+            "alice", status=OutboxEntry.Status.RUNNING, owner="w1", lease_expires=soon
+        )
+        theirs = self.queue(
+            "bob", status=OutboxEntry.Status.RUNNING, owner="w2", lease_expires=soon
+        )
+
+        outbox.renew("w1")
+        mine.refresh_from_db()
+        theirs.refresh_from_db()
+        self.assertGreater(mine.lease_expires, soon)
+        self.assertEqual(theirs.lease_expires, soon)
+
+    def test_process_releases_the_lease_on_failure(self):
+        self.queue("alice")
+        entry = outbox.claim("w1")
+
+        with mock.patch.object(outbox, "apply", side_effect=RuntimeError("down")):
+            outbox.process(entry)
+        entry.refresh_from_db()
+        self.assertEqual(entry.status, OutboxEntry.Status.PENDING)
+        self.assertEqual(entry.attempts, 1)
+        self.assertEqual(entry.owner, "")
+
+    def test_process_retries_rejected_write(self):
+        self.queue("alice")
+        entry = outbox.claim("w1")
+
+        with mock.patch.object(outbox, "IPA") as ipa:
+            ipa.return_value.user_mod.side_effect = LDAPWriteException("Busy")
+            outbox.process(entry)
+        entry.refresh_from_db()
+        self.assertEqual(entry.status, OutboxEntry.Status.PENDING)
+        self.assertEqual(entry.last_error, "Busy")
+        self.assertGreater(entry.next_attempt, timezone.now())
+
+    def test_process_ignores_lost_lease(self):
+        self.queue("alice")
+        entry = outbox.claim("w1")
+        # taken over by another worker meanwhile
+        OutboxEntry.objects.filter(id=entry.id).update(owner="w2")
+
+        with mock.patch.object(outbox, "apply", side_effect=RuntimeError("down")):
+            with self.assertLogs("ipatuura.outbox", "WARNING"):
+                outbox.process(entry)
+        entry.refresh_from_db()
+        self.assertEqual(entry.owner, "w2")
+        self.assertEqual(entry.status, OutboxEntry.Status.RUNNING)
+
+
+class OverlayTest(TestCase):
+    def setUp(self):
+        self.addCleanup(caches["overlay"].clear)
+
+    def test_lookup_by_name_and_uid_number(self):
+        Overlay().record(SSSDUser(1500, "alice", givenname="Alice"))
+
+        self.assertEqual(Overlay().lookup(username="alice").first_name, "Alice")
+        self.assertEqual(Overlay().lookup(id="1500").username, "alice")
+        self.assertIsNone(Overlay().lookup(id=1501))
+
+    def test_unknown_uid_number(self):
+        Overlay().record(SSSDUser(None, "alice"))
+
+        self.assertIsNotNone(Overlay().lookup(username="alice"))
+        self.assertIsNone(Overlay().lookup(id=None))
+
+    def test_deleted(self):
+        Overlay().record_deleted("alice", 1500)
+
+        self.assertIs(Overlay().lookup(username="alice"), DELETED)
+        self.assertIs(Overlay().lookup(id=1500), DELETED)
+
+    def test_missing_table(self):
+        with connection.cursor() as cursor:
+            cursor.execute("DROP TABLE ipatuura_overlay")
+
+        with self.assertLogs("ipatuura.overlay", "WARNING"):
+            Overlay().record(SSSDUser(1500, "alice"))
+            self.assertIsNone(Overlay().lookup(username="alice"))
+
+        # created again along with the migrations
+        call_command("migrate", verbosity=0)
+        Overlay().record(SSSDUser(1500, "alice"))
+        self.assertIsNotNone(Overlay().lookup(username="alice"))
+
+    @mock.patch("ipatuura.adapters.SSSD")
+    def test_recorded_with_uid_number(self, sssd):
+        sssd.return_value.find_user_by_name.return_value = SSSDUser(1500, "alice")
+        user = User.objects.create(scim_username="alice", first_name="Alice")
+
+        sssduser = SCIMUser(user).to_sssd_user()
+        self.assertEqual(sssduser.id, 1500)
+        self.assertEqual(sssduser.first_name, "Alice")
+
+    @mock.patch("ipatuura.adapters.SSSD")
+    def test_not_recorded_with_local_id(self, sssd):
+        sssd.return_value.find_user_by_name.side_effect = SSSDNotFoundException
+        user = User.objects.create(scim_username="alice")
+
+        self.assertIsNone(SCIMUser(user).to_sssd_user().id)
+
+
+@mock.patch("ipatuura.adapters.IPA")
+class LocalPasswordTest(TestCase):
+    def save(self, d, user=None):
+        scim_user = SCIMUser(user or User())
+        scim_user.from_dict(d)
+        with mock.patch(
+            "ipatuura.adapters.make_password", wraps=make_password
+        ) as hashed:
+            scim_user.save()
+        return scim_user.obj, hashed.call_count
+
+    def user(self, **kwargs):
+        return dict(
+            userName="alice", emails=[{"value": "alice@example.test"}], **kwargs
+        )
+
+    def test_unusable_by_default(self, ipa):
+        user, hashed = self.save(self.user(password="Secret123"))
+        self.assertEqual(hashed, 0)
+        self.assertFalse(user.has_usable_password())
+
+    def test_hashed_once(self, ipa):
+        with self.settings(IPATUURA_LOCAL_PASSWORD="hash"):
+            user, hashed = self.save(self.user(password="Secret123"))
+            self.assertEqual(hashed, 1)
+            self.assertTrue(user.check_password("Secret123"))
+
+            # a modification without password keeps the hash
+            user = User.objects.get(id=user.id)
+            user, hashed = self.save(self.user(name={"givenName": "Alice"}), user=user)
+            self.assertEqual(hashed, 0)
+            self.assertTrue(user.check_password("Secret123"))
+
+    def test_no_password_is_unusable(self, ipa):
+        with self.settings(IPATUURA_LOCAL_PASSWORD="hash"):
+            user, hashed = self.save(self.user())
+        self.assertEqual(hashed, 0)
+        self.assertFalse(user.has_usable_password())
+
+
+class IdempotencyTest(TestCase):
+    class View(IdempotencyMixin, View):
+        calls = 0
+
+        def post(self, request):
+            type(self).calls += 1
+            response = HttpResponse(request.body, status=201)
+            response["Location"] = "/scim/v2/Users/1"
+            return response
+
+    def setUp(self):
+        self.View.calls = 0
+        self.user = User.objects.create(scim_username="scim")
+        self.addCleanup(caches["idempotency"].clear)
+
+    def post(self, body, key="key1"):
+        request = RequestFactory().post(
+            "/scim/v2/Users",
+            body,
+            content_type="application/scim+json",
+            HTTP_IDEMPOTENCY_KEY=key,
+        )
+        request.user = self.user
+        return self.View.as_view()(request)
+
+    def test_replay(self):
+        first = self.post('{"userName": "alice"}')
+        replayed = self.post('{"userName": "alice"}')
+
+        self.assertEqual(self.View.calls, 1)
+        self.assertEqual(replayed.status_code, 201)
+        self.assertEqual(replayed.content, first.content)
+        self.assertEqual(replayed["Location"], "/scim/v2/Users/1")
+        self.assertEqual(replayed["Idempotent-Replayed"], "true")
+
+    def test_other_key_is_processed(self):
+        self.post('{"userName": "alice"}')
+        self.post('{"userName": "alice"}', key="key2")
+        self.assertEqual(self.View.calls, 2)
+
+    def test_in_progress(self):
+        with mock.patch.object(
+            self.View, "post", side_effect=lambda request: self.post(request.body)
+        ):
+            response = self.post('{"userName": "alice"}')
+        self.assertEqual(response.status_code, 409)
+
+    def test_in_progress_expires(self):
+        with self.settings(IPATUURA_IDEMPOTENCY_LOCK_TTL=5):
+            with mock.patch.object(caches["idempotency"], "add") as add:
+                add.return_value = True
+                self.post('{"userName": "alice"}')
+        self.assertEqual(add.call_args.kwargs["timeout"], 5)
+
+    def test_different_payload(self):
+        self.post('{"userName": "alice"}')
+        response = self.post('{"userName": "bob"}')
+
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(self.View.calls, 1)
+
+    def test_missing_table(self):
+        with connection.cursor() as cursor:
+            cursor.execute("DROP TABLE ipatuura_idempotency")
+        self.addCleanup(call_command, "createcachetable", verbosity=0)
+
+        with self.assertLogs("ipatuura.views", "WARNING"):
+            self.post('{"userName": "alice"}')
+            self.post('{"userName": "alice"}')
+        self.assertEqual(self.View.calls, 2)
+
+    def test_server_error_is_not_recorded(self):
+        with mock.patch.object(
+            self.View, "post", return_value=HttpResponse(status=503)
+        ):
+            self.assertEqual(self.post('{"userName": "alice"}').status_code, 503)
+        self.assertEqual(self.post('{"userName": "alice"}').status_code, 201)
+
+
+@mock.patch("ipatuura.ipa.invalidate_cache")
+@mock.patch.object(_IPA, "_write")
+class WriterRoutingTest(TestCase):
+    def writer(self):
+        return _IPA(Domain(name="example.test", id_provider="ipa"))
+
+    def test_user_suffix_stripped(self, write, invalidate):
+        scim_user = SCIMUser(User(scim_username="alice@EXAMPLE.test"))
+        self.writer().user_add(scim_user)
+
+        written = write.return_value.add.call_args.args[0]
+        self.assertEqual(written.obj.username, "alice")
+        # the adapter itself keeps the routed name
+        self.assertEqual(scim_user.obj.username, "alice@EXAMPLE.test")
+        invalidate.assert_called_once_with(user="alice@EXAMPLE.test")
+
+    def test_other_suffix_kept(self, write, invalidate):
+        scim_user = SCIMUser(User(scim_username="alice@other.test"))
+        self.writer().user_del(scim_user)
+
+        self.assertIs(write.return_value.delete.call_args.args[0], scim_user)
+
+    def test_group_and_members_suffix_stripped(self, write, invalidate):
+        scim_group = SCIMGroup(Group(scim_display_name="admins@example.test"))
+        self.writer().group_add_member(
+            scim_group, ["alice@example.test", "bob", "carol@other.test"]
+        )
+
+        written, members = write.return_value.group_add_members.call_args.args
+        self.assertEqual(written.group_name, "admins")
+        self.assertEqual(members, ["alice", "bob", "carol@other.test"])
+
+
+class FanOutTest(TestCase):
+    def test_closes_the_thread_connections(self):
+        domains = [Domain(name="a.test"), Domain(name="b.test")]
+        with mock.patch.object(connections, "close_all") as close_all:
+            results = Registry().fan_out(lambda domain: domain.name, domains)
+
+        self.assertEqual([r for _, r in results], ["a.test", "b.test"])
+        self.assertEqual(close_all.call_count, 2)
+
+
+class ForkTest(TestCase):
+    def setUp(self):
+        self.addCleanup(after_fork)
+
+    def singletons(self):
+        with mock.patch.object(_SSSD, "reconnect"):
+            return {
+                "registry": Registry(),
+                "admission": Admission(),
+                "overlay": Overlay(),
+                "sssd": SSSD(),
+                "exporter": tracing.Exporter(),
+            }
+
+    def test_after_fork(self):
+        before = self.singletons()
+        after_fork()
+        # the exporter is created again in another process only
+        with mock.patch.object(tracing.os, "getpid", return_value=-1):
+            after = self.singletons()
+        for name, instance in before.items():
+            self.assertIsNot(after[name], instance, name)
+
+    def test_forked_worker(self):
+        before = self.singletons()
+        pid = os.fork()
+        if pid == 0:
+            # the child reports the singletons it inherited
+            after = self.singletons()
+            inherited = [n for n, i in before.items() if after[n] is i]
+            os._exit(len(inherited))
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(os.waitstatus_to_exitcode(status), 0)
+        self.assertEqual(self.singletons(), before)
+
+
+class SSSDReconnectTest(TestCase):
+    def setUp(self):
+        with mock.patch.object(_SSSD, "reconnect"):
+            self.sssd = _SSSD()
+        self.sssd._users_iface = mock.Mock()
+        self.sssd._get_user_from_path = mock.Mock(return_value=SSSDUser(1500, "alice"))
+
+    def test_reconnect_on_stale_connection(self):
+        self.sssd._users_iface.FindByName.side_effect = [
+            StaleConnectionException("restarted"),
+            "/org/freedesktop/sssd/infopipe/Users/1500",
+        ]
+        with mock.patch.object(_SSSD, "reconnect") as reconnect:
+            self.assertEqual(self.sssd.find_user_by_name("alice").id, 1500)
+        reconnect.assert_called_once_with()
+
+    def test_reconnect_once(self):
+        self.sssd._users_iface.FindByName.side_effect = StaleConnectionException(
+            "restarted"
+        )
+        with mock.patch.object(_SSSD, "reconnect") as reconnect:
+            with self.assertRaises(SSSDNotFoundException):
+                self.sssd.find_user_by_name("alice")
+        reconnect.assert_called_once_with()
+
+    def test_reconnected_by_another_thread(self):
+        generation = self.sssd._generation
+        self.sssd._generation += 1
+        with mock.patch.object(_SSSD, "reconnect") as reconnect:
+            self.sssd._reconnect_stale(generation)
+        reconnect.assert_not_called()
+
+    def test_stale_connection_errors(self):
+        iface = _TimedInterface.__new__(_TimedInterface)
+        iface._name = "Users"
+        iface._iface = mock.Mock()
+
+        iface._iface.FindByName.side_effect = dbus.exceptions.DBusException(
+            name="org.freedesktop.DBus.Error.ServiceUnknown"
+        )
+        with self.assertRaises(StaleConnectionException):
+            iface.FindByName("alice")
+
+        iface._iface.FindByName.side_effect = dbus.exceptions.DBusException(
+            name="org.freedesktop.sssd.Error.NotFound"
+        )
+        with self.assertRaises(dbus.exceptions.DBusException):
+            iface.FindByName("alice")
+
+    def test_list_errors(self):
+        iface = mock.Mock()
+        iface.ListByName.side_effect = dbus.exceptions.DBusException(
+            name="org.freedesktop.sssd.Error.NotFound"
+        )
+        self.assertEqual(self.sssd._list(iface, "*", 0), [])
+
+        # the other errors are not an empty enumeration
+        iface.ListByName.side_effect = dbus.exceptions.DBusException(
+            name="org.freedesktop.DBus.Error.NoReply"
+        )
+        with self.assertRaises(dbus.exceptions.DBusException):
+            self.sssd._list(iface, "*", 0)
+
+
+@mock.patch.object(changelog, "read", return_value=([], 0, False))
+class ChangeWaitTest(TestCase):
+    def setUp(self):
+        # a clock advanced by the sleeps of the long-poll
+        self.now = 0
+        self.slept = []
+        for name, func in (("monotonic", lambda: self.now), ("sleep", self.sleep)):
+            patcher = mock.patch.object(changelog.time, name, side_effect=func)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+    def wait(self, max_waiters):
+        options = {"MAX_WAITERS": max_waiters, "POLL_INTERVAL": 1}
+        with self.settings(IPATUURA_CHANGES=options):
+            return changelog.wait(0, 2)
+
+    def test_answered_at_once_without_waiters(self, read):
+        self.assertEqual(self.wait(0), ([], 0, False))
+        read.assert_called_once_with(0, None)
+        self.assertEqual(self.slept, [])
+
+    def test_wait(self, read):
+        self.wait(1)
+        self.assertEqual(self.slept, [1, 1])
+
+    def test_invalid_wait(self, read):
+        for wait in ("nan", "inf", "-1", "soon"):
+            request = RequestFactory().get(
+                "/scim/v2/.changes", {"since": "0", "wait": wait}
+            )
+            self.assertEqual(ChangesView().get(request).status_code, 400)
+        read.assert_not_called()
+
+    def test_waiters_capped(self, read):
+        def sleep(seconds):
+            # a second request while the only slot is taken
+            self.wait(1)
+            self.assertEqual(self.slept, [])
+            changelog.time.sleep.side_effect = self.sleep
+            self.sleep(seconds)
+
+        changelog.time.sleep.side_effect = sleep
+        self.wait(1)
+        # the slot is released
+        self.slept = []
+        self.wait(1)
+        self.assertEqual(self.slept, [1, 1])
+
+
+class StreamedGroupTest(TestCase):
+    def setUp(self):
+        self.group = SSSDGroup(200000, "staff")
+        self.group.set_members([f"user{i}" for i in range(150)])
+        self.sssd = mock.Mock()
+        self.sssd.find_group_by_id.return_value = self.group
+        self.sssd.find_user_by_name.side_effect = self.user
+        self.failing = None
+
+    def user(self, name, retrieve_groups=False):
+        index = int(name[4:])
+        if index == self.failing:
+            raise BackendOverloadedException("Too many requests waiting")
+        return SSSDUser(100000 + index, name)
+
+    def get(self):
+        view = GroupsView()
+        view.kwargs = {view.lookup_url_kwarg: "200000"}
+        request = RequestFactory().get("/scim/v2/Groups/200000")
+        with mock.patch("ipatuura.views.SSSD", return_value=self.sssd):
+            with self.settings(IPATUURA_STREAM_MEMBERS=10):
+                response = view.get_single(request)
+                content = b"".join(response.streaming_content)
+        return json.loads(content)
+
+    def test_streamed(self):
+        d = self.get()
+        self.assertEqual(len(d["members"]), 150)
+        self.assertEqual(d["meta"]["resourceType"], "Group")
+
+    def test_error_before_the_status(self):
+        self.failing = 0
+        with self.assertRaises(BackendOverloadedException):
+            self.get()
+
+    def test_error_ends_the_document(self):
+        self.failing = serializers.MEMBERS_PER_CHUNK + 10
+        with self.assertLogs("ipatuura.serializers", "ERROR"):
+            d = self.get()
+        self.assertEqual(len(d["members"]), serializers.MEMBERS_PER_CHUNK)
+        self.assertEqual(d["id"], "200000")
+
+
+class ChangeLogTest(TestCase):
+    USER = ChangeEvent.ResourceType.USER
+    CREATE = ChangeEvent.Operation.CREATE
+    UPDATE = ChangeEvent.Operation.UPDATE
+    DELETE = ChangeEvent.Operation.DELETE
+
+    def record(self, name, operation=CREATE, digest=""):
+        return changelog.record(self.USER, operation, name, digest=digest)
+
+    def log(self):
+        return list(ChangeEvent.objects.values_list("name", "operation"))
+
+    def test_read(self):
+        events = [self.record(f"user{i}") for i in range(3)]
+        with self.settings(IPATUURA_CHANGES={"SETTLE": 0}):
+            self.assertEqual(changelog.read(0, 2), (events[:2], events[1].id, True))
+            self.assertEqual(
+                changelog.read(events[1].id, 2), (events[2:], events[2].id, False)
+            )
+            self.assertEqual(changelog.read(events[2].id), ([], events[2].id, False))
+
+    def test_read_holds_back_recent_changes(self):
+        self.record("alice")
+        with self.settings(IPATUURA_CHANGES={"SETTLE": 60}):
+            self.assertEqual(changelog.read(0), ([], 0, False))
+
+    def test_compact(self):
+        self.record("alice")
+        self.record("bob")
+        self.record("alice", self.UPDATE)
+        self.record("bob", self.DELETE)
+        last = changelog.token()
+
+        self.assertEqual(changelog.compact(), 2)
+        self.assertEqual(self.log(), [("alice", self.UPDATE), ("bob", self.DELETE)])
+        self.assertEqual(changelog.token(), last)
+
+    def sync(self, *resources):
+        entries = [(None, resource) for resource in resources]
+
+        def fetch(resource):
+            if resource[1] is None:
+                raise SSSDNotFoundException("gone")
+            return resource
+
+        return changelog._sync(self.USER, entries, fetch)
+
+    def test_sync(self):
+        self.record("same", digest="1")
+        self.record("modified", digest="1")
+        self.record("removed", digest="1")
+        self.record("deleted", self.DELETE)
+        self.record("written")
+
+        counts = self.sync(
+            ("1", "same", "1"),
+            ("2", "modified", "2"),
+            ("3", "deleted", "3"),
+            ("4", "written", "4"),
+            ("5", "new", "5"),
+            ("6", None, None),
+        )
+        self.assertEqual(counts, {self.CREATE: 2, self.UPDATE: 1, self.DELETE: 1})
+        self.assertEqual(
+            self.log()[5:],
+            [
+                ("modified", self.UPDATE),
+                ("deleted", self.CREATE),
+                ("new", self.CREATE),
+                ("removed", self.DELETE),
+            ],
+        )
+        # the digest of a write through ipa-tuura is recorded in place
+        written = ChangeEvent.objects.get(name="written")
+        self.assertEqual((written.resource_id, written.digest), ("4", "4"))
+
+    def test_sync_empty_enumeration(self):
+        self.record("alice", digest="1")
+        self.assertEqual(self.sync()[self.DELETE], 0)
+        self.assertEqual(self.log(), [("alice", self.CREATE)])
+
+    @mock.patch.object(changelog, "SSSD")
+    def test_sync_truncated_enumeration(self, sssd):
+        self.record("removed", digest="1")
+        sssd.return_value.list_users.return_value = [(1, "user1"), (2, "user2")]
+        sssd.return_value.get_user.side_effect = lambda path: SSSDUser(
+            int(path[4:]), path
+        )
+        sssd.return_value.list_groups.return_value = []
+        with self.settings(IPATUURA_CHANGES={"ENUMERATION_LIMIT": 2}):
+            with self.assertLogs("ipatuura.changelog", "WARNING"):
+                counts = changelog.sync()
+
+        sssd.return_value.list_users.assert_called_once_with(limit=2)
+        self.assertEqual(counts[self.USER][self.CREATE], 2)
+        self.assertEqual(counts[self.USER][self.DELETE], 0)
+
+
+class SerializerTest(TestCase):
+    def setUp(self):
+        self.groups = {}
+        for index, members in enumerate((["alice", "bob"], ["alice"])):
+            group = SSSDGroup(200000 + index, f"group{index}")
+            group.set_members(members)
+            self.groups[group.name] = group
+        self.sssd = mock.Mock()
+        self.sssd.find_user_by_name.side_effect = self.user
+        self.sssd.find_group_by_name.side_effect = self.groups.__getitem__
+        self.request = RequestFactory().get("/scim/v2/Users")
+        self.locations = serializers.Locations(self.request)
+
+    def user(self, name, retrieve_groups=False):
+        if name == "alice":
+            return SSSDUser(
+                100000,
+                "alice",
+                givenname="Alice",
+                sn="Liddell",
+                mail=["alice@example.test", "al@example.test"],
+                groups=["group0", "group1"] if retrieve_groups else [],
+                active=True,
+            )
+        return SSSDUser(100001, name, mail="bob@example.test", active=False)
+
+    def test_user(self):
+        sssduser = self.user("alice", retrieve_groups=True)
+        model = SSSDUserToUserModel(self.sssd, sssduser)
+        groups = serializers.directory_groups(self.sssd, sssduser.groups)
+
+        self.assertEqual(
+            serializers.user_to_dict(sssduser, groups, self.locations),
+            SCIMUser(model, request=self.request).to_dict(),
+        )
+
+    def test_group(self):
+        for group in self.groups.values():
+            model = SSSDGroupToGroupModel(self.sssd, group)
+            members = serializers.directory_members(self.sssd, group.members)
+            expected = SCIMGroup(model, request=self.request).to_dict()
+
+            d = serializers.group_to_dict(group.id, group.name, members, self.locations)
+            self.assertEqual(d, expected)
+            members = serializers.directory_members(self.sssd, group.members)
+            streamed = serializers.iter_group_json(
+                group.id, group.name, members, self.locations
+            )
+            self.assertEqual(json.loads(b"".join(streamed)), expected)
+
+
+@mock.patch("ipatuura.adapters.IPA")
+class GroupCreateTest(TestCase):
+    def test_display_name_kept(self, ipa):
+        scim_group = SCIMGroup(Group())
+        scim_group.from_dict({"displayName": "admins"})
+        scim_group.save()
+
+        ipa.return_value.group_add.assert_called_once_with(scim_group, [])
+        self.assertEqual(scim_group.display_name, "admins")
+        stored = Group.objects.filter(id=scim_group.obj.id)
+        self.assertEqual(list(stored.values_list("scim_display_name")), [("admins",)])
+
+
+class AttributeMapTest(TestCase):
+    extra_attrs = "mail:userPrincipalName, sn:surname, givenname:givenName"
+
+    def test_changes_to_ldap_names(self):
+        changes = {
+            "mail": (["a@example.test"], ["b@example.test"]),
+            "sn": (["A"], []),
+        }
+        self.assertEqual(
+            attribute_map(self.extra_attrs).changes(changes),
+            {
+                "userPrincipalName": (["a@example.test"], ["b@example.test"]),
+                "surname": (["A"], []),
+            },
+        )
+
+    def test_changes_to_ipa_options(self):
+        changes = {"mail": ([], ["b@example.test"]), "givenname": (["A"], ["B"])}
+        self.assertEqual(
+            attribute_map(self.extra_attrs, ipa_api=True).changes(changes),
+            {"mail": ([], ["b@example.test"]), "givenname": (["A"], ["B"])},
+        )
+
+    def test_changes_unmapped_attribute(self):
+        changes = {"telephonenumber": ([], ["1234"])}
+        self.assertEqual(attribute_map(self.extra_attrs).changes(changes), changes)
+
+    def test_changes_default_mapping(self):
+        changes = {"sn": (["A"], ["B"])}
+        self.assertEqual(attribute_map().changes(changes), changes)
+        self.assertEqual(attribute_map(ipa_api=True).changes(changes), changes)
+
+    def test_entry(self):
+        user = User(first_name="Alice", last_name="A", email="a@example.test")
+        self.assertEqual(
+            attribute_map(self.extra_attrs).entry(user),
+            {
+                "givenName": "Alice",
+                "surname": "A",
+                "userPrincipalName": "a@example.test",
+            },
+        )
+        self.assertEqual(
+            attribute_map(self.extra_attrs, ipa_api=True).entry(user),
+            {"givenname": "Alice", "sn": "A", "mail": "a@example.test"},
+        )
+
+
+class AdmissionTest(TestCase):
+    def hold(self, gate):
+        """
+        Hold a slot of the gate from another thread until the test ends
+        """
+        admitted, release = threading.Event(), threading.Event()
+
+        def run():
+            with gate.admit():
+                admitted.set()
+                release.wait(5)
+
+        thread = threading.Thread(target=run)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(release.set)
+        admitted.wait(5)
+
+    def test_admitted(self):
+        gate = _Gate("test", 1, 0, 1)
+        with gate.admit():
+            # nested calls of an admitted thread are not limited again
+            with gate.admit():
+                self.assertEqual(gate.stats()["running"], 1)
+        stats = gate.stats()
+        self.assertEqual((stats["running"], stats["admitted"]), (0, 1))
+        self.assertEqual(stats["wait"]["count"], 1)
+
+    def test_overloaded(self):
+        gate = _Gate("test", 1, 0, 1)
+        self.hold(gate)
+        with self.assertRaises(BackendOverloadedException):
+            with gate.admit():
+                pass
+        self.assertEqual(gate.stats()["rejected"], 1)
+
+    def test_timeout(self):
+        gate = _Gate("test", 1, 1, 0.01)
+        self.hold(gate)
+        with self.assertRaises(BackendTimeoutException):
+            with gate.admit():
+                pass
+        stats = gate.stats()
+        self.assertEqual((stats["timeouts"], stats["waiting"]), (1, 0))
+
+    def test_middleware(self):
+        middleware = AdmissionMiddleware(
+            lambda request: middleware.process_exception(
+                request, BackendOverloadedException("Too many requests waiting")
+            )
+        )
+        with self.settings(IPATUURA_ADMISSION={"RETRY_AFTER": 3}):
+            response = middleware(RequestFactory().get("/scim/v2/Users"))
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response["Retry-After"], "3")
+        self.assertIsNone(
+            middleware.process_exception(None, SSSDNotFoundException("not found"))
+        )
+
+
+class MetricsViewTest(TestCase):
+    def get(self, user):
+        request = RequestFactory().get("/metrics")
+        request.user = user
+        return MetricsView.as_view()(request)
+
+    def test_authenticated(self):
+        self.assertEqual(self.get(AnonymousUser()).status_code, 401)
+
+        response = self.get(User.objects.create(scim_username="metrics"))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b"ipatuura_outbox_depth", response.content)
+
+
+@mock.patch.object(tracing, "_finish")
+class TracingTest(TestCase):
+    def get(self, view):
+        middleware = TracingMiddleware(view)
+        with self.settings(IPATUURA_TRACING={"ENABLED": True}):
+            return middleware(RequestFactory().get("/scim/v2/Groups/1"))
+
+    def test_response(self, finish):
+        def view(request):
+            with tracing.span("sssd.find_group_by_id"):
+                return HttpResponse("{}")
+
+        self.get(view)
+        (root,) = finish.call_args.args
+        self.assertEqual(root.attributes["http.status_code"], 200)
+        self.assertEqual(
+            [s.name for s in root.trace.spans],
+            ["GET /scim/v2/Groups/1", "sssd.find_group_by_id"],
+        )
+
+    def test_streamed_response(self, finish):
+        def members():
+            for name in ("alice", "bob"):
+                with tracing.span("sssd.find_user_by_name"):
+                    yield name
+
+        response = self.get(lambda request: StreamingHttpResponse(members()))
+        finish.assert_not_called()
+        self.assertEqual(b"".join(response.streaming_content), b"alicebob")
+        # the root span ends once the server closes the response
+        finish.assert_not_called()
+        response.close()
+
+        (root,) = finish.call_args.args
+        self.assertIsNotNone(root.end)
+        self.assertEqual(
+            [s.name for s in root.trace.spans],
+            ["GET /scim/v2/Groups/1"] + ["sssd.find_user_by_name"] * 2,
+        )
+        self.assertEqual({s.parent_id for s in root.trace.spans[1:]}, {root.span_id})
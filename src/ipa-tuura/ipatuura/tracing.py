@@ -0,0 +1,391 @@
+#
+# Copyright (C) 2023  FreeIPA Contributors see COPYING for license
+#
+
+"""Request tracing
+
+Each request traced by the TracingMiddleware records a tree of spans:
+the _SSSD lookups and their DBus calls, the writable interface operations
+and the database queries. The sampled traces are exported in the OTLP
+JSON format, appended to a file or posted to an OTLP/HTTP collector. The
+span tree of the requests slower than SLOW_REQUEST is logged whether the
+trace is sampled or not.
+
+Outside of a traced request, span() costs a context variable lookup.
+"""
+
+import contextvars
+import functools
+import json
+import logging
+import os
+import queue
+import random
+import re
+import threading
+import time
+import urllib.request
+from contextlib import contextmanager
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+TRACING_DEFAULTS = {
+    "ENABLED": False,
+    "SAMPLE_RATE": 0.01,
+    "EXPORTER": "",
+    "FILE": "/var/log/ipatuura/traces.jsonl",
+    "OTLP_ENDPOINT": "http://localhost:4318/v1/traces",
+    "SLOW_REQUEST": 2.0,
+    "MAX_SPANS": 10000,
+}
+
+# OTLP span kinds
+KIND_INTERNAL = 1
+KIND_SERVER = 2
+KIND_CLIENT = 3
+
+# OTLP status code of the failed spans
+STATUS_ERROR = 2
+
+TRACEPARENT = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$")
+
+_current = contextvars.ContextVar("ipatuura_span", default=None)
+
+
+def _option(name):
+    return getattr(settings, "IPATUURA_TRACING", {}).get(name, TRACING_DEFAULTS[name])
+
+
+def enabled():
+    return _option("ENABLED")
+
+
+class Trace:
+    """
+    Spans recorded for a request
+    """
+
+    def __init__(self, trace_id, sampled):
+        self.trace_id = trace_id
+        self.sampled = sampled
+        self.spans = []
+        self.dropped = 0
+        self.max_spans = _option("MAX_SPANS")
+        # the root span of a streamed response ends with its content
+        self.streamed = False
+
+
+class Span:
+    __slots__ = (
+        "trace",
+        "name",
+        "kind",
+        "span_id",
+        "parent_id",
+        "start",
+        "end",
+        "attributes",
+        "error",
+    )
+
+    def __init__(self, trace, name, parent_id, kind, attributes):
+        self.trace = trace
+        self.name = name
+        self.kind = kind
+        self.span_id = "%016x" % random.getrandbits(64)
+        self.parent_id = parent_id
+        self.attributes = attributes
+        self.error = None
+        self.start = time.time_ns()
+        self.end = None
+
+    @property
+    def seconds(self):
+        return ((self.end or time.time_ns()) - self.start) / 1e9
+
+    def to_otlp(self):
+        span = {
+            "traceId": self.trace.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": self.kind,
+            "startTimeUnixNano": str(self.start),
+            "endTimeUnixNano": str(self.end),
+            "attributes": [
+                {"key": key, "value": {"stringValue": str(value)}}
+                for key, value in self.attributes.items()
+            ],
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        if self.error is not None:
+            span["status"] = {"code": STATUS_ERROR, "message": self.error}
+        return span
+
+
+@contextmanager
+def span(name, kind=KIND_INTERNAL, **attributes):
+    """
+    Record a span in the trace of the current request, if any.
+
+    :param name: name of the operation
+    :param attributes: attributes of the span
+    """
+    parent = _current.get()
+    if parent is None:
+        yield None
+        return
+
+    trace = parent.trace
+    if len(trace.spans) >= trace.max_spans:
+        trace.dropped += 1
+        yield None
+        return
+    current = Span(trace, name, parent.span_id, kind, attributes)
+    trace.spans.append(current)
+    token = _current.set(current)
+    try:
+        yield current
+    except Exception as e:
+        current.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        current.end = time.time_ns()
+        _current.reset(token)
+
+
+def traced(name, kind=KIND_INTERNAL):
+    """
+    Decorator recording a span for each call of a function
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name, kind):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def _start(name, traceparent):
+    match = TRACEPARENT.match(traceparent or "")
+    if match:
+        trace_id, parent_id, flags = match.groups()
+        sampled = bool(int(flags, 16) & 1)
+    else:
+        trace_id, parent_id = "%032x" % random.getrandbits(128), None
+        sampled = random.random() < _option("SAMPLE_RATE")
+    trace = Trace(trace_id, sampled)
+    root = Span(trace, name, parent_id, KIND_SERVER, {})
+    trace.spans.append(root)
+    return root
+
+
+@contextmanager
+def trace(name, traceparent=None):
+    """
+    Trace a request: the spans recorded within are exported if the trace
+    is sampled, and logged if the request is slow.
+
+    :param name: name of the root span
+    :param traceparent: W3C traceparent header of the caller, its trace id
+                        and sampling decision are kept
+    :returns: the root span
+    """
+    root = _start(name, traceparent)
+    token = _current.set(root)
+    try:
+        yield root
+    except Exception as e:
+        root.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        _current.reset(token)
+        if not root.trace.streamed:
+            root.end = time.time_ns()
+            _finish(root)
+
+
+class _StreamedContent:
+    """
+    Content of a streamed response, generated within the trace of its
+    request. The root span ends when the server closes the response.
+    """
+
+    def __init__(self, root, content):
+        self._root = root
+        self._content = iter(content)
+        self._closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        token = _current.set(self._root)
+        try:
+            return next(self._content)
+        except StopIteration:
+            raise
+        except Exception as e:
+            self._root.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            _current.reset(token)
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._root.end = time.time_ns()
+        _finish(self._root)
+
+
+def stream(root, content):
+    """
+    Trace the generation of the content of a streamed response, its spans
+    are recorded in the trace of the request.
+
+    :param root: the root span of the request, as returned by trace()
+    :param content: the streaming_content of the response
+    :returns: the content to stream instead
+    """
+    root.trace.streamed = True
+    return _StreamedContent(root, content)
+
+
+def _finish(root):
+    slow = _option("SLOW_REQUEST")
+    if slow and root.seconds >= slow:
+        logger.warning(
+            f"slow request {root.name} ({root.seconds:.3f}s), trace "
+            f"{root.trace.trace_id}:\n" + format_tree(root.trace)
+        )
+    if root.trace.sampled:
+        Exporter().export(root.trace)
+
+
+def format_tree(trace):
+    """
+    Format the spans of a trace as an indented tree. The sibling spans
+    with the same name are merged into one line with their count and
+    total duration.
+    """
+    children = {}
+    for s in trace.spans:
+        children.setdefault(s.parent_id, []).append(s)
+    lines = []
+
+    def walk(spans, depth):
+        groups = {}
+        for s in spans:
+            groups.setdefault(s.name, []).append(s)
+        for name, group in groups.items():
+            total = sum(s.seconds for s in group) * 1000
+            count = f" x{len(group)}" if len(group) > 1 else ""
+            error = " ERROR" if any(s.error for s in group) else ""
+            lines.append(f"{'  ' * depth}{name}{count} {total:.1f}ms{error}")
+            walk([c for s in group for c in children.get(s.span_id, [])], depth + 1)
+
+    root = trace.spans[0]
+    walk([root], 0)
+    if trace.dropped:
+        lines.append(f"({trace.dropped} spans dropped)")
+    return "\n".join(lines)
+
+
+def db_wrapper(execute, sql, params, many, context):
+    """
+    Database execute wrapper recording a span per query
+    """
+    with span("db.query", KIND_CLIENT, **{"db.statement": sql[:256]}):
+        return execute(sql, params, many, context)
+
+
+class _Exporter:
+    """
+    Export the sampled traces from a background thread, to a file or an
+    OTLP/HTTP collector. Traces are dropped when the queue is full.
+    """
+
+    _instance = None
+
+    def __init__(self):
+        self.kind = _option("EXPORTER")
+        self.pid = os.getpid()
+        self._queue = queue.Queue(maxsize=1000)
+        self._thread = threading.Thread(
+            target=self._run, name="trace-exporter", daemon=True
+        )
+        self._thread.start()
+
+    def export(self, trace):
+        if not self.kind:
+            return
+        try:
+            self._queue.put_nowait(trace)
+        except queue.Full:
+            logger.debug(f"trace {trace.trace_id} dropped, export queue full")
+
+    def _document(self, traces):
+        return {
+            "resourceSpans": [
+                {
+                    "resource": {
+                        "attributes": [
+                            {
+                                "key": "service.name",
+                                "value": {"stringValue": "ipa-tuura"},
+                            }
+                        ]
+                    },
+                    "scopeSpans": [
+                        {
+                            "scope": {"name": "ipatuura"},
+                            "spans": [s.to_otlp() for t in traces for s in t.spans],
+                        }
+                    ],
+                }
+            ]
+        }
+
+    def _write(self, traces):
+        with open(_option("FILE"), "a") as f:
+            for t in traces:
+                f.write(json.dumps(self._document([t])) + "\n")
+
+    def _post(self, traces):
+        request = urllib.request.Request(
+            _option("OTLP_ENDPOINT"),
+            data=json.dumps(self._document(traces)).encode("utf-8"),
+            headers={"Content-Type": "application/json"},
+        )
+        with urllib.request.urlopen(request, timeout=10) as response:
+            response.read()
+
+    def _run(self):
+        while True:
+            traces = [self._queue.get()]
+            while len(traces) < 100:
+                try:
+                    traces.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                if self.kind == "otlp":
+                    self._post(traces)
+                else:
+                    self._write(traces)
+            except Exception as e:
+                logger.info(f"unable to export {len(traces)} traces: {e}")
+
+
+def Exporter():
+    # the export thread does not survive a fork
+    if _Exporter._instance is None or _Exporter._instance.pid != os.getpid():
+        _Exporter._instance = _Exporter()
+    return _Exporter._instance
@@ -0,0 +1,30 @@
+#
+# Copyright (C) 2023  FreeIPA Contributors see COPYING for license
+#
+
+"""SCIM URL Configuration
+
+Routes served by ipa-tuura views take precedence over the django_scim ones,
+the remaining django_scim routes are kept unchanged.
+"""
+from django.urls import re_path
+from django_scim import urls as scim_urls
+from ipatuura import views
+
+app_name = "scim"
+
+urlpatterns = [
+    # before the Users and Groups routes, which would take .export as an id
+    re_path(r"^Users/\.export$", views.UsersExportView.as_view(), name="users-export"),
+    re_path(
+        r"^Groups/\.export$", views.GroupsExportView.as_view(), name="groups-export"
+    ),
+    re_path(r"^\.changes$", views.ChangesView.as_view(), name="changes"),
+    re_path(r"^Users(?:/(?P<uuid>[^/]+))?$", views.UsersView.as_view(), name="users"),
+    re_path(
+        r"^Groups(?:/(?P<uuid>[^/]+))?$", views.GroupsView.as_view(), name="groups"
+    ),
+]
+
+overridden = {pattern.name for pattern in urlpatterns}
+urlpatterns += [p for p in scim_urls.urlpatterns if p.name not in overridden]
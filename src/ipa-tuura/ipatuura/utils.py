@@ -4,7 +4,7 @@
 
 from django.db import NotSupportedError
 from django_scim.filters import GroupFilterQuery, UserFilterQuery
-from ipatuura.models import SSSDGroupToGroupModel, SSSDUserToUserModel
+from ipatuura.models import SSSDGroupToGroupModel, find_directory_users
 from ipatuura.sssd import SSSD, SSSDNotFoundException
 
 
@@ -40,14 +40,7 @@ class SCIMUserFilterQuery(UserFilterQuery):
         if op.lower() != "eq":
             raise NotSupportedError("Support only exact search")
 
-        try:
-            sssd_if = SSSD()
-            sssduser = sssd_if.find_user_by_name(value, retrieve_groups=True)
-        except SSSDNotFoundException:
-            return localresult
-
-        user = SSSDUserToUserModel(sssd_if, sssduser)
-        return [user]
+        return find_directory_users(value) or localresult
 
 
 class SCIMGroupFilterQuery(GroupFilterQuery):
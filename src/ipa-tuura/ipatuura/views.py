@@ -2,6 +2,355 @@
 # Copyright (C) 2022  FreeIPA Contributors see COPYING for license
 #
 
-# from django.shortcuts import render
+import hashlib
+import json
+import logging
+import math
+from itertools import chain, islice
 
-# Create your views here.
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.base import InvalidCacheBackendError
+from django.db import DatabaseError
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils.decorators import method_decorator
+from django.views.decorators.csrf import csrf_exempt
+from django.views.generic import View
+from django_scim import constants, exceptions, views
+from django_scim.settings import scim_settings
+from django_scim.utils import get_is_authenticated_predicate
+from ipatuura import changelog, export, metrics, serializers
+from ipatuura.models import find_directory_sssduser
+from ipatuura.sssd import SSSD, SSSDNotFoundException
+
+logger = logging.getLogger(__name__)
+
+IDEMPOTENCY_IN_PROGRESS = "in-progress"
+CHANGES_SCHEMA = "urn:ipa-tuura:api:messages:2.0:Changes"
+
+
+def idempotency_cache():
+    """
+    Return the cache recording the responses of idempotent requests,
+    bounded by its MAX_ENTRIES option and expired after its TIMEOUT.
+    """
+    try:
+        return caches["idempotency"]
+    except InvalidCacheBackendError:
+        return caches["default"]
+
+
+def _error(detail, status):
+    content = {
+        "schemas": [constants.SchemaURI.ERROR],
+        "detail": detail,
+        "status": status,
+    }
+    return HttpResponse(
+        content=json.dumps(content),
+        content_type=constants.SCIM_CONTENT_TYPE,
+        status=status,
+    )
+
+
+class IdempotencyMixin:
+    """
+    Replay the recorded response of a POST, PUT or PATCH request retried
+    with the same Idempotency-Key header, without touching the integration
+    domain again.
+    """
+
+    idempotent_methods = ("POST", "PUT", "PATCH")
+
+    def _idempotency_key(self, request, key):
+        scope = "{}:{}:{}:{}".format(request.user.pk, request.method, request.path, key)
+        return "idempotency:" + hashlib.sha256(scope.encode("utf-8")).hexdigest()
+
+    @method_decorator(csrf_exempt)
+    def dispatch(self, request, *args, **kwargs):
+        key = request.META.get("HTTP_IDEMPOTENCY_KEY")
+        user = getattr(request, "user", None)
+        if (
+            not key
+            or request.method not in self.idempotent_methods
+            or user is None
+            or not user.is_authenticated
+        ):
+            return super().dispatch(request, *args, **kwargs)
+
+        cache = idempotency_cache()
+        cache_key = self._idempotency_key(request, key)
+        fingerprint = hashlib.sha256(request.body).hexdigest()
+
+        # Only the first request with a given key is processed, its marker
+        # expires if the worker dies before recording the response
+        try:
+            replay = not cache.add(
+                cache_key,
+                IDEMPOTENCY_IN_PROGRESS,
+                timeout=getattr(settings, "IPATUURA_IDEMPOTENCY_LOCK_TTL", 120),
+            )
+        except DatabaseError as e:
+            logger.warning(f"idempotency: cache unavailable, key ignored: {e}")
+            return super().dispatch(request, *args, **kwargs)
+        metrics.cache_lookup("idempotency", replay)
+        if replay:
+            recorded = cache.get(cache_key)
+            if recorded == IDEMPOTENCY_IN_PROGRESS:
+                return _error("A request with this Idempotency-Key is in progress", 409)
+            if recorded is None:
+                # expired in the meantime, process it as a new request
+                return self.dispatch(request, *args, **kwargs)
+            if recorded["fingerprint"] != fingerprint:
+                return _error(
+                    "Idempotency-Key already used with a different payload", 422
+                )
+            logger.debug(f"idempotency: replaying response for key {key}")
+            response = HttpResponse(
+                content=recorded["content"],
+                content_type=recorded["content_type"],
+                status=recorded["status"],
+            )
+            if recorded["location"]:
+                response["Location"] = recorded["location"]
+            response["Idempotent-Replayed"] = "true"
+            return response
+
+        try:
+            response = super().dispatch(request, *args, **kwargs)
+        except Exception:
+            cache.delete(cache_key)
+            raise
+
+        # Server errors and rejected requests are not recorded so that
+        # the client can retry
+        if response.status_code >= 500 or response.status_code == 429:
+            cache.delete(cache_key)
+        else:
+            cache.set(
+                cache_key,
+                {
+                    "fingerprint": fingerprint,
+                    "status": response.status_code,
+                    "content": response.content,
+                    "content_type": response.get("Content-Type"),
+                    "location": response.get("Location"),
+                },
+            )
+        return response
+
+
+class WriteQueuedMixin:
+    """
+    When the directory write was queued in the outbox, acknowledge the
+    request with 202 Accepted instead of 200/201/204.
+    """
+
+    @method_decorator(csrf_exempt)
+    def dispatch(self, request, *args, **kwargs):
+        response = super().dispatch(request, *args, **kwargs)
+        if (
+            getattr(request, "ipatuura_write_queued", False)
+            and response.status_code < 300
+        ):
+            response.status_code = 202
+        return response
+
+
+def _document(content, location):
+    response = HttpResponse(content=content, content_type=constants.SCIM_CONTENT_TYPE)
+    response["Location"] = location
+    return response
+
+
+class UsersView(IdempotencyMixin, WriteQueuedMixin, views.UsersView):
+    """
+    SCIM Users view.
+    """
+
+    def get_single(self, request):
+        """
+        Serialize the users of the integration domain straight from
+        SSSD, without building a User and its Groups. The users stored
+        locally, e.g. the django admin, are served by the adapter.
+        """
+        uuid = self.kwargs[self.lookup_url_kwarg]
+        if self.model_cls.objects.filter(**{self.lookup_field: uuid}).exists():
+            return super().get_single(request)
+        try:
+            sssd_if, sssduser = find_directory_sssduser(scim_id=uuid)
+        except self.model_cls.DoesNotExist:
+            raise exceptions.NotFoundError(uuid)
+
+        locations = serializers.Locations(request)
+        groups = serializers.directory_groups(sssd_if, sssduser.groups)
+        d = serializers.user_to_dict(sssduser, groups, locations)
+        return _document(serializers.dumps(d), d["meta"]["location"])
+
+
+class GroupsView(IdempotencyMixin, WriteQueuedMixin, views.GroupsView):
+    """
+    SCIM Groups view.
+    """
+
+    def get_single(self, request):
+        """
+        Serialize the groups straight from SSSD, without building a User
+        per member. The groups with more than IPATUURA_STREAM_MEMBERS
+        members are streamed, their members looked up as the client reads
+        the document.
+        """
+        uuid = self.kwargs[self.lookup_url_kwarg]
+        localgroup = self.model_cls.objects.filter(**{self.lookup_field: uuid}).first()
+        sssd_if, members = None, []
+        try:
+            sssd_if = SSSD()
+            if localgroup is None:
+                sssdgroup = sssd_if.find_group_by_id(uuid, retrieve_members=True)
+            else:
+                # The membership is only stored in the integration domain
+                sssdgroup = sssd_if.find_group_by_name(
+                    localgroup.scim_display_name, retrieve_members=True
+                )
+        except SSSDNotFoundException:
+            if localgroup is None:
+                raise exceptions.NotFoundError(uuid)
+        else:
+            members = sssdgroup.members
+
+        if localgroup is None:
+            args = (sssdgroup.id, sssdgroup.name)
+            external_id = None
+        else:
+            args = (localgroup.scim_id, localgroup.scim_display_name)
+            external_id = localgroup.scim_external_id
+        locations = serializers.Locations(request)
+        location = locations.group(args[0])
+        users = serializers.directory_members(sssd_if, members)
+        if len(members) <= getattr(settings, "IPATUURA_STREAM_MEMBERS", 1000):
+            d = serializers.group_to_dict(*args, users, locations, external_id)
+            return _document(serializers.dumps(d), location)
+
+        # the first members are looked up before the status is sent, an
+        # unavailable backend is answered with an error
+        first = list(islice(users, serializers.MEMBERS_PER_CHUNK))
+        users = chain(first, users)
+        response = StreamingHttpResponse(
+            serializers.iter_group_json(*args, users, locations, external_id),
+            content_type=constants.SCIM_CONTENT_TYPE,
+        )
+        response["Location"] = location
+        return response
+
+
+class AuthenticatedView(View):
+    """
+    View answering 401 to the requests not authenticated, like the SCIM
+    views.
+    """
+
+    http_method_names = ["get"]
+
+    @method_decorator(csrf_exempt)
+    def dispatch(self, request, *args, **kwargs):
+        # Not a SCIM view, checked like the SCIM auth middleware does
+        if not get_is_authenticated_predicate()(request.user):
+            response = HttpResponse(status=401)
+            response["WWW-Authenticate"] = scim_settings.WWW_AUTHENTICATE_HEADER
+            return response
+        return super().dispatch(request, *args, **kwargs)
+
+
+class ExportView(AuthenticatedView):
+    """
+    Stream all the users or groups of the integration domains as
+    newline-delimited JSON, for a full reconciliation.
+
+    The documents are generated as the client reads them, the memory
+    used does not depend on the number of entries. Pass the id of the
+    last document received as cursor to resume an interrupted export.
+    """
+
+    generate = None
+
+    def get(self, request, *args, **kwargs):
+        cursor = request.GET.get("cursor")
+        if cursor is not None:
+            try:
+                cursor = int(cursor)
+            except ValueError:
+                return _error(f"Invalid cursor {cursor}", 400)
+        try:
+            lines = self.generate(request, cursor)
+        except SSSDNotFoundException:
+            return _error("SSSD infopipe not available", 503)
+        return StreamingHttpResponse(lines, content_type=export.NDJSON_CONTENT_TYPE)
+
+
+class UsersExportView(ExportView):
+    generate = staticmethod(export.export_users)
+
+
+class GroupsExportView(ExportView):
+    generate = staticmethod(export.export_groups)
+
+
+class ChangesView(AuthenticatedView):
+    """
+    Feed of the user and group changes, in order.
+
+    Without a token, return the current token: fetch it before a full
+    export, then follow the changes from it. With `since`, return the
+    changes following this token and the token to pass next. With
+    `wait`, wait up to this number of seconds for a change when there is
+    none yet.
+    """
+
+    def get(self, request, *args, **kwargs):
+        since = request.GET.get("since")
+        if since is None:
+            return self._response(changelog.token(), [], False)
+        try:
+            since = int(since)
+            timeout = float(request.GET.get("wait", 0))
+        except ValueError:
+            return _error("Invalid since or wait parameter", 400)
+        if since < 0 or not math.isfinite(timeout) or timeout < 0:
+            return _error("Invalid since or wait parameter", 400)
+
+        if timeout:
+            events, last, more = changelog.wait(since, timeout)
+        else:
+            events, last, more = changelog.read(since)
+        return self._response(last, events, more)
+
+    def _response(self, token, events, more):
+        content = {
+            "schemas": [CHANGES_SCHEMA],
+            "token": str(token),
+            "more": more,
+            "changes": [
+                {
+                    "token": str(event.id),
+                    "operation": event.operation,
+                    "resourceType": event.resource_type,
+                    "id": event.resource_id or None,
+                    "name": event.name,
+                    "timestamp": event.created.isoformat(),
+                }
+                for event in events
+            ],
+        }
+        return HttpResponse(
+            content=json.dumps(content), content_type=constants.SCIM_CONTENT_TYPE
+        )
+
+
+class MetricsView(AuthenticatedView):
+    """
+    Metrics of all the worker processes, in the Prometheus text format.
+    """
+
+    def get(self, request, *args, **kwargs):
+        content, content_type = metrics.render()
+        return HttpResponse(content=content, content_type=content_type)
@@ -16,6 +16,8 @@ https://docs.djangoproject.com/en/3.0/ref/settings/
 
 import os
 
+import django
+
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
@@ -50,6 +52,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'ipatuura.middleware.MetricsMiddleware',
+    'ipatuura.middleware.TracingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -57,6 +61,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'ipatuura.middleware.AdmissionMiddleware',
 ]
 
 ROOT_URLCONF = 'root.urls'
@@ -83,13 +88,96 @@ WSGI_APPLICATION = 'root.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/3.0/ref/settings/#databases
 
-DATABASES = {
-    'default': {
+# IPATUURA_DATABASE selects the 'sqlite' (default) or 'postgresql' backend,
+# configured by the IPATUURA_DB_* variables. Each worker process keeps its
+# PostgreSQL connections open for CONN_MAX_AGE seconds, or takes them from
+# a pool of at most IPATUURA_DB_POOL_MAX_SIZE connections when set (Django
+# 5.1 or later with psycopg 3). "manage.py copy_database" copies the data
+# of IPATUURA_DATABASE_SOURCE, a SQLite file, when switching to PostgreSQL.
+
+IPATUURA_DATABASE = os.environ.get('IPATUURA_DATABASE', 'sqlite')
+
+# Pragmas of the SQLite connections: WAL journal, synchronous level, seconds
+# a writer waits for the lock held by another worker, and mode of the
+# transactions (IMMEDIATE takes the write lock when the transaction starts,
+# Django 5.1 or later)
+IPATUURA_SQLITE = {
+    'JOURNAL_MODE': os.environ.get('IPATUURA_SQLITE_JOURNAL_MODE', 'WAL'),
+    'SYNCHRONOUS': os.environ.get('IPATUURA_SQLITE_SYNCHRONOUS', 'NORMAL'),
+    'BUSY_TIMEOUT': float(os.environ.get('IPATUURA_SQLITE_BUSY_TIMEOUT', '20')),
+    'TRANSACTION_MODE': os.environ.get('IPATUURA_SQLITE_TRANSACTION_MODE', 'IMMEDIATE'),
+}
+
+if IPATUURA_DATABASE == 'postgresql':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.environ.get('IPATUURA_DB_NAME', 'ipatuura'),
+            'USER': os.environ.get('IPATUURA_DB_USER', 'ipatuura'),
+            'PASSWORD': os.environ.get('IPATUURA_DB_PASSWORD', ''),
+            'HOST': os.environ.get('IPATUURA_DB_HOST', 'localhost'),
+            'PORT': os.environ.get('IPATUURA_DB_PORT', '5432'),
+            'CONN_MAX_AGE': int(os.environ.get('IPATUURA_DB_CONN_MAX_AGE', '600')),
+            'CONN_HEALTH_CHECKS': True,
+            'OPTIONS': {},
+        }
+    }
+    if int(os.environ.get('IPATUURA_DB_POOL_MAX_SIZE', '0')):
+        # pooled connections are returned to the pool, not kept open
+        DATABASES['default']['CONN_MAX_AGE'] = 0
+        DATABASES['default']['OPTIONS']['pool'] = {
+            'min_size': int(os.environ.get('IPATUURA_DB_POOL_MIN_SIZE', '2')),
+            'max_size': int(os.environ.get('IPATUURA_DB_POOL_MAX_SIZE')),
+            'timeout': float(os.environ.get('IPATUURA_DB_POOL_TIMEOUT', '10')),
+        }
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.environ.get('IPATUURA_DB_NAME', os.path.join(BASE_DIR, 'db.sqlite3')),
+            'OPTIONS': {},
+        }
+    }
+    if django.VERSION >= (5, 1):
+        DATABASES['default']['OPTIONS']['transaction_mode'] = IPATUURA_SQLITE['TRANSACTION_MODE']
+
+if os.environ.get('IPATUURA_DATABASE_SOURCE'):
+    DATABASES['source'] = {
         'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+        'NAME': os.environ['IPATUURA_DATABASE_SOURCE'],
     }
+
+
+# Caches
+# The idempotency cache records the responses replayed to SCIM clients
+# retrying a request with the same Idempotency-Key header. It is kept in
+# the database so that all the worker processes share it, as the overlay
+# of the recent writes. Their tables are created by "manage.py migrate",
+# both answer without caching while the tables are missing.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'idempotency': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'ipatuura_idempotency',
+        'TIMEOUT': int(os.environ.get('IPATUURA_IDEMPOTENCY_TTL', '86400')),
+        'OPTIONS': {
+            'MAX_ENTRIES': int(os.environ.get('IPATUURA_IDEMPOTENCY_MAX_ENTRIES', '10000')),
+        },
+    },
+    'overlay': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'ipatuura_overlay',
+    },
 }
 
+# Seconds a request holds its Idempotency-Key while it is processed, the
+# retries are answered 409 meanwhile. Released when the request completes,
+# it expires when the worker dies processing the request.
+IPATUURA_IDEMPOTENCY_LOCK_TTL = int(os.environ.get('IPATUURA_IDEMPOTENCY_LOCK_TTL', '120'))
+
 
 # Password validation
 # https://docs.djangoproject.com/en/3.0/ref/settings/#auth-password-validators
@@ -144,6 +232,7 @@ SCIM_SERVICE_PROVIDER = {
     'SERVICE_PROVIDER_CONFIG_MODEL': 'ipatuura.models.ServiceProviderConfig',
     'USER_FILTER_PARSER': 'ipatuura.utils.SCIMUserFilterQuery',
     'GROUP_FILTER_PARSER': 'ipatuura.utils.SCIMGroupFilterQuery',
+    'AUTH_CHECK_MIDDLEWARE': 'ipatuura.middleware.SCIMAuthCheckMiddleware',
     'DOCUMENTATION_URI': 'https://www.rfc-editor.org/rfc/rfc7644',
     'AUTHENTICATION_SCHEMES': [
         {
@@ -156,6 +245,116 @@ SCIM_SERVICE_PROVIDER = {
     ],
 }
 
+# Local copy of the SCIM user passwords, the password is validated against
+# the integration domain: 'unusable' stores no usable hash, 'hash' hashes it
+# once with IPATUURA_LOCAL_PASSWORD_HASHER ('default' or an algorithm name
+# of PASSWORD_HASHERS)
+IPATUURA_LOCAL_PASSWORD = os.environ.get('IPATUURA_LOCAL_PASSWORD', 'unusable')
+IPATUURA_LOCAL_PASSWORD_HASHER = os.environ.get('IPATUURA_LOCAL_PASSWORD_HASHER', 'default')
+
+# Seconds during which the users written through the writable interface
+# are served from an overlay, while SSSD may still return stale data. The
+# overlay is kept in the "overlay" cache, shared by the worker processes.
+IPATUURA_OVERLAY_TTL = int(os.environ.get('IPATUURA_OVERLAY_TTL', '60'))
+
+# Groups with more members are streamed by GET /scim/v2/Groups/<id>, their
+# members being looked up as the client reads the document
+IPATUURA_STREAM_MEMBERS = int(os.environ.get('IPATUURA_STREAM_MEMBERS', '1000'))
+
+# Seconds after which a domain job whose worker process stopped renewing
+# its lease can be retried
+IPATUURA_DOMAIN_JOB_LEASE = int(os.environ.get('IPATUURA_DOMAIN_JOB_LEASE', '60'))
+
+# Seconds between the sweeps of the pending domain jobs by each worker
+# process, run at its startup first
+IPATUURA_DOMAIN_JOB_SWEEP = int(os.environ.get('IPATUURA_DOMAIN_JOB_SWEEP', '60'))
+
+# Directory writes: 'sync' applies them within the SCIM request, 'outbox'
+# persists them locally, acknowledges the request with 202 and lets
+# "manage.py outbox_worker" apply them to the writable interface
+IPATUURA_WRITE_MODE = os.environ.get('IPATUURA_WRITE_MODE', 'sync')
+
+IPATUURA_OUTBOX = {
+    'WORKERS': int(os.environ.get('IPATUURA_OUTBOX_WORKERS', '4')),
+    'MAX_ATTEMPTS': int(os.environ.get('IPATUURA_OUTBOX_MAX_ATTEMPTS', '8')),
+    # retry delay in seconds: BACKOFF ** attempts, up to MAX_BACKOFF
+    'BACKOFF': 2,
+    'MAX_BACKOFF': 300,
+    'POLL_INTERVAL': 1,
+    # seconds after which the writes of a worker that stopped renewing
+    # its lease are applied by another worker
+    'LEASE': int(os.environ.get('IPATUURA_OUTBOX_LEASE', '60')),
+}
+
+# Change log served at /scim/v2/.changes: maximum number of changes per
+# response, longest wait of a long-poll, number of long-polls waiting at
+# once in a worker, and age in seconds before a change is served, so that
+# a late transaction cannot land behind a token. A long-poll holds a
+# thread: by default all but one of the IPATUURA_THREADS of a gthread
+# worker may wait, the sync workers answer at once
+IPATUURA_CHANGES = {
+    'MAX_EVENTS': int(os.environ.get('IPATUURA_CHANGES_MAX_EVENTS', '1000')),
+    'LONG_POLL_TIMEOUT': int(os.environ.get('IPATUURA_CHANGES_LONG_POLL_TIMEOUT', '30')),
+    'MAX_WAITERS': int(os.environ.get(
+        'IPATUURA_CHANGES_MAX_WAITERS',
+        max(int(os.environ.get('IPATUURA_THREADS', '1')) - 1, 0))),
+    'POLL_INTERVAL': 0.5,
+    'SETTLE': 1,
+    'ENUMERATION_LIMIT': int(os.environ.get('IPATUURA_CHANGES_ENUMERATION_LIMIT', '100000')),
+}
+
+# Credential validation pool: number of threads running the PAM
+# conversations, number of validations allowed to wait for a thread
+# before answering 503, timeout in seconds of a validation (504) and
+# number of credentials accepted per request by creds/validate
+IPATUURA_PAM = {
+    'WORKERS': int(os.environ.get('IPATUURA_PAM_WORKERS', '8')),
+    'MAX_QUEUE': int(os.environ.get('IPATUURA_PAM_MAX_QUEUE', '64')),
+    'TIMEOUT': float(os.environ.get('IPATUURA_PAM_TIMEOUT', '10')),
+    'MAX_BATCH': int(os.environ.get('IPATUURA_PAM_MAX_BATCH', '1000')),
+}
+
+# Keytab of the host principal, the tickets of the Kerberos credential
+# validations are verified with it. Without it, the domains configured
+# with password_validation=kerberos refuse the validations.
+IPATUURA_KERBEROS_KEYTAB = os.environ.get('IPATUURA_KERBEROS_KEYTAB', '/etc/krb5.keytab')
+
+# Admission control of the backends shared by all the clients: at most
+# CONCURRENCY calls run at once, MAX_QUEUE more wait up to TIMEOUT seconds.
+# The other calls are answered with 429, the ones waiting too long with
+# 503, both with a Retry-After header of RETRY_AFTER seconds
+IPATUURA_ADMISSION = {
+    'RETRY_AFTER': int(os.environ.get('IPATUURA_RETRY_AFTER', '1')),
+    'infopipe': {
+        'CONCURRENCY': int(os.environ.get('IPATUURA_INFOPIPE_CONCURRENCY', '16')),
+        'MAX_QUEUE': int(os.environ.get('IPATUURA_INFOPIPE_MAX_QUEUE', '64')),
+        'TIMEOUT': float(os.environ.get('IPATUURA_INFOPIPE_TIMEOUT', '5')),
+    },
+    'ipa': {
+        'CONCURRENCY': int(os.environ.get('IPATUURA_IPA_CONCURRENCY', '8')),
+        'MAX_QUEUE': int(os.environ.get('IPATUURA_IPA_MAX_QUEUE', '32')),
+        'TIMEOUT': float(os.environ.get('IPATUURA_IPA_TIMEOUT', '10')),
+    },
+    'ldap': {
+        'CONCURRENCY': int(os.environ.get('IPATUURA_LDAP_CONCURRENCY', '8')),
+        'MAX_QUEUE': int(os.environ.get('IPATUURA_LDAP_MAX_QUEUE', '32')),
+        'TIMEOUT': float(os.environ.get('IPATUURA_LDAP_TIMEOUT', '10')),
+    },
+}
+
+# Request tracing: spans of the SSSD lookups, directory writes and database
+# queries. SAMPLE_RATE of the requests are exported by EXPORTER ('file'
+# appends OTLP JSON lines to FILE, 'otlp' posts them to OTLP_ENDPOINT), the
+# span tree of the requests slower than SLOW_REQUEST seconds is logged
+IPATUURA_TRACING = {
+    'ENABLED': os.environ.get('IPATUURA_TRACING', '') == 'True',
+    'SAMPLE_RATE': float(os.environ.get('IPATUURA_TRACING_SAMPLE_RATE', '0.01')),
+    'EXPORTER': os.environ.get('IPATUURA_TRACING_EXPORTER', ''),
+    'FILE': os.environ.get('IPATUURA_TRACING_FILE', '/var/log/ipatuura/traces.jsonl'),
+    'OTLP_ENDPOINT': os.environ.get('IPATUURA_TRACING_OTLP_ENDPOINT', 'http://localhost:4318/v1/traces'),
+    'SLOW_REQUEST': float(os.environ.get('IPATUURA_TRACING_SLOW_REQUEST', '2')),
+}
+
 # admin endpoint so that we can handle permissions and required fields only for authenticated users
 #REST_FRAMEWORK = {
 #    'DEFAULT_PERMISSION_CLASSES': ('rest_framework.permissions.IsAuthenticated',)
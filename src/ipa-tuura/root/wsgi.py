@@ -16,8 +16,12 @@ import sys
 
 from django.core.wsgi import get_wsgi_application
 
-sys.path.append(os.path.dirname(os.path.abspath(__file__)) + "/..")
-sys.path.append(os.path.dirname(os.path.abspath(__file__)) + "/../root")
+# normalized, the same directory listed twice under two names makes the
+# domains namespace package span two locations
+sys.path.append(os.path.normpath(os.path.dirname(os.path.abspath(__file__)) + "/.."))
+sys.path.append(
+    os.path.normpath(os.path.dirname(os.path.abspath(__file__)) + "/../root")
+)
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "root.settings")
 
 application = get_wsgi_application()